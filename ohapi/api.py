@@ -3,10 +3,19 @@ Utility functions to use the OAuth2 project API to e.g. message users, download
 their files, upload new ones and delete existing files.
 """
 
+import bz2
 from collections import OrderedDict
+import concurrent.futures
+from contextlib import contextmanager
+import copy
+import hashlib
 import json
 import logging
 import os
+import tempfile
+import threading
+import time
+import zlib
 try:
     import urllib.parse as urlparse
 except ImportError:
@@ -17,7 +26,13 @@ import requests
 
 
 MAX_FILE_DEFAULT = parse_size('128m')
+SPOOL_SIZE_DEFAULT = parse_size('32m')
+CHUNK_SIZE_DEFAULT = parse_size('64k')
+MAX_WORKERS_DEFAULT = 4
+THROTTLE_STATUS_CODES = frozenset([429, 502, 503, 504])
+COMPRESSION_SUFFIXES = OrderedDict([('gzip', '.gz'), ('bz2', '.bz2')])
 OH_BASE_URL = os.getenv('OHAPI_OH_BASE_URL', 'https://www.openhumans.org/')
+REQUEST_TIMEOUT = float(os.getenv('OHAPI_REQUEST_TIMEOUT', '60'))
 
 
 class SettingsError(Exception):
@@ -101,55 +116,128 @@ def oauth2_token_exchange(client_id, client_secret, redirect_uri,
     return data
 
 
+class _Flight(object):
+    """
+    A GET request in flight, shared by the get_page calls made for its URL
+    while it runs.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.copies = []
+        self.error = None
+
+
+# GET requests in flight, keyed by URL.
+_flights = {}
+_flights_lock = threading.Lock()
+
+
 def get_page(url):
     """
     Get a single page of results.
 
+    Concurrent calls for the same url (e.g. from threads sharing an
+    OHProject) are coalesced into a single request. The first call makes
+    the request, and the others wait for it and get a copy of its parsed
+    JSON (or its error). Calls made after it completes make a new request.
+
     :param url: This field is the url from which data will be requested.
     """
-    response = requests.get(url)
-    handle_error(response, 200)
-    data = response.json()
+    with _flights_lock:
+        flight = _flights.get(url)
+        leader = flight is None
+        if leader:
+            flight = _flights[url] = _Flight()
+        else:
+            flight.followers += 1
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.copies.pop()
+
+    data = None
+    try:
+        response = requests.get(url)
+        handle_error(response, 200)
+        data = response.json()
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[url]
+        # No more followers can join, so each gets its own copy, made
+        # before the caller can change data.
+        if flight.error is None:
+            flight.copies = [copy.deepcopy(data) for _ in
+                             range(flight.followers)]
+        flight.done.set()
+        if flight.followers:
+            logging.debug('Shared request with {} other calls: {}'.format(
+                flight.followers, url))
     return data
 
 
-def get_all_results(starting_page):
+def iter_pages(starting_page, executor=None):
     """
-    Given starting API query for Open Humans, iterate to get all results.
+    Given starting API query for Open Humans, yield each page of results.
 
     :param starting page: This field is the first page, starting from which
         results will be obtained.
+    :param executor: If provided, this concurrent.futures executor is used
+        to fetch the next page while the current one is being used. Its
+        default value is None.
     """
-    logging.info('Retrieving all results for {}'.format(starting_page))
-    page = starting_page
-    results = []
-
+    logging.debug('Getting data from: {}'.format(starting_page))
+    data = get_page(starting_page)
     while True:
-        logging.debug('Getting data from: {}'.format(page))
-        data = get_page(page)
         logging.debug('JSON data: {}'.format(data))
-        results = results + data['results']
-
+        next_page = None
         if data['next']:
-            page = data['next']
-        else:
+            logging.debug('Getting data from: {}'.format(data['next']))
+            if executor is not None:
+                next_page = executor.submit(get_page, data['next'])
+        yield data
+        if not data['next']:
             break
+        data = (next_page.result() if next_page is not None else
+                get_page(data['next']))
+
+
+def get_all_results(starting_page):
+    """
+    Given starting API query for Open Humans, iterate to get all results.
 
+    :param starting page: This field is the first page, starting from which
+        results will be obtained.
+    """
+    logging.info('Retrieving all results for {}'.format(starting_page))
+    results = []
+    for data in iter_pages(starting_page):
+        results += data['results']
     return results
 
 
 def exchange_oauth2_member(access_token, base_url=OH_BASE_URL,
-                           all_files=True):
+                           all_files=True, project_member_id=None):
     """
     Returns data for a specific user, including shared data files.
 
-    :param access_token: This field is the user specific access_token.
+    :param access_token: This field is the user specific access_token, or
+        the project's master access token if project_member_id is given.
     :param base_url: It is this URL `https://www.openhumans.org`.
+    :param project_member_id: If provided, data is returned for this project
+        member, using a master access token. Its default value is None.
     """
+    params = {'access_token': access_token}
+    if project_member_id:
+        params['project_member_id'] = project_member_id
     url = urlparse.urljoin(
         base_url,
         '/api/direct-sharing/project/exchange-member/?{}'.format(
-            urlparse.urlencode({'access_token': access_token})))
+            urlparse.urlencode(params)))
     member_data = get_page(url)
 
     returned = member_data.copy()
@@ -163,6 +251,7 @@ def exchange_oauth2_member(access_token, base_url=OH_BASE_URL,
     logging.debug('JSON data: {}'.format(returned))
     return returned
 
+
 def delete_file(access_token, project_member_id=None, base_url=OH_BASE_URL,
                 file_basename=None, file_id=None, all_files=False):
     """
@@ -203,6 +292,292 @@ def delete_file(access_token, project_member_id=None, base_url=OH_BASE_URL,
     return response
 
 
+# The limiter slot (if any) of the call running in each thread, which
+# handle_error reports response outcomes to.
+_slots = threading.local()
+
+
+class AdaptiveLimiter(object):
+    """
+    Limit on concurrent API calls and transfers that adapts to how Open
+    Humans (and S3) respond, using additive increase and multiplicative
+    decrease (AIMD).
+
+    Calls run in a :func:`slot<ohapi.api.AdaptiveLimiter.slot>` report the
+    outcome of each response checked by :func:`handle_error
+    <ohapi.api.handle_error>`. The limit grows by one after about limit
+    successful responses that took at most max_latency, and is
+    multiplied by decrease when a response is throttled (status 429, 502,
+    503 or 504) or a request times out. Calls started before the last
+    decrease don't decrease it again, so one burst of throttling backs off
+    once.
+
+    :param max_limit: This field is the highest concurrency allowed. Its
+        default value is 16.
+    :param min_limit: This field is the lowest concurrency allowed. Its
+        default value is 1.
+    :param initial_limit: This field is the starting concurrency. Its
+        default value is None, for 4 (limited to min_limit and max_limit).
+    :param decrease: This field is the factor the limit is multiplied by on
+        throttling. Its default value is 0.5.
+    :param max_latency: If provided, this field is the response time in
+        seconds above which the limit isn't increased. Its default value is
+        None.
+    """
+    def __init__(self, max_limit=16, min_limit=1, initial_limit=None,
+                 decrease=0.5, max_latency=None):
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError('Limits should satisfy 1 <= min_limit <= '
+                             'max_limit.')
+        if not 0 < decrease < 1:
+            raise ValueError('decrease should be between 0 and 1.')
+        if initial_limit is None:
+            initial_limit = MAX_WORKERS_DEFAULT
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease = decrease
+        self.max_latency = max_latency
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._in_flight = 0
+        self._last_decrease = None
+        self._latency = None
+        self._counts = dict.fromkeys(
+            ['succeeded', 'failed', 'throttled', 'increases', 'decreases'], 0)
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """
+        The current concurrency limit.
+        """
+        return int(self._limit)
+
+    def acquire(self):
+        """
+        Wait until fewer than limit calls are in flight, then start one.
+        """
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self):
+        """
+        Finish a call started with :func:`acquire
+        <ohapi.api.AdaptiveLimiter.acquire>`.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+        Context manager running a call within the limit, and reporting the
+        responses checked by :func:`handle_error<ohapi.api.handle_error>`
+        in this thread (and timeouts or connection errors) to the limiter.
+        """
+        self.acquire()
+        previous = getattr(_slots, 'current', None)
+        started = time.monotonic()
+        # handle_error sets the last item once it reports an error.
+        current = _slots.current = [self, started, False]
+        try:
+            yield
+        except (requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError):
+            self.record('throttled', started=started)
+            raise
+        except Exception:
+            # Errors not already reported, e.g. an MD5 mismatch.
+            if not current[2]:
+                self.record('error', started=started)
+            raise
+        finally:
+            _slots.current = previous
+            self.release()
+
+    def record(self, outcome, latency=None, started=None):
+        """
+        Adjust the limit after a response.
+
+        :param outcome: This field is 'success', 'throttled' or 'error' (for
+            other errors, which don't change the limit).
+        :param latency: If provided, this field is the response time in
+            seconds. Its default value is None.
+        :param started: If provided, this field is the time.monotonic() time
+            the call started. Its default value is None.
+        """
+        with self._condition:
+            old_limit = int(self._limit)
+            if outcome == 'success':
+                self._counts['succeeded'] += 1
+                if latency is not None:
+                    self._latency = (latency if self._latency is None else
+                                     0.8 * self._latency + 0.2 * latency)
+                if (self.max_latency is None or latency is None or
+                        latency <= self.max_latency):
+                    self._limit = min(self._limit + 1.0 / old_limit,
+                                      float(self.max_limit))
+            elif outcome == 'throttled':
+                self._counts['throttled'] += 1
+                if (started is None or self._last_decrease is None or
+                        started >= self._last_decrease):
+                    self._limit = max(self._limit * self.decrease,
+                                      float(self.min_limit))
+                    self._last_decrease = time.monotonic()
+                    self._counts['decreases'] += 1
+            else:
+                self._counts['failed'] += 1
+            if int(self._limit) > old_limit:
+                self._counts['increases'] += 1
+            if int(self._limit) != old_limit:
+                logging.debug('Concurrency limit {} -> {}'.format(
+                    old_limit, int(self._limit)))
+                self._condition.notify_all()
+
+    def metrics(self):
+        """
+        Return a dict of the current limit, its bounds, the calls in flight,
+        the mean recent latency and counts of responses and limit changes.
+        """
+        with self._condition:
+            metrics = dict(self._counts)
+            metrics.update({'limit': int(self._limit),
+                            'min_limit': self.min_limit,
+                            'max_limit': self.max_limit,
+                            'in_flight': self._in_flight,
+                            'latency': self._latency})
+            return metrics
+
+
+def _record_response(r, expected_code):
+    """
+    Helper function to report a response to the limiter of the current
+    thread's call, if it's running in an :class:`AdaptiveLimiter
+    <ohapi.api.AdaptiveLimiter>` slot.
+    """
+    current = getattr(_slots, 'current', None)
+    if current is None:
+        return
+    limiter, started, _ = current
+    if r.status_code == expected_code:
+        outcome = 'success'
+    elif r.status_code in THROTTLE_STATUS_CODES:
+        outcome = 'throttled'
+    else:
+        outcome = 'error'
+    current[2] = outcome != 'success'
+    try:
+        latency = float(r.elapsed.total_seconds())
+    except (AttributeError, TypeError):
+        latency = None
+    limiter.record(outcome, latency=latency, started=started)
+
+
+def _run_concurrently(func, calls, max_workers=MAX_WORKERS_DEFAULT,
+                      limiter=None):
+    """
+    Helper function to run API calls concurrently, limited to max_workers
+    calls in flight at once. Results are returned in the order of calls, and
+    the first exception raised by a call is re-raised.
+
+    :param func: This field is the function to call.
+    :param calls: This field is a list of dicts of keyword arguments, one for
+        each call.
+    :param max_workers: This field is the maximum number of concurrent calls.
+        Its default value is 4.
+    :param limiter: If provided, this field is an :class:`AdaptiveLimiter
+        <ohapi.api.AdaptiveLimiter>` setting the number of calls in flight
+        instead of max_workers. Its default value is None.
+    """
+    if not calls:
+        return []
+    if limiter is not None:
+        unlimited = func
+        max_workers = limiter.max_limit
+
+        def limited(**kwargs):
+            with limiter.slot():
+                return unlimited(**kwargs)
+        func = limited
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        futures = [executor.submit(func, **kwargs) for kwargs in calls]
+        return [future.result() for future in futures]
+
+
+def delete_files_bulk(access_token, targets, base_url=OH_BASE_URL,
+                      member_files=None, max_workers=MAX_WORKERS_DEFAULT,
+                      limiter=None, allow_all_files=False):
+    """
+    Delete many project member files concurrently. Returns the list of
+    responses, one for each delete request made.
+
+    Each target is a (project_member_id, file) pair, where file is a file
+    basename (str), a file ID (int), or None to delete all files. If
+    allow_all_files is True, member_files lists a member's files, and every
+    one of them is targeted, that member's files are removed with a single
+    all_files request. That also deletes any file missing from member_files
+    (e.g. one uploaded after it was listed), so only allow it with a
+    current listing.
+
+    :param access_token: This field is the master access token.
+    :param targets: This field is an iterable of (project_member_id, file)
+        pairs.
+    :param base_url: It is this URL `https://www.openhumans.org`.
+    :param member_files: This field is a dict mapping project member IDs to
+        the project's own files for that member (dicts with "basename" and
+        "id"), e.g. from an OHProject. Its default value is None.
+    :param max_workers: This field is the maximum number of concurrent delete
+        requests. Its default value is 4.
+    :param limiter: If provided, this field is an :class:`AdaptiveLimiter
+        <ohapi.api.AdaptiveLimiter>` adapting the number of concurrent delete
+        requests, instead of max_workers. Its default value is None.
+    :param allow_all_files: If True, targets covering all of a member's
+        files in member_files are collapsed into one all_files request. Its
+        default value is False.
+    """
+    basenames = OrderedDict()
+    file_ids = OrderedDict()
+    delete_all = set()
+    for project_member_id, target in targets:
+        basenames.setdefault(project_member_id, set())
+        file_ids.setdefault(project_member_id, set())
+        if target is None:
+            delete_all.add(project_member_id)
+        elif isinstance(target, int):
+            file_ids[project_member_id].add(target)
+        else:
+            basenames[project_member_id].add(target)
+
+    if member_files and allow_all_files:
+        for project_member_id in basenames:
+            if project_member_id not in member_files:
+                continue
+            remote = member_files[project_member_id]
+            if remote and all(
+                    f['basename'] in basenames[project_member_id] or
+                    f['id'] in file_ids[project_member_id] for f in remote):
+                delete_all.add(project_member_id)
+
+    calls = []
+    for project_member_id in basenames:
+        kwargs = {'access_token': access_token,
+                  'project_member_id': project_member_id,
+                  'base_url': base_url}
+        if project_member_id in delete_all:
+            calls.append(dict(kwargs, all_files=True))
+            continue
+        for file_basename in sorted(basenames[project_member_id]):
+            calls.append(dict(kwargs, file_basename=file_basename))
+        for file_id in sorted(file_ids[project_member_id]):
+            calls.append(dict(kwargs, file_id=file_id))
+    logging.info('Deleting files with {} requests'.format(len(calls)))
+    return _run_concurrently(delete_file, calls, max_workers=max_workers,
+                             limiter=limiter)
+
+
 # Alternate names for the same functions.
 def delete_files(*args, **kwargs):
     """
@@ -265,15 +640,137 @@ def handle_error(r, expected_code):
         function.
     """
     code = r.status_code
+    _record_response(r, expected_code)
     if code != expected_code:
         info = 'API response status code {}:\n{}'.format(code, r.content)
         raise Exception(info)
 
 
+def _is_seekable(stream):
+    """
+    Helper function to check whether a file object supports tell and seek.
+
+    :param stream: This field is the stream (or file object) to be checked.
+    """
+    seekable = getattr(stream, 'seekable', None)
+    if seekable is not None:
+        # seekable() may itself fail, e.g. for a member of a tar archive
+        # opened in stream mode, whose underlying stream can't seek.
+        try:
+            return seekable()
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+    try:
+        stream.tell()
+    except (AttributeError, IOError, OSError):
+        return False
+    return True
+
+
+def _iter_chunks(source, chunk_size=CHUNK_SIZE_DEFAULT):
+    """
+    Helper function to yield chunks of bytes from a file object or an
+    iterable of bytes (e.g. a generator).
+
+    :param source: This field is the file object or iterable to read from.
+    :param chunk_size: This field is the size of chunks read from file
+        objects. Its default value is 64k.
+    """
+    if hasattr(source, 'read'):
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            yield chunk
+    else:
+        for chunk in source:
+            if chunk:
+                yield chunk
+
+
+def spool_stream(source, max_bytes=MAX_FILE_DEFAULT,
+                 spool_size=SPOOL_SIZE_DEFAULT, file_identifier=None,
+                 digest=None):
+    """
+    Copy a non-seekable stream or an iterable of bytes into a seekable
+    temporary file. Data is held in memory up to spool_size, and written to a
+    temporary file on disk beyond that. The returned file is positioned at
+    its start and should be closed by the caller.
+
+    :param source: This field is the file object (e.g. a pipe) or iterable of
+        bytes (e.g. a generator) to be spooled.
+    :param max_bytes: This field is the maximum number of bytes to accept.
+        A ValueError is raised as soon as it is exceeded. Its default value
+        is 128m.
+    :param spool_size: This field is the number of bytes held in memory
+        before spooling to disk. Its default value is 32m.
+    :param file_identifier: If provided, this is used in logging output. Its
+        default value is None.
+    :param digest: If provided, this hashlib object is updated with the data
+        as it is spooled. Its default value is None.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    filesize = 0
+    try:
+        for chunk in _iter_chunks(source):
+            filesize += len(chunk)
+            if _exceeds_size(filesize, max_bytes, file_identifier):
+                raise ValueError("Maximum file size exceeded")
+            if digest is not None:
+                digest.update(chunk)
+            spooled.write(chunk)
+    except Exception:
+        spooled.close()
+        raise
+    spooled.seek(0)
+    return spooled
+
+
+def compressed_filename(filename, compress):
+    """
+    Return the filename a file will have on Open Humans once compressed.
+
+    Filenames that already have a compression suffix are returned unchanged,
+    as these files are not compressed again.
+
+    :param filename: This field is the name of the file.
+    :param compress: This field is the compression format, either 'gzip' or
+        'bz2'.
+    """
+    if compress not in COMPRESSION_SUFFIXES:
+        raise ValueError('Unsupported compression: {}'.format(compress))
+    if filename.endswith(tuple(COMPRESSION_SUFFIXES.values())):
+        return filename
+    return filename + COMPRESSION_SUFFIXES[compress]
+
+
+def compress_chunks(source, compress, chunk_size=CHUNK_SIZE_DEFAULT):
+    """
+    Yield compressed chunks of bytes while reading from a file object or an
+    iterable of bytes, so data is compressed without an extra pass.
+
+    :param source: This field is the file object or iterable to compress.
+    :param compress: This field is the compression format, either 'gzip' or
+        'bz2'.
+    :param chunk_size: This field is the size of chunks read from file
+        objects. Its default value is 64k.
+    """
+    if compress == 'gzip':
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compress == 'bz2':
+        compressor = bz2.BZ2Compressor()
+    else:
+        raise ValueError('Unsupported compression: {}'.format(compress))
+    for chunk in _iter_chunks(source, chunk_size):
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 def upload_stream(stream, filename, metadata, access_token, datatypes=None,
                   base_url=OH_BASE_URL, remote_file_info=None,
                   project_member_id=None, max_bytes=MAX_FILE_DEFAULT,
-                  file_identifier=None):
+                  file_identifier=None, compress=None, set_md5=False,
+                  timeout=REQUEST_TIMEOUT):
     """
     Upload a file object using the "direct upload" feature, which uploads to
     an S3 bucket URL provided by the Open Humans API. To learn more about this
@@ -293,12 +790,50 @@ def upload_stream(stream, filename, metadata, access_token, datatypes=None,
         all members of a project. Its default value is None.
     :param max_bytes: This field is the maximum file size a user can upload.
         Its default value is 128m.
-    :param max_bytes: If provided, this is used in logging output. Its default
-        value is None (in which case, filename is used).
+    :param file_identifier: If provided, this is used in logging output. Its
+        default value is None (in which case, filename is used).
+
+    :param compress: If 'gzip' or 'bz2', data is compressed while it is read
+        and the matching suffix is added to filename. If 'md5' is in metadata
+        it is replaced with the MD5 of the compressed data. Its default value
+        is None.
+    :param set_md5: If True, the MD5 of the uploaded data is computed and set
+        as 'md5' in the metadata. Data up to 32m is read once into memory,
+        hashed and uploaded from there. Larger streams are read twice: they
+        are hashed, rewound and then uploaded, as the metadata is sent
+        before the upload and the API can't change it afterwards. Its
+        default value is False.
+    :param timeout: This field is the number of seconds to wait to connect,
+        or for data, before a request fails with requests.exceptions.Timeout.
+        Its default value is REQUEST_TIMEOUT (the OHAPI_REQUEST_TIMEOUT
+        environment variable, or 60).
+
+    Streams that can't seek (e.g. pipes) are spooled using
+    :func:`upload_iter<ohapi.api.upload_iter>`.
     """
     if not file_identifier:
         file_identifier = filename
 
+    if compress and compressed_filename(filename, compress) != filename:
+        return upload_iter(
+            compress_chunks(stream, compress),
+            filename=compressed_filename(filename, compress),
+            metadata=metadata, access_token=access_token,
+            datatypes=datatypes, base_url=base_url,
+            remote_file_info=remote_file_info,
+            project_member_id=project_member_id, max_bytes=max_bytes,
+            file_identifier=file_identifier,
+            set_md5=set_md5 or 'md5' in metadata, timeout=timeout)
+
+    if not _is_seekable(stream):
+        return upload_iter(
+            stream, filename=filename, metadata=metadata,
+            access_token=access_token, datatypes=datatypes,
+            base_url=base_url, remote_file_info=remote_file_info,
+            project_member_id=project_member_id, max_bytes=max_bytes,
+            file_identifier=file_identifier, set_md5=set_md5,
+            timeout=timeout)
+
     # Determine a stream's size using seek.
     # f is a file-like object.
     old_position = stream.tell()
@@ -308,11 +843,29 @@ def upload_stream(stream, filename, metadata, access_token, datatypes=None,
     if filesize == 0:
         raise Exception('The submitted file is empty.')
 
+    if set_md5:
+        if filesize - old_position <= SPOOL_SIZE_DEFAULT:
+            # Small enough to hold in memory: read it once, for both the
+            # MD5 and the upload.
+            return upload_iter(
+                stream, filename=filename, metadata=metadata,
+                access_token=access_token, datatypes=datatypes,
+                base_url=base_url, remote_file_info=remote_file_info,
+                project_member_id=project_member_id, max_bytes=max_bytes,
+                file_identifier=file_identifier, set_md5=True,
+                timeout=timeout)
+        file_md5 = hashlib.md5()
+        for chunk in _iter_chunks(stream):
+            file_md5.update(chunk)
+        stream.seek(old_position, os.SEEK_SET)
+        metadata = dict(metadata, md5=file_md5.hexdigest())
+
     # Check size, and possibly remote file match.
     if _exceeds_size(filesize, max_bytes, file_identifier):
         raise ValueError("Maximum file size exceeded")
     if remote_file_info:
-        response = requests.get(remote_file_info['download_url'], stream=True)
+        response = requests.get(remote_file_info['download_url'],
+                                stream=True, timeout=timeout)
         remote_size = int(response.headers['Content-Length'])
         if remote_size == filesize:
             info_msg = ('Skipping {}, remote exists with matching '
@@ -334,9 +887,9 @@ def upload_stream(stream, filename, metadata, access_token, datatypes=None,
             'filename': filename}
     if datatypes:
         data['datatypes'] = json.dumps(datatypes)
-    r1 = requests.post(url, data=data)
+    r1 = requests.post(url, data=data, timeout=timeout)
     handle_error(r1, 201)
-    r2 = requests.put(url=r1.json()['url'], data=stream)
+    r2 = requests.put(url=r1.json()['url'], data=stream, timeout=timeout)
     handle_error(r2, 200)
     done = urlparse.urljoin(
         base_url,
@@ -344,15 +897,77 @@ def upload_stream(stream, filename, metadata, access_token, datatypes=None,
             urlparse.urlencode({'access_token': access_token})))
 
     r3 = requests.post(done, data={'project_member_id': project_member_id,
-                                   'file_id': r1.json()['id']})
+                                   'file_id': r1.json()['id']},
+                       timeout=timeout)
     handle_error(r3, 200)
     logging.info('Upload complete: {}'.format(file_identifier))
     return r3
 
 
+def upload_iter(source, filename, metadata, access_token, datatypes=None,
+                base_url=OH_BASE_URL, remote_file_info=None,
+                project_member_id=None, max_bytes=MAX_FILE_DEFAULT,
+                file_identifier=None, spool_size=SPOOL_SIZE_DEFAULT,
+                set_md5=False, timeout=REQUEST_TIMEOUT):
+    """
+    Upload data from a non-seekable stream (e.g. a subprocess pipe) or an
+    iterable of bytes (e.g. a generator) using the "direct upload" API.
+
+    The S3 upload URL requires the file size up front, so data is spooled
+    to memory up to spool_size and to a temporary file beyond that before
+    uploading. The max_bytes limit is enforced while spooling, so oversized
+    data is rejected without being read in full.
+
+    :param source: This field is the file object or iterable of bytes to be
+        uploaded.
+    :param filename: This field is the name of the file on Open Humans.
+    :param metadata: This field is the metadata associated with the file.
+        Description and tags are compulsory fields of metadata.
+    :param access_token: This is user specific access token/master token.
+    :param base_url: It is this URL `https://www.openhumans.org`.
+    :param remote_file_info: This field is for for checking if a file with
+        matching name and file size already exists. Its default value is none.
+    :param project_member_id: This field is the list of project member id of
+        all members of a project. Its default value is None.
+    :param max_bytes: This field is the maximum file size a user can upload.
+        Its default value is 128m.
+    :param file_identifier: If provided, this is used in logging output. Its
+        default value is None (in which case, filename is used).
+    :param spool_size: This field is the number of bytes held in memory
+        before spooling to disk. Its default value is 32m.
+    :param set_md5: If True, the MD5 of the data is computed while spooling
+        and set as 'md5' in the metadata. Its default value is False.
+    :param timeout: This field is the number of seconds to wait to connect,
+        or for data, before a request fails with requests.exceptions.Timeout.
+        Its default value is REQUEST_TIMEOUT (the OHAPI_REQUEST_TIMEOUT
+        environment variable, or 60).
+    """
+    if not file_identifier:
+        file_identifier = filename
+    file_md5 = hashlib.md5() if set_md5 else None
+    with spool_stream(source, max_bytes=max_bytes, spool_size=spool_size,
+                      file_identifier=file_identifier,
+                      digest=file_md5) as spooled:
+        if set_md5:
+            metadata = dict(metadata, md5=file_md5.hexdigest())
+        return upload_stream(
+            stream=spooled,
+            filename=filename,
+            metadata=metadata,
+            access_token=access_token,
+            datatypes=datatypes,
+            base_url=base_url,
+            remote_file_info=remote_file_info,
+            project_member_id=project_member_id,
+            max_bytes=max_bytes,
+            file_identifier=file_identifier,
+            timeout=timeout)
+
+
 def upload_file(target_filepath, metadata, access_token, datatypes=None,
                 base_url=OH_BASE_URL, remote_file_info=None,
-                project_member_id=None, max_bytes=MAX_FILE_DEFAULT):
+                project_member_id=None, max_bytes=MAX_FILE_DEFAULT,
+                compress=None, set_md5=False, timeout=REQUEST_TIMEOUT):
     """
     Upload a file from a local filepath using the "direct upload" API.
     To learn more about this API endpoint see:
@@ -372,6 +987,16 @@ def upload_file(target_filepath, metadata, access_token, datatypes=None,
         all members of a project. Its default value is None.
     :param max_bytes: This field is the maximum file size a user can upload.
         It's default value is 128m.
+    :param compress: If 'gzip' or 'bz2', the file is compressed while it is
+        uploaded and the matching suffix is added to its name. Its default
+        value is None.
+    :param set_md5: If True, the MD5 of the file is computed as it is read
+        for upload and set as 'md5' in the metadata. Its default value is
+        False.
+    :param timeout: This field is the number of seconds to wait to connect,
+        or for data, before a request fails with requests.exceptions.Timeout.
+        Its default value is REQUEST_TIMEOUT (the OHAPI_REQUEST_TIMEOUT
+        environment variable, or 60).
     """
     with open(target_filepath, 'rb') as stream:
         filename = os.path.basename(target_filepath)
@@ -385,12 +1010,16 @@ def upload_file(target_filepath, metadata, access_token, datatypes=None,
             remote_file_info=remote_file_info,
             project_member_id=project_member_id,
             max_bytes=max_bytes,
-            file_identifier=target_filepath)
+            file_identifier=target_filepath,
+            compress=compress,
+            set_md5=set_md5,
+            timeout=timeout)
 
 
 def upload_aws(target_filepath, metadata, access_token, base_url=OH_BASE_URL,
                remote_file_info=None, project_member_id=None,
-               max_bytes=MAX_FILE_DEFAULT):
+               max_bytes=MAX_FILE_DEFAULT, compress=None, set_md5=False,
+               timeout=REQUEST_TIMEOUT):
     """
     Upload a file from a local filepath using the "direct upload" API.
     Equivalent to upload_file. To learn more about this API endpoint see:
@@ -409,6 +1038,18 @@ def upload_aws(target_filepath, metadata, access_token, base_url=OH_BASE_URL,
         all members of a project. Its default value is None.
     :param max_bytes: This field is the maximum file size a user can upload.
         It's default value is 128m.
+    :param compress: If 'gzip' or 'bz2', the file is compressed while it is
+        uploaded. Its default value is None.
+    :param set_md5: If True, the MD5 of the file is computed as it is read
+        for upload and set as 'md5' in the metadata. Its default value is
+        False.
+    :param timeout: This field is the number of seconds to wait to connect,
+        or for data, before a request fails with requests.exceptions.Timeout.
+        Its default value is REQUEST_TIMEOUT (the OHAPI_REQUEST_TIMEOUT
+        environment variable, or 60).
     """
-    return upload_file(target_filepath, metadata, access_token, base_url,
-                       remote_file_info, project_member_id, max_bytes)
+    return upload_file(target_filepath, metadata, access_token,
+                       base_url=base_url, remote_file_info=remote_file_info,
+                       project_member_id=project_member_id,
+                       max_bytes=max_bytes, compress=compress,
+                       set_md5=set_md5, timeout=timeout)
@@ -1,4 +1,7 @@
+from collections import OrderedDict
+from itertools import groupby
 import csv
+import json
 import logging
 import os
 import re
@@ -9,16 +12,26 @@ from click import UsageError
 
 from humanfriendly import parse_size
 
-from .api import (OH_BASE_URL, exchange_oauth2_member, message,
-                  delete_file, oauth2_auth_url,
+from .api import (OH_BASE_URL, AdaptiveLimiter, exchange_oauth2_member,
+                  message, delete_file, delete_files_bulk, oauth2_auth_url,
                   oauth2_token_exchange)
 
-from .projects import OHProject
+from .projects import (OHProject, compact_member_data, format_created,
+                       iter_member_data, max_created, parse_created,
+                       parse_shard, select_members)
 from .public import download as public_download
+from .sync import add_download_sizes, plan_download, plan_member_download
+from .sync import SyncPlan, execute_plan, plan_upload
 from .utils_fs import load_metadata_csv, mk_metadata_csv, read_id_list
+from .utils_fs import archive_format, is_jsonl_path, open_output_file
+from .utils_fs import is_archive, iter_archive_files, open_sink
+from .utils_fs import read_delete_targets, read_manifest
+from .utils_fs import read_download_state, write_download_state
 from .utils_fs import review_metadata_csv
+from .work_queue import WorkQueue, enqueue_plan, run_queue
 
 MAX_FILE_DEFAULT = parse_size('128m')
+DOWNLOAD_STATE_FILENAME = '.ohapi-download-state.json'
 
 
 def set_log_level(debug, verbose):
@@ -36,7 +49,8 @@ def set_log_level(debug, verbose):
 
 @click.command()
 @click.option('-d', '--directory',
-              help='Target directory for downloaded files.', required=True)
+              help='Target directory (or .tar, .tar.gz, .tar.bz2 or .zip '
+              'archive) for downloaded files.', required=True)
 @click.option('-T', '--master-token', help='Project master access token.')
 @click.option('-m', '--member', help='Project member ID.')
 @click.option('-t', '--access-token', help='OAuth2 user access token.')
@@ -53,10 +67,38 @@ def set_log_level(debug, verbose):
 @click.option('--excludelist', help='Text file with blacklist IDs to avoid')
 @click.option('--id-filename', is_flag=True,
               help='Prepend filenames with IDs to ensure uniqueness.')
+@click.option('--manifest', help='JSON Lines file recording the digests of '
+              'downloaded files.')
+@click.option('--sha256', is_flag=True,
+              help='Also compute SHA-256 digests of downloaded files.')
+@click.option('--dry-run', is_flag=True,
+              help='Print the files that would be downloaded, and their '
+              'sizes, without downloading them.')
+@click.option('--since', help='Only download files created after this ISO '
+              '8601 time.')
+@click.option('--since-last-run', is_flag=True,
+              help='Only download files created since the last run that used '
+              '--since or --since-last-run with the same state file.')
+@click.option('--state-file', help='JSON file recording the latest created '
+              'time of downloaded files, used by --since-last-run. Defaults '
+              'to {} in the target directory.'.format(
+                  DOWNLOAD_STATE_FILENAME))
+@click.option('--shard', help='Only process the Kth of N disjoint shards of '
+              'project members, given as K/N (e.g. 2/4).')
+@click.option('--queue', help='SQLite work queue file shared by download '
+              'processes. Several processes given the same queue (and '
+              'options) split the downloads between them.')
+@click.option('--max-concurrency', type=int,
+              help='With --queue, adapt the number of concurrent downloads '
+              'between 1 and this limit, backing off when requests are '
+              'throttled or time out.')
 def download_cli(directory, master_token=None, member=None, access_token=None,
                  source=None, project_data=False, max_size='128m',
                  verbose=False, debug=False, memberlist=None,
-                 excludelist=None, id_filename=False):
+                 excludelist=None, id_filename=False, manifest=None,
+                 sha256=False, dry_run=False, since=None,
+                 since_last_run=False, state_file=None, shard=None,
+                 queue=None, max_concurrency=None):
     """
     Command line function for downloading data from project members to the
     target directory. For more information visit
@@ -64,13 +106,17 @@ def download_cli(directory, master_token=None, member=None, access_token=None,
     """
     return download(directory, master_token, member, access_token, source,
                     project_data, max_size, verbose, debug, memberlist,
-                    excludelist, id_filename)
+                    excludelist, id_filename, manifest, sha256, dry_run,
+                    since, since_last_run, state_file, shard, queue,
+                    max_concurrency)
 
 
 def download(directory, master_token=None, member=None, access_token=None,
              source=None, project_data=False, max_size='128m', verbose=False,
              debug=False, memberlist=None, excludelist=None,
-             id_filename=False):
+             id_filename=False, manifest=None, sha256=False, dry_run=False,
+             since=None, since_last_run=False, state_file=None,
+             shard=None, queue=None, max_concurrency=None):
     """
     Download data from project members to the target directory.
 
@@ -84,6 +130,44 @@ def download(directory, master_token=None, member=None, access_token=None,
     (the project's own data files, instead of data from other sources) will be
     downloaded for each member.
 
+    Files are hashed as they are downloaded. Files uploaded with an "md5" in
+    their metadata are verified, and a mismatched file is removed. If a
+    manifest is given, each downloaded file's digests are appended to it.
+
+    For incremental downloads, files can be limited to those created after a
+    time (since), or after the latest created time of files seen by the last
+    run (since_last_run). Files are filtered on their "created" time before
+    anything is checked or downloaded. When either is used, the latest
+    created time of the selected members' files is recorded in the state
+    file after the download completes, unless any files failed to download
+    (they're logged and skipped), so the next run tries them again. A state
+    file records a single high-water mark, so runs with different sources
+    or members should use different state files.
+
+    A project's members can be split between hosts with shard: each member
+    is assigned to one of N shards by a stable hash of their project member
+    ID, so hosts given shards 1/N to N/N download disjoint sets of members
+    whose directories merge cleanly.
+
+    Several processes on one host can share the work of a download with a
+    queue (see :class:`WorkQueue<ohapi.work_queue.WorkQueue>`). The first
+    process plans the download and adds the planned files to the queue
+    while the others wait, then each claims files until none are left, so
+    each file is downloaded by one process. Leases on files are renewed
+    while they download. Use a new queue file for each download run. With
+    max_concurrency, each process adapts its number of concurrent downloads
+    (see :class:`AdaptiveLimiter<ohapi.api.AdaptiveLimiter>`), adding
+    downloads while they succeed and halving them when requests are throttled.
+
+    For a whole project, directory may instead be a tar or zip archive
+    filepath (e.g. "project.tar.gz" or "project.zip"). Files are then
+    streamed from their downloads into a new archive, laid out as they would
+    be in a directory, without writing any intermediate files. As each run
+    replaces the archive, archives can't be used for incremental downloads.
+    An archive can't be rewound, so if a file fails to download or verify,
+    the download stops and the archive is left with ".incomplete" added to
+    its name.
+
     :param directory: This field is the target directory to download data.
     :param master_token: This field is the master access token for the project.
         It's default value is None.
@@ -104,12 +188,40 @@ def download(directory, master_token=None, member=None, access_token=None,
         downloaded. It's default value is None.
     :param excludelist: This field is list of members whose data will be
         skipped. It's default value is None.
+    :param manifest: This field is the filepath of a JSON Lines manifest
+        recording the digests of downloaded files. It's default value is None.
+    :param sha256: If True, SHA-256 digests are also computed. It's default
+        value is False.
+    :param dry_run: If True, the download plan (see
+        :func:`plan_download<ohapi.sync.plan_download>`) is printed and
+        returned, and nothing is downloaded. It's default value is False.
+    :param since: If provided, only files created after this ISO 8601 time
+        are downloaded. It's default value is None.
+    :param since_last_run: If True, only files created since the high-water
+        mark recorded in the state file are downloaded. If there's no state
+        file, all files are downloaded. It's default value is False.
+    :param state_file: This field is the filepath of the JSON state file. It's
+        default value is None, for ".ohapi-download-state.json" in the target
+        directory.
+    :param shard: If provided, only members in this shard, given as "K/N",
+        are downloaded. It's default value is None.
+    :param queue: If provided, this field is the filepath of a SQLite work
+        queue shared with other download processes. It's default value is
+        None.
+    :param max_concurrency: If provided, this field is the most concurrent
+        downloads each process running a queue adapts up to. It's default
+        value is None, for one download at a time.
     """
     set_log_level(debug, verbose)
 
-    if (memberlist or excludelist) and (member or access_token):
-        raise UsageError('Please do not provide a memberlist or excludelist '
-                         'when retrieving data for a single member.')
+    if (memberlist or excludelist or shard) and (member or access_token):
+        raise UsageError('Please do not provide a memberlist, excludelist or '
+                         'shard when retrieving data for a single member.')
+    if shard:
+        try:
+            shard = parse_shard(shard)
+        except ValueError as e:
+            raise UsageError(str(e))
     memberlist = read_id_list(memberlist)
     excludelist = read_id_list(excludelist)
     if not (master_token or access_token) or (master_token and access_token):
@@ -118,44 +230,178 @@ def download(directory, master_token=None, member=None, access_token=None,
     if (source and project_data):
         raise UsageError("It doesn't make sense to use both 'source' and"
                          "'project-data' options!")
-
-    if master_token:
-        project = OHProject(master_access_token=master_token)
+    if since and since_last_run:
+        raise UsageError('Please use either --since or --since-last-run, '
+                         'not both.')
+    if max_concurrency is not None and (not queue or max_concurrency < 1):
+        raise UsageError('--max-concurrency should be at least 1, and is '
+                         'only used with --queue.')
+    archive = archive_format(directory)
+    if archive and (member or access_token or queue):
+        raise UsageError('Archives can only be written when downloading a '
+                         'whole project without a queue.')
+    if archive and (since or since_last_run):
+        # A new archive would replace the files of earlier runs.
+        raise UsageError('--since and --since-last-run need a directory, not '
+                         'an archive.')
+    state_file = state_file or os.path.join(directory,
+                                            DOWNLOAD_STATE_FILENAME)
+    if since_last_run:
+        since = read_download_state(state_file).get('since')
+        if since is None:
+            logging.info('No earlier run recorded in {}, downloading all '
+                         'files.'.format(state_file))
+    created_after = None
+    if since:
+        created_after = parse_created(since)
+        if created_after is None:
+            raise UsageError('Unable to parse time: {}'.format(since))
+        logging.info('Downloading files created after {}'.format(
+            format_created(created_after)))
+
+    def latest_created(project, member_data):
+        if master_token and not member:
+            members = None
+            if memberlist is not None or excludelist or shard:
+                members = list(select_members(
+                    project.project_data, memberlist=memberlist,
+                    excludelist=excludelist, shard=shard))
+            return project.latest_created(members=members)
+        if master_token:
+            member_data = project.project_data[member]
+        return max_created(member_data['data'])
+
+    project = member_data = latest = None
+    # The high-water mark is only recorded if every file was downloaded.
+    finished = True
+    if dry_run or queue:
+        def make_plan():
+            manifest_records = read_manifest(manifest) if manifest else None
+            if master_token and not member:
+                project = OHProject(master_access_token=master_token)
+                return project, None, plan_download(
+                    project, directory,
+                    source=source, project_data=project_data,
+                    memberlist=memberlist, excludelist=excludelist,
+                    id_filename=id_filename, manifest=manifest,
+                    created_after=created_after, shard=shard)
+            if master_token:
+                project = OHProject(master_access_token=master_token,
+                                    lazy=True)
+                member_data = project.project_data[member]
+            else:
+                project = None
+                member_data = exchange_oauth2_member(access_token,
+                                                     all_files=True)
+            return project, member_data, plan_member_download(
+                member_data, directory, source=source,
+                project_data=project_data, id_filename=id_filename,
+                manifest_records=manifest_records,
+                created_after=created_after)
+
+        if dry_run:
+            plan = add_download_sizes(make_plan()[2], max_size=max_size)
+            print(plan.format())
+            return plan
+        limiter = None
+        if max_concurrency:
+            limiter = AdaptiveLimiter(max_limit=max_concurrency)
+        with WorkQueue(queue) as work_queue:
+            def seed():
+                project, member_data, plan = make_plan()
+                enqueue_plan(work_queue, plan)
+                if since or since_last_run:
+                    work_queue.set_meta('latest_created',
+                                        latest_created(project, member_data))
+
+            # Only one worker plans the download; the others wait for it.
+            work_queue.seed(seed)
+            completed = run_queue(work_queue, max_size=max_size,
+                                  sha256=sha256, manifest=manifest,
+                                  limiter=limiter)
+            counts = work_queue.counts()
+            latest = work_queue.get_meta('latest_created')
+        if limiter is not None:
+            _log_limiter_metrics(limiter)
+        logging.info('Completed {} queued downloads. Queue: {}'.format(
+            completed, ', '.join('{} {}'.format(count, state) for
+                                 state, count in sorted(counts.items()))))
+        # Only the last worker to finish records the high-water mark, and
+        # only if nothing failed.
+        finished = counts['done'] == sum(counts.values())
+    elif master_token:
+        project = OHProject(master_access_token=master_token,
+                            lazy=bool(member))
         if member:
             if project_data:
-                project.download_member_project_data(
+                failures = project.download_member_project_data(
                     member_data=project.project_data[member],
                     target_member_dir=directory,
                     max_size=max_size,
-                    id_filename=id_filename)
+                    id_filename=id_filename,
+                    sha256=sha256, manifest=manifest,
+                    created_after=created_after)
             else:
-                project.download_member_shared(
+                failures = project.download_member_shared(
                     member_data=project.project_data[member],
                     target_member_dir=directory,
                     source=source,
                     max_size=max_size,
-                    id_filename=id_filename)
+                    id_filename=id_filename,
+                    sha256=sha256, manifest=manifest,
+                    created_after=created_after)
         else:
-            project.download_all(target_dir=directory,
-                                 source=source,
-                                 max_size=max_size,
-                                 memberlist=memberlist,
-                                 excludelist=excludelist,
-                                 project_data=project_data,
-                                 id_filename=id_filename)
+            with open_sink(directory) as sink:
+                failures = project.download_all(
+                    target_dir='' if archive else directory,
+                    source=source,
+                    max_size=max_size,
+                    memberlist=memberlist,
+                    excludelist=excludelist,
+                    project_data=project_data,
+                    id_filename=id_filename,
+                    sha256=sha256,
+                    manifest=manifest,
+                    created_after=created_after,
+                    shard=shard,
+                    sink=sink if archive else None)
+        finished = not failures
     else:
         member_data = exchange_oauth2_member(access_token, all_files=True)
         if project_data:
-            OHProject.download_member_project_data(member_data=member_data,
-                                                   target_member_dir=directory,
-                                                   max_size=max_size,
-                                                   id_filename=id_filename)
+            failures = OHProject.download_member_project_data(
+                member_data=member_data,
+                target_member_dir=directory,
+                max_size=max_size,
+                id_filename=id_filename,
+                sha256=sha256,
+                manifest=manifest,
+                created_after=created_after)
         else:
-            OHProject.download_member_shared(member_data=member_data,
-                                             target_member_dir=directory,
-                                             source=source,
-                                             max_size=max_size,
-                                             id_filename=id_filename)
+            failures = OHProject.download_member_shared(
+                member_data=member_data,
+                target_member_dir=directory,
+                source=source,
+                max_size=max_size,
+                id_filename=id_filename,
+                sha256=sha256,
+                manifest=manifest,
+                created_after=created_after)
+        finished = not failures
+
+    if (since or since_last_run) and finished:
+        if not queue:
+            latest = latest_created(project, member_data)
+        if latest is not None and (created_after is None or
+                                   latest > created_after):
+            write_download_state(state_file,
+                                 {'since': format_created(latest)})
+            logging.info('Recorded high-water mark {} in {}'.format(
+                format_created(latest), state_file))
+    elif since or since_last_run:
+        logging.warning('Not recording a high-water mark in {}, as some '
+                        'downloads failed or are unfinished.'.format(
+                            state_file))
 
 
 @click.command()
@@ -163,22 +409,32 @@ def download(directory, master_token=None, member=None, access_token=None,
               required=True)
 @click.option('-v', '--verbose', help='Show INFO level logging', is_flag=True)
 @click.option('--debug', help='Show DEBUG level logging.', is_flag=True)
-@click.option('--output-csv', help="Output project metedata CSV",
+@click.option('--output-csv', help="Output project metedata CSV (JSON Lines "
+              "if it ends in .jsonl, compressed if it ends in .gz or .bz2)",
               required=True)
+@click.option('--max-workers', help='Maximum concurrent API requests.',
+              default=4, show_default=True, type=int)
 def download_metadata_cli(master_token, output_csv, verbose=False,
-                          debug=False):
+                          debug=False, max_workers=4):
     """
     Command line function for downloading metadata.
     For more information visit
     :func:`download_metadata<ohapi.command_line.download_metadata>`.
     """
-    return download_metadata(master_token, output_csv, verbose, debug)
+    return download_metadata(master_token, output_csv, verbose, debug,
+                             max_workers)
 
 
-def download_metadata(master_token, output_csv, verbose=False, debug=False):
+def download_metadata(master_token, output_csv, verbose=False, debug=False,
+                      max_workers=4):
     """
     Output CSV with metadata for a project's downloadable files in Open Humans.
 
+    Rows are written as pages of project members arrive, so memory use
+    doesn't grow with the size of the project. If output_csv ends in
+    ".jsonl" or ".ndjson" a JSON Lines file is written instead, and if it
+    ends in ".gz" or ".bz2" it's compressed.
+
     :param master_token: This field is the master access token for the project.
     :param output_csv: This field is the target csv file to which metadata is
         written.
@@ -186,56 +442,86 @@ def download_metadata(master_token, output_csv, verbose=False, debug=False):
         is False.
     :param debug: This boolean field is the logging level. It's default value
         is False.
+    :param max_workers: This field is the maximum number of concurrent API
+        requests. It's default value is 4.
     """
     set_log_level(debug, verbose)
 
-    project = OHProject(master_access_token=master_token)
-
-    with open(output_csv, 'w') as f:
-        csv_writer = csv.writer(f)
-        header = ['project_member_id', 'data_source', 'file_basename',
-                  'file_upload_date']
-        csv_writer.writerow(header)
-        for member_id in project.project_data:
-            if not project.project_data[member_id]['data']:
-                csv_writer.writerow([member_id, 'NA', 'None', 'NA'])
-            else:
-                for data_item in project.project_data[member_id]['data']:
-                    logging.debug(data_item)
-                    csv_writer.writerow([
-                        member_id, data_item['source'],
-                        data_item['basename'].encode('utf-8'),
-                        data_item['created']])
+    header = ['project_member_id', 'data_source', 'file_basename',
+              'file_upload_date']
+    jsonl = is_jsonl_path(output_csv)
+    with open_output_file(output_csv) as f:
+        if jsonl:
+            def writerow(row):
+                f.write(json.dumps(OrderedDict(zip(header, row))) + '\n')
+        else:
+            writerow = csv.writer(f).writerow
+            writerow(header)
+        for member_data in iter_member_data(master_token,
+                                            max_workers=max_workers):
+            member_id = member_data['project_member_id']
+            if not member_data['data']:
+                if jsonl:
+                    writerow([member_id, None, None, None])
+                else:
+                    writerow([member_id, 'NA', 'None', 'NA'])
+                continue
+            for data_item in member_data['data']:
+                logging.debug(data_item)
+                writerow([member_id, data_item['source'],
+                          data_item['basename'], data_item['created']])
 
 
 @click.command()
-@click.option('-d', '--directory', help='Target directory', required=True)
-@click.option('--create-csv', help='Create draft CSV metadata', required=False)
+@click.option('-d', '--directory', help='Target directory (or tar or zip '
+              'archive)', required=True)
+@click.option('--create-csv', help='Create draft CSV metadata (JSON Lines '
+              'if the path ends in .jsonl or .ndjson).', required=False)
 @click.option('--review', help='Review existing metadata file', required=False)
 @click.option('--max-size', help='Maximum file size to consider.',
               default='128m', show_default=True)
+@click.option('--processes', type=int, default=1, show_default=True,
+              help='Processes used to hash files (0 for one per CPU core).')
+@click.option('--buffer-size', help='Read size used when hashing files.',
+              default='1 MiB', show_default=True)
+@click.option('--mmap-size', help='Memory map files of at least this size '
+              'when hashing them.')
+@click.option('--hash-cache', help='SQLite file caching hashes of unchanged '
+              'files between runs.')
 @click.option('-v', '--verbose', help='Show INFO level logging', is_flag=True)
 @click.option('--debug', help='Show DEBUG level logging.', is_flag=True)
 def upload_metadata_cli(directory, create_csv='', review='',
-                        max_size='128m', verbose=False, debug=False):
+                        max_size='128m', verbose=False, debug=False,
+                        processes=1, buffer_size='1 MiB', mmap_size=None,
+                        hash_cache=None):
     """
     Command line function for drafting or reviewing metadata files.
     For more information visit
     :func:`upload_metadata<ohapi.command_line.upload_metadata>`.
     """
     return upload_metadata(directory, create_csv, review,
-                           max_size, verbose, debug)
+                           max_size, verbose, debug, processes,
+                           buffer_size, mmap_size, hash_cache)
 
 
 def upload_metadata(directory, create_csv='', review='',
-                    max_size='128m', verbose=False, debug=False):
+                    max_size='128m', verbose=False, debug=False,
+                    processes=1, buffer_size='1 MiB', mmap_size=None,
+                    hash_cache=None):
     """
     Draft or review metadata files for uploading files to Open Humans.
     The target directory should either represent files for a single member (no
     subdirectories), or contain a subdirectory for each project member ID.
 
-    :param directory: This field is the directory for which metadata has to be
-        created.
+    Metadata files ending in ".jsonl" or ".ndjson" are written and reviewed as
+    JSON Lines, with one JSON object per file, instead of CSV.
+
+    Metadata can also be created for a tar or zip archive laid out like the
+    directory. Its files are hashed as they are read from the archive,
+    without extracting it.
+
+    :param directory: This field is the directory (or archive) for which
+        metadata has to be created.
     :param create_csv: This field is the output filepath to which csv file
         will be written.
     :param max_size: This field is the maximum file size. It's default value is
@@ -244,6 +530,14 @@ def upload_metadata(directory, create_csv='', review='',
         is False.
     :param debug: This boolean field is the logging level. It's default value
         is False.
+    :param processes: This field is the number of processes used to hash
+        files, or 0 for one per CPU core. It's default value is 1.
+    :param buffer_size: This field is the read size used when hashing files.
+        It's default value is 1 MiB.
+    :param mmap_size: If provided, files of at least this size are memory
+        mapped when hashing them. It's default value is None.
+    :param hash_cache: If provided, this SQLite file caches hashes so that
+        only new or modified files are hashed. It's default value is None.
     """
     set_log_level(debug, verbose)
 
@@ -252,10 +546,18 @@ def upload_metadata(directory, create_csv='', review='',
         raise ValueError("Either create_csv must be true or review must be " +
                          "true but not both")
     if review:
+        if is_archive(directory):
+            raise UsageError('Metadata for an archive can be created, but not '
+                             'reviewed.')
         if review_metadata_csv(directory, review):
             print("The metadata file has been reviewed and is valid.")
     elif create_csv:
-        mk_metadata_csv(directory, create_csv, max_bytes=max_bytes)
+        mk_metadata_csv(directory, create_csv, max_bytes=max_bytes,
+                        processes=processes,
+                        buffer_size=parse_size(buffer_size),
+                        mmap_threshold=(parse_size(mmap_size) if mmap_size
+                                        else None),
+                        hash_cache=hash_cache)
     else:
         raise ValueError("Either create_csv must be true or review must be " +
                          "true but not both should be false")
@@ -263,9 +565,10 @@ def upload_metadata(directory, create_csv='', review='',
 
 @click.command()
 @click.option('-d', '--directory',
-              help='Target directory for downloaded files.', required=True)
-@click.option('--metadata-csv', help='CSV file containing file metadata.',
-              required=True)
+              help='Target directory (or .tar, .tar.gz, .tar.bz2 or .zip '
+              'archive) of files to upload.', required=True)
+@click.option('--metadata-csv', help='CSV (or .jsonl) file containing file '
+              'metadata. If omitted, metadata is drafted while uploading.')
 @click.option('-T', '--master-token', help='Project master access token.')
 @click.option('-m', '--member', help='Project member ID.')
 @click.option('-t', '--access-token', help='OAuth2 user access token.')
@@ -275,13 +578,25 @@ def upload_metadata(directory, create_csv='', review='',
               is_flag=True)
 @click.option('--max-size', help='Maximum file size to download.',
               default='128m', show_default=True)
+@click.option('--compress', type=click.Choice(['gzip', 'bz2']),
+              help='Compress files while uploading them.')
+@click.option('--dry-run', is_flag=True,
+              help='Print the files that would be uploaded or deleted, '
+              'without uploading or deleting them.')
+@click.option('--shard', help='Only process the Kth of N disjoint shards of '
+              'project members, given as K/N (e.g. 2/4).')
+@click.option('--max-concurrency', type=int,
+              help='Upload up to this many files at once, adapting the '
+              'number between 1 and this limit and backing off when '
+              'requests are throttled or time out.')
 @click.option('-v', '--verbose', help='Report INFO level logging to stdout',
               is_flag=True)
 @click.option('--debug', help='Report DEBUG level logging to stdout.',
               is_flag=True)
-def upload_cli(directory, metadata_csv, master_token=None, member=None,
+def upload_cli(directory, metadata_csv=None, master_token=None, member=None,
                access_token=None, safe=False, sync=False, max_size='128m',
-               mode='default', verbose=False, debug=False):
+               mode='default', verbose=False, debug=False, compress=None,
+               dry_run=False, shard=None, max_concurrency=None):
     """
     Command line function for uploading files to OH.
     For more information visit
@@ -289,12 +604,14 @@ def upload_cli(directory, metadata_csv, master_token=None, member=None,
     """
     return upload(directory, metadata_csv, master_token, member,
                   access_token, safe, sync, max_size,
-                  mode, verbose, debug)
+                  mode, verbose, debug, compress, dry_run, shard,
+                  max_concurrency)
 
 
-def upload(directory, metadata_csv, master_token=None, member=None,
+def upload(directory, metadata_csv=None, master_token=None, member=None,
            access_token=None, safe=False, sync=False, max_size='128m',
-           mode='default', verbose=False, debug=False):
+           mode='default', verbose=False, debug=False, compress=None,
+           dry_run=False, shard=None, max_concurrency=None):
     """
     Upload files for the project to Open Humans member accounts.
 
@@ -331,9 +648,32 @@ def upload(directory, metadata_csv, master_token=None, member=None,
     Other metedata fields (e.g. 'description') can be arbitrary strings.
     Either specify sync as True or safe as True but not both.
 
+    The metadata may instead be a JSON Lines file (ending in ".jsonl" or
+    ".ndjson"), with one JSON object per file holding its "project_member_id"
+    (for multiple users), "filename" and metadata fields.
+
+    Multi-user metadata is indexed (saved as "<metadata_csv>.idx") and each
+    member's rows are only loaded when their subdirectory is uploaded.
+
+    Without a metadata file, files are uploaded without a separate pass to
+    describe them: tags are guessed from filenames, creation dates are taken
+    from the files, and each file's md5 is computed while it is read for
+    upload. As the md5 is sent before the upload, files over 32m are read
+    twice, once to hash them and once to upload them.
+
+    directory may instead be a tar or zip archive, laid out in the same way.
+    Each file is streamed from the archive into its upload, without
+    extracting the archive. A tar archive is read in a single pass, so each
+    member's files must be together in it.
+
+    Uploads for many members can be split between hosts with shard: each
+    member subdirectory is assigned to one of N shards by a stable hash of
+    its project member ID, and only the given shard is uploaded.
+
     :param directory: This field is the target directory from which data will
         be uploaded.
     :param metadata_csv: This field is the filepath of the metadata csv file.
+        It's default value is None.
     :param master_token: This field is the master access token for the project.
         It's default value is None.
     :param member: This field is specific member whose project data is
@@ -352,6 +692,19 @@ def upload(directory, metadata_csv, master_token=None, member=None,
         is False.
     :param debug: This boolean field is the logging level. It's default value
         is False.
+    :param compress: If 'gzip' or 'bz2', files are compressed while they are
+        uploaded and the matching suffix is added to their names. It's
+        default value is None.
+    :param dry_run: If True, the upload plan (see
+        :func:`plan_upload<ohapi.sync.plan_upload>`) is printed and returned,
+        and nothing is uploaded or deleted. It's default value is False.
+    :param shard: If provided, only member subdirectories in this shard,
+        given as "K/N", are uploaded. It's default value is None.
+    :param max_concurrency: If provided, the upload is planned (see
+        :func:`plan_upload<ohapi.sync.plan_upload>`) and its files are
+        uploaded concurrently, adapting between 1 and this many at once
+        (see :class:`AdaptiveLimiter<ohapi.api.AdaptiveLimiter>`). It's
+        default value is None, for one file at a time.
     """
     if safe and sync:
         raise UsageError('Safe (--safe) and sync (--sync) modes are mutually '
@@ -360,6 +713,12 @@ def upload(directory, metadata_csv, master_token=None, member=None,
         raise UsageError('Please specify either a master access token (-T), '
                          'or an OAuth2 user access token (-t).')
 
+    if shard:
+        try:
+            shard = parse_shard(shard)
+        except ValueError as e:
+            raise UsageError(str(e))
+
     set_log_level(debug, verbose)
 
     if sync:
@@ -367,7 +726,18 @@ def upload(directory, metadata_csv, master_token=None, member=None,
     elif safe:
         mode = 'safe'
 
-    metadata = load_metadata_csv(metadata_csv)
+    metadata = None
+    if metadata_csv:
+        metadata = load_metadata_csv(metadata_csv, lazy=True)
+
+    if max_concurrency is not None and max_concurrency < 1:
+        raise UsageError('--max-concurrency should be at least 1.')
+    if is_archive(directory):
+        if dry_run or max_concurrency:
+            raise UsageError('Dry runs and concurrent uploads are not '
+                             'supported when uploading from an archive.')
+        return _upload_archive(directory, metadata, master_token, member,
+                               access_token, mode, max_size, compress, shard)
 
     subdirs = [i for i in os.listdir(directory) if
                os.path.isdir(os.path.join(directory, i))]
@@ -378,37 +748,120 @@ def upload(directory, metadata_csv, master_token=None, member=None,
         if (master_token and member) or not master_token:
             raise UsageError(
                 "Subdirs shouldn't exist if uploading for specific member!")
-        project = OHProject(master_access_token=master_token)
-        for member_id in subdirs:
-            subdir_path = os.path.join(directory, member_id)
-            project.upload_member_from_dir(
-                member_data=project.project_data[member_id],
-                target_member_dir=subdir_path,
-                metadata=metadata[member_id],
-                mode=mode,
-                access_token=project.master_access_token,
-            )
+        # Member data and metadata are loaded as each member is reached.
+        uploads = _iter_subdir_uploads(directory, subdirs, metadata,
+                                       master_token, shard)
+        access_token = master_token
     else:
+        if shard:
+            raise UsageError('Shards are only used when uploading for '
+                             'multiple members!')
         if master_token and not (master_token and member):
             raise UsageError('No member specified!')
         if master_token:
-            project = OHProject(master_access_token=master_token)
-            project.upload_member_from_dir(
-                member_data=project.project_data[member],
-                target_member_dir=directory,
-                metadata=metadata,
-                mode=mode,
-                access_token=project.master_access_token,
-            )
+            project = OHProject(master_access_token=master_token, lazy=True)
+            member_data = project.project_data[member]
+            access_token = master_token
         else:
             member_data = exchange_oauth2_member(access_token)
-            OHProject.upload_member_from_dir(
-                member_data=member_data,
-                target_member_dir=directory,
-                metadata=metadata,
-                mode=mode,
-                access_token=access_token,
-            )
+        uploads = [(member_data, directory, metadata)]
+
+    if dry_run or max_concurrency:
+        plan = SyncPlan()
+        for member_data, member_dir, member_metadata in uploads:
+            plan.extend(plan_upload(member_data, member_dir, member_metadata,
+                                    mode=mode, max_size=max_size,
+                                    compress=compress))
+        if dry_run:
+            print(plan.format())
+            return plan
+        limiter = AdaptiveLimiter(max_limit=max_concurrency)
+        execute_plan(plan, access_token=access_token, limiter=limiter)
+        _log_limiter_metrics(limiter)
+        return plan
+    for member_data, member_dir, member_metadata in uploads:
+        OHProject.upload_member_from_dir(
+            member_data=member_data,
+            target_member_dir=member_dir,
+            metadata=member_metadata,
+            mode=mode,
+            access_token=access_token,
+            compress=compress,
+        )
+
+
+def _iter_subdir_uploads(directory, subdirs, metadata, master_token, shard):
+    """
+    Helper function for :func:`upload<ohapi.command_line.upload>`, yielding
+    (member data, member directory, member metadata) for each member
+    subdirectory. Member data comes from the paged list of project members,
+    rather than a request for each member.
+    """
+    remaining = set(select_members(subdirs, shard=shard))
+    for member_data in iter_member_data(master_token):
+        member_id = member_data['project_member_id']
+        if member_id not in remaining:
+            continue
+        remaining.discard(member_id)
+        yield (compact_member_data(member_data),
+               os.path.join(directory, member_id),
+               metadata[member_id] if metadata is not None else None)
+    if remaining:
+        raise UsageError('Subdirs for members not in the project: {}'.format(
+            ', '.join(sorted(remaining))))
+
+
+def _log_limiter_metrics(limiter):
+    logging.info('Concurrency: {}'.format(', '.join(
+        '{} {}'.format(name, value) for name, value in
+        sorted(limiter.metrics().items()))))
+
+
+def _upload_archive(archive, metadata, master_token, member, access_token,
+                    mode, max_size, compress, shard):
+    """
+    Helper function for :func:`upload<ohapi.command_line.upload>`, uploading
+    files straight from a tar or zip archive's entries.
+    """
+    project = None
+    if master_token:
+        project = OHProject(master_access_token=master_token, lazy=True)
+    uploaded_members = set()
+    files = iter_archive_files(archive, max_bytes=parse_size(max_size))
+    for project_member_id, entries in groupby(files, key=lambda f: f[0]):
+        if project_member_id is None:
+            if master_token and not member:
+                raise UsageError('No member specified!')
+            if shard:
+                raise UsageError('Shards are only used when uploading for '
+                                 'multiple members!')
+            if master_token:
+                member_data = project.project_data[member]
+            else:
+                member_data = exchange_oauth2_member(access_token)
+            member_metadata = metadata
+        else:
+            if (master_token and member) or not master_token:
+                raise UsageError("Subdirs shouldn't exist if uploading for "
+                                 "specific member!")
+            if project_member_id in uploaded_members:
+                raise UsageError('Archive entries for each member should be '
+                                 'together: {}'.format(project_member_id))
+            uploaded_members.add(project_member_id)
+            if not list(select_members([project_member_id], shard=shard)):
+                continue
+            member_data = project.project_data[project_member_id]
+            member_metadata = (metadata[project_member_id] if metadata is
+                               not None else None)
+        OHProject.upload_member_files(
+            member_data=member_data,
+            files=((filename, mtime, fileobj) for
+                   _, filename, _, mtime, fileobj in entries if
+                   filename is not None),
+            metadata=member_metadata,
+            access_token=master_token or access_token,
+            mode=mode,
+            compress=compress)
 
 
 @click.command()
@@ -435,6 +888,7 @@ def oauth_token_exchange_cli(client_id, client_secret, redirect_uri,
     print(oauth2_token_exchange(client_id, client_secret, redirect_uri,
                                 base_url, code, refresh_token))
 
+
 @click.command()
 @click.option('-r', '--redirect_uri',
               help='Redirect URL for project')
@@ -482,19 +936,38 @@ def message_cli(subject, message_body, access_token, all_members=False,
 
 @click.command()
 @click.option('-T', '--access_token', help='Access token', required=True)
-@click.option('-m', '--project_member_id', help='Project Member ID',
-              required=True)
+@click.option('-m', '--project_member_id', help='Project Member ID')
 @click.option('-b', '--file_basename', help='File basename')
 @click.option('-i', '--file_id', help='File ID')
 @click.option('--all_files', help='Delete all files',
               default=False, show_default=True)
-def delete_cli(access_token, project_member_id, base_url=OH_BASE_URL,
-               file_basename=None, file_id=None, all_files=False):
+@click.option('--targets-csv', help='CSV file of files to delete, with '
+              'project_member_id and file_basename or file_id columns')
+@click.option('--max-workers', help='Maximum concurrent delete requests.',
+              default=4, show_default=True, type=int)
+def delete_cli(access_token, project_member_id=None, base_url=OH_BASE_URL,
+               file_basename=None, file_id=None, all_files=False,
+               targets_csv=None, max_workers=4):
     """
     Command line function for deleting files.
     For more information visit
-    :func:`delete_file<ohapi.api.delete_file>`.
+    :func:`delete_file<ohapi.api.delete_file>` and
+    :func:`delete_files_bulk<ohapi.api.delete_files_bulk>`.
     """
+    if targets_csv:
+        if project_member_id or file_basename or file_id or all_files:
+            raise UsageError('Please do not provide a project member ID or '
+                             'file when deleting files from a targets CSV.')
+        responses = delete_files_bulk(access_token,
+                                      read_delete_targets(targets_csv),
+                                      base_url=base_url,
+                                      max_workers=max_workers)
+        print("Files deleted successfully with {} requests".format(
+            len(responses)))
+        return
+    if not project_member_id:
+        raise UsageError('Please specify a project member ID (-m) or a '
+                         'targets CSV (--targets-csv).')
     response = delete_file(access_token, project_member_id,
                            base_url, file_basename, file_id, all_files)
     if (response.status_code == 200):
@@ -506,8 +979,8 @@ def delete_cli(access_token, project_member_id, base_url=OH_BASE_URL,
 @click.command()
 @click.option('-s', '--source', help='the source to download files from')
 @click.option('-u', '--username', help='the user to download files from')
-@click.option('-d', '--directory', help='the directory for downloaded files',
-              default='.')
+@click.option('-d', '--directory', help='the directory (or .tar, .tar.gz, '
+              '.tar.bz2 or .zip archive) for downloaded files', default='.')
 @click.option('-m', '--max-size', help='the maximum file size to download',
               default='128m')
 @click.option('-q', '--quiet', help='Report ERROR level logging to stdout',
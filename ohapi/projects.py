@@ -2,83 +2,791 @@
 Utility functions to use master_access_tokens to interact with a project
 """
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from bisect import bisect_right
+from collections import deque
+import concurrent.futures
+import datetime
+from fnmatch import fnmatchcase
+import hashlib
+import json
 import logging
 import os
+import re
+import sys
 
 import arrow
 from humanfriendly import parse_size
 
-from .api import delete_file, get_all_results, get_page, upload_aws
-from .utils_fs import download_file, validate_metadata
+from .api import (MAX_WORKERS_DEFAULT, _run_concurrently, compressed_filename,
+                  delete_files_bulk, exchange_oauth2_member, get_page,
+                  iter_pages, upload_aws, upload_stream)
+from .utils_fs import (MD5_RE, DirectorySink, describe_local_files,
+                       download_file, draft_file_metadata, validate_metadata)
 
 MAX_SIZE_DEFAULT = '128m'
 
 
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MISSING = object()
+
+
+# The API's own timestamps, e.g. "2018-01-31T21:49:38.478718Z".
+API_CREATED_RE = re.compile(
+    r'^([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})'
+    r'(?:\.([0-9]{1,6}))?(?:Z|\+00:00)$')
+
+
+def parse_created(created):
+    """
+    Parse an API timestamp to integer microseconds since the Unix epoch, or
+    None if it can't be parsed.
+
+    Timestamps in the API's own UTC format are parsed directly, as arrow is
+    much slower, and anything else falls back to arrow.
+
+    :param created: This field is the timestamp, e.g. a file's "created".
+    """
+    match = API_CREATED_RE.match(created) if isinstance(created, str) else None
+    if match:
+        fields = [int(field) for field in match.groups()[:6]]
+        microsecond = int((match.group(7) or '').ljust(6, '0'))
+        try:
+            created_at = datetime.datetime(*fields, microsecond=microsecond,
+                                           tzinfo=datetime.timezone.utc)
+        except ValueError:
+            # Out of range fields, e.g. an hour of 24, are left to arrow.
+            pass
+        else:
+            return (created_at - EPOCH) // datetime.timedelta(microseconds=1)
+    try:
+        created_at = arrow.get(created).datetime
+    except Exception:
+        return None
+    return (created_at - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def format_created(created_ts):
+    """
+    Format integer microseconds since the Unix epoch (see
+    :func:`parse_created<ohapi.projects.parse_created>`) as an ISO 8601
+    timestamp.
+
+    :param created_ts: This field is the timestamp in microseconds.
+    """
+    return (EPOCH + datetime.timedelta(microseconds=created_ts)).isoformat()
+
+
+def _created_after_ts(created_after):
+    if created_after is None or isinstance(created_after, int):
+        return created_after
+    created_ts = parse_created(created_after)
+    if created_ts is None:
+        raise ValueError('Unable to parse created_after')
+    return created_ts
+
+
+def _format_api_created(created_ts):
+    """
+    Format a created time as the API does, e.g. "2018-01-31T21:49:38.478718Z".
+    """
+    created = format_created(created_ts)
+    if created.endswith('+00:00'):
+        created = created[:-6] + 'Z'
+    return created
+
+
+class FileRecord(Mapping):
+    """
+    A compact, read-only record of a file from the Open Humans API.
+
+    Records behave like the API's file dicts (e.g. record['basename'] and
+    record.get('metadata')), but store the common fields in slots rather
+    than a per-file dict. Sources and basenames are interned, and the
+    "created" timestamp is parsed once, when the record is made, to
+    created_ts (integer microseconds since the Unix epoch, see
+    :func:`parse_created<ohapi.projects.parse_created>`), from which the
+    "created" string is formatted when it's read. Other fields, e.g.
+    "metadata", are kept as a compact JSON string and decoded when they're
+    read, so each read returns a new copy. Use to_dict for a plain dict.
+    """
+    FIELDS = ('id', 'basename', 'created', 'download_url', 'source')
+    __slots__ = ('id', 'basename', 'created_ts', 'download_url', 'source',
+                 '_extra')
+
+    def __init__(self, file_data):
+        extra = {}
+        for key, value in file_data.items():
+            if key in ('basename', 'source') and isinstance(value, str):
+                value = sys.intern(value)
+            if key in self.FIELDS and key != 'created':
+                object.__setattr__(self, key, value)
+            elif key != 'created':
+                extra[key] = value
+        for key in self.FIELDS:
+            if key not in file_data and key != 'created':
+                object.__setattr__(self, key, _MISSING)
+        created = file_data.get('created', _MISSING)
+        created_ts = None if created is _MISSING else parse_created(created)
+        # The string is only kept if it can't be formatted from created_ts.
+        if created is not _MISSING and (
+                created_ts is None or
+                _format_api_created(created_ts) != created):
+            extra['created'] = created
+        object.__setattr__(self, 'created_ts', created_ts)
+        # Files often share their metadata, so the JSON is interned.
+        object.__setattr__(self, '_extra', sys.intern(json.dumps(
+            extra, separators=(',', ':'))) if extra else None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FileRecord is read-only')
+
+    __delattr__ = __setattr__
+
+    def _extra_dict(self):
+        return json.loads(self._extra) if self._extra is not None else {}
+
+    def __getitem__(self, key):
+        if key in self.FIELDS and key != 'created':
+            value = getattr(self, key)
+            if value is not _MISSING:
+                return value
+            raise KeyError(key)
+        extra = self._extra_dict()
+        if key == 'created' and key not in extra:
+            if self.created_ts is None:
+                raise KeyError(key)
+            return _format_api_created(self.created_ts)
+        return extra[key]
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+    def __eq__(self, other):
+        if isinstance(other, FileRecord):
+            other = other.to_dict()
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return self.to_dict() == dict(other.items())
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FileRecord({!r})'.format(self.to_dict())
+
+    def __reduce__(self):
+        return (FileRecord, (self.to_dict(),))
+
+    def to_dict(self):
+        """
+        Return the record as a plain dict, as returned by the API.
+        """
+        file_data = {}
+        for key in self.FIELDS:
+            if key == 'created':
+                if self.created_ts is not None:
+                    file_data[key] = _format_api_created(self.created_ts)
+            elif getattr(self, key) is not _MISSING:
+                file_data[key] = getattr(self, key)
+        file_data.update(self._extra_dict())
+        return file_data
+
+
+class MemberData(dict):
+    """
+    Data for a project member, as returned by the API, which also caches
+    the member's latest file for each basename (see
+    :func:`_get_member_file_data<ohapi.projects.OHProject._get_member_file_data>`).
+    The cache is cleared when the member's "data" is replaced.
+
+    Its items() give :class:`FileRecord<ohapi.projects.FileRecord>` objects
+    as plain dicts, so member data (and a project's project_data) can be
+    serialized with json, which uses items() for dict subclasses.
+    """
+    __slots__ = ('file_data_cache',)
+
+    def __init__(self, *args, **kwargs):
+        super(MemberData, self).__init__(*args, **kwargs)
+        self.file_data_cache = {}
+
+    def __setitem__(self, key, value):
+        if key == 'data':
+            self.file_data_cache.clear()
+        super(MemberData, self).__setitem__(key, value)
+
+    def items(self):
+        return [(key, [f.to_dict() if isinstance(f, FileRecord) else f for
+                       f in value] if key == 'data' else value) for
+                key, value in super(MemberData, self).items()]
+
+
+def compact_member_data(member_data):
+    """
+    Return member data as a :class:`MemberData<ohapi.projects.MemberData>`,
+    with its file dicts replaced by
+    :class:`FileRecord<ohapi.projects.FileRecord>` objects.
+
+    :param member_data: This field is data related to member in a project.
+    """
+    member_data = MemberData(member_data)
+    member_data['data'] = [
+        f if isinstance(f, FileRecord) else FileRecord(f) for f in
+        member_data['data']]
+    if 'sources_shared' in member_data:
+        member_data['sources_shared'] = [
+            sys.intern(source) for source in member_data['sources_shared']]
+    return member_data
+
+
+def _created_ts(datafile):
+    # Records are parsed once, when they're made.
+    if isinstance(datafile, FileRecord):
+        return datafile.created_ts
+    return parse_created(datafile.get('created'))
+
+
+def max_created(datafiles):
+    """
+    Return the latest created time of some files, in microseconds since the
+    Unix epoch, or None if none of them have a created time.
+
+    :param datafiles: This field is an iterable of file dicts or
+        :class:`FileRecord<ohapi.projects.FileRecord>` objects.
+    """
+    latest = None
+    for datafile in datafiles:
+        created_ts = _created_ts(datafile)
+        if created_ts is not None and (latest is None or created_ts > latest):
+            latest = created_ts
+    return latest
+
+
+def _download_files(downloads, limiter=None):
+    """
+    Helper function to download files with :func:`download_file
+    <ohapi.utils_fs.download_file>`, given its keyword arguments for each
+    file. A file that fails (e.g. an MD5 mismatch) is logged and skipped, and
+    its partial download discarded by the sink, so the other files are still
+    downloaded. Returns a list of (target filepath, exception) pairs for the
+    files that failed.
+
+    :param downloads: This field is an iterable of dicts of keyword
+        arguments, one for each file.
+    :param limiter: If provided, this field is an :class:`AdaptiveLimiter
+        <ohapi.api.AdaptiveLimiter>`, and files are downloaded concurrently.
+        It's default value is None, for one download at a time.
+    """
+    def run(**kwargs):
+        try:
+            if limiter is None:
+                download_file(**kwargs)
+            else:
+                # The slot sees the error before it's caught here.
+                with limiter.slot():
+                    download_file(**kwargs)
+        except Exception as e:
+            sink = kwargs.get('sink')
+            if sink is not None and sink.error is not None:
+                # An archive with a partly written file can't be added to.
+                raise
+            logging.error('Failed download of {}: {}'.format(
+                kwargs['target_filepath'], e))
+            return (kwargs['target_filepath'], e)
+        return None
+
+    if limiter is None:
+        results = [run(**kwargs) for kwargs in downloads]
+    else:
+        results = _run_concurrently(run, list(downloads),
+                                    max_workers=limiter.max_limit)
+    return [result for result in results if result is not None]
+
+
+def _log_download_failures(failures):
+    if failures:
+        logging.error('{} downloads failed: {}'.format(
+            len(failures), ', '.join(path for path, _ in failures)))
+
+
+def _is_shared(member_data, datafile):
+    return datafile.get('source') in member_data['sources_shared']
+
+
+class FileIndex(object):
+    """
+    Secondary indexes over a project's files, by source, by basename and by
+    created time, for selecting files without scanning every member.
+
+    Files are indexed as (project_member_id, datafile) pairs. Files whose
+    created time can't be parsed are left out of the created time index.
+    """
+    def __init__(self, project_data):
+        self.by_source = {}
+        self.by_basename = {}
+        created = []
+        for member_id, member_data in project_data.items():
+            for datafile in member_data['data']:
+                item = (member_id, datafile)
+                self.by_source.setdefault(
+                    datafile.get('source'), []).append(item)
+                self.by_basename.setdefault(
+                    datafile.get('basename'), []).append(item)
+                created_ts = _created_ts(datafile)
+                if created_ts is not None:
+                    created.append((created_ts, item))
+        created.sort(key=lambda entry: entry[0])
+        self.created_ts = [entry[0] for entry in created]
+        self.by_created = [entry[1] for entry in created]
+
+    def source(self, source):
+        return self.by_source.get(source, [])
+
+    def basename_glob(self, basename_glob):
+        if not re.search(r'[*?[]', basename_glob):
+            return self.by_basename.get(basename_glob, [])
+        items = []
+        for basename in self.by_basename:
+            if basename is not None and fnmatchcase(basename, basename_glob):
+                items += self.by_basename[basename]
+        return items
+
+    def created_after(self, created_after):
+        start = bisect_right(self.created_ts, created_after)
+        return self.by_created[start:]
+
+
+def parse_shard(shard):
+    """
+    Parse a shard given as "K/N" (the Kth of N shards, counting from 1) and
+    return (K, N). A (K, N) tuple is returned unchanged after checking it.
+
+    :param shard: This field is the shard, e.g. "2/4".
+    """
+    if isinstance(shard, str):
+        match = re.match(r'^\s*([0-9]+)\s*/\s*([0-9]+)\s*$', shard)
+        if not match:
+            raise ValueError('Shard should be given as K/N, e.g. "2/4": '
+                             '{}'.format(shard))
+        shard = (int(match.group(1)), int(match.group(2)))
+    shard_index, shard_count = shard
+    if not 1 <= shard_index <= shard_count:
+        raise ValueError('Shard K/N needs 1 <= K <= N: {}/{}'.format(
+            shard_index, shard_count))
+    return shard_index, shard_count
+
+
+def member_shard(project_member_id, shard_count):
+    """
+    Return the shard (counting from 1) of a project member ID when a project
+    is split into shard_count shards.
+
+    Members are assigned by an MD5 hash of their ID rather than Python's
+    hash(), so every host assigns each member to the same shard, and the
+    shards are disjoint.
+
+    :param project_member_id: This field is the project member ID.
+    :param shard_count: This field is the number of shards.
+    """
+    digest = hashlib.md5(project_member_id.encode('utf-8')).hexdigest()
+    return int(digest, 16) % shard_count + 1
+
+
+def select_members(member_ids, memberlist=None, excludelist=None,
+                   shard=None):
+    """
+    Yield the project member IDs that are in memberlist (if given), not in
+    excludelist, and in shard (if given).
+
+    :param member_ids: This field is an iterable of project member IDs.
+    :param memberlist: This field is a collection of members to select. It's
+        default value is None, for all members.
+    :param excludelist: This field is a collection of members to skip. It's
+        default value is None.
+    :param shard: This field is the shard to select, as "K/N" or (K, N). See
+        :func:`member_shard<ohapi.projects.member_shard>`. It's default value
+        is None, for all shards.
+    """
+    if memberlist is not None:
+        memberlist = frozenset(memberlist)
+    excludelist = frozenset(excludelist or ())
+    if shard is not None:
+        shard_index, shard_count = parse_shard(shard)
+    for member_id in member_ids:
+        if memberlist is not None and member_id not in memberlist:
+            logging.debug('Skipping {}, not in memberlist'.format(member_id))
+            continue
+        if member_id in excludelist:
+            logging.debug('Skipping {}, in excludelist'.format(member_id))
+            continue
+        if (shard is not None and
+                member_shard(member_id, shard_count) != shard_index):
+            logging.debug('Skipping {}, not in shard {}/{}'.format(
+                member_id, shard_index, shard_count))
+            continue
+        yield member_id
+
+
+def _members_url(master_access_token):
+    return ('https://www.openhumans.org/api/direct-sharing/project/'
+            'members/?access_token={}'.format(master_access_token))
+
+
+def _get_all_member_files(exchange_member_url):
+    member_data = get_page(exchange_member_url)
+    final_data = member_data['data']
+    while member_data['next']:
+        member_data = get_page(member_data['next'])
+        final_data = final_data + member_data['data']
+    return final_data
+
+
+def iter_member_data(master_access_token, max_workers=MAX_WORKERS_DEFAULT):
+    """
+    Yield the data of each project member, including all of their files, in
+    the order members are listed by the API.
+
+    Members are yielded as pages of the members list arrive. The next page
+    is fetched while the current one is processed, and the files of members
+    with more files than the list includes are fetched concurrently, so
+    only a bounded number of members are held in memory at once.
+
+    :param master_access_token: This field is the project's master access
+        token.
+    :param max_workers: This field is the maximum number of concurrent
+        requests. It's default value is 4.
+    """
+    window = max_workers * 4
+    pending = deque()
+
+    def finish(result, future):
+        if future is not None:
+            result['data'] = future.result()
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        for page in iter_pages(_members_url(master_access_token),
+                               executor=executor):
+            for result in page['results']:
+                future = None
+                if len(result['data']) < result['file_count']:
+                    future = executor.submit(_get_all_member_files,
+                                             result['exchange_member'])
+                pending.append((result, future))
+                while pending and (len(pending) > window or
+                                   pending[0][1] is None or
+                                   pending[0][1].done()):
+                    yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+
+
+class LazyProjectData(Mapping):
+    """
+    Project member data, keyed by project member ID, fetched on demand.
+
+    A member's data (including all of their files) is fetched the first
+    time it is accessed, with a single exchange-member request. The list of
+    project members is only fetched when needed, e.g. to iterate over the
+    members or check whether a member belongs to the project. Only the IDs
+    from the list are kept, one page at a time, so checking membership or
+    listing keys doesn't hold every member's file data. Like a dict, it
+    raises KeyError for IDs of members not in the project.
+    """
+    def __init__(self, master_access_token):
+        self.master_access_token = master_access_token
+        self._member_data = {}
+        self._member_ids = None
+        self._member_id_set = None
+
+    def _get_member_ids(self):
+        if self._member_ids is None:
+            member_ids = []
+            for page in iter_pages(_members_url(self.master_access_token)):
+                member_ids += [result['project_member_id'] for result in
+                               page['results']]
+            self._member_ids = member_ids
+            self._member_id_set = frozenset(member_ids)
+        return self._member_ids
+
+    def __getitem__(self, project_member_id):
+        if project_member_id not in self._member_data:
+            if (self._member_id_set is not None and
+                    project_member_id not in self._member_id_set):
+                raise KeyError(project_member_id)
+            logging.debug('Loading data for member {}'.format(
+                project_member_id))
+            try:
+                member_data = exchange_oauth2_member(
+                    self.master_access_token,
+                    project_member_id=project_member_id)
+            except Exception:
+                # Only list the members to tell a missing member from
+                # another error.
+                if project_member_id not in self:
+                    raise KeyError(project_member_id)
+                raise
+            self._member_data[project_member_id] = compact_member_data(
+                member_data)
+        return self._member_data[project_member_id]
+
+    def __iter__(self):
+        return iter(self._get_member_ids())
+
+    def __len__(self):
+        return len(self._get_member_ids())
+
+    def __contains__(self, project_member_id):
+        self._get_member_ids()
+        return project_member_id in self._member_id_set
+
+
 class OHProject:
     """
     Work with an Open Humans Project.
+
+    If lazy is True, member data isn't fetched up front. Instead
+    project_data is a
+    :class:`LazyProjectData<ohapi.projects.LazyProjectData>`, which fetches
+    each member's data when it is first accessed, so working with a single
+    member doesn't fetch data for the whole project.
     """
-    def __init__(self, master_access_token):
+    def __init__(self, master_access_token, lazy=False):
         self.master_access_token = master_access_token
+        self.lazy = lazy
         self.project_data = None
+        self.file_index = None
         self.update_data()
 
     @staticmethod
-    def _get_member_file_data(member_data, id_filename=False):
+    def _get_member_file_data(member_data, id_filename=False,
+                              created_after=None):
         """
         Helper function to get file data of member of a project.
 
+        The latest file is kept for each basename. Timestamps are only
+        parsed for duplicate basenames. For
+        :class:`MemberData<ohapi.projects.MemberData>` (as stored by
+        OHProject) the result is cached until the member's data is updated.
+
         :param member_data: This field is data related to member in a project.
+        :param created_after: If provided, only basenames whose latest file
+            was created after this time are returned. This may be anything
+            arrow can parse, or microseconds since the epoch as an int. It's
+            default value is None.
         """
+        created_after = _created_after_ts(created_after)
+        file_data = OHProject._get_latest_file_data(member_data, id_filename)
+        if created_after is None:
+            return file_data
+        return {basename: datafile for basename, datafile in
+                file_data.items() if (_created_ts(datafile) or 0) >
+                created_after}
+
+    @staticmethod
+    def _get_latest_file_data(member_data, id_filename):
+        cache = getattr(member_data, 'file_data_cache', None)
+        if cache is not None and id_filename in cache:
+            return dict(cache[id_filename])
         file_data = {}
+        created = {}
         for datafile in member_data['data']:
             if id_filename:
                 basename = '{}.{}'.format(datafile['id'], datafile['basename'])
             else:
                 basename = datafile['basename']
-            if (basename not in file_data or
-                    arrow.get(datafile['created']) >
-                    arrow.get(file_data[basename]['created'])):
+            if basename not in file_data:
+                file_data[basename] = datafile
+                continue
+            if basename not in created:
+                created[basename] = _created_ts(file_data[basename])
+            datafile_created = _created_ts(datafile)
+            if (datafile_created is not None and
+                    (created[basename] is None or
+                     datafile_created > created[basename])):
                 file_data[basename] = datafile
+                created[basename] = datafile_created
+        if cache is not None:
+            cache[id_filename] = file_data
+            return dict(file_data)
         return file_data
 
+    @staticmethod
+    def _get_remote_md5(datafile):
+        """
+        Helper function to get the MD5 a data file was uploaded with, or None
+        if its metadata doesn't have a valid one.
+
+        :param datafile: This field is the data file from member data.
+        """
+        metadata = datafile.get('metadata') or {}
+        md5 = metadata.get('md5') if isinstance(metadata, dict) else None
+        if isinstance(md5, str) and MD5_RE.match(md5):
+            return md5
+        return None
+
     def update_data(self):
         """
         Returns data for all users including shared data files.
+
+        Files are stored as :class:`FileRecord<ohapi.projects.FileRecord>`
+        objects, which can be used like the API's file dicts.
+
+        The :class:`FileIndex<ohapi.projects.FileIndex>` used by
+        :func:`iter_files<ohapi.projects.OHProject.iter_files>` is rebuilt.
+        For a lazy project, cached member data is discarded and members are
+        fetched again when they are next accessed, and the index is built
+        when it is first needed.
         """
-        url = ('https://www.openhumans.org/api/direct-sharing/project/'
-               'members/?access_token={}'.format(self.master_access_token))
-        results = get_all_results(url)
+        self.file_index = None
+        if self.lazy:
+            self.project_data = LazyProjectData(self.master_access_token)
+            return self.project_data
         self.project_data = dict()
-        for result in results:
-            self.project_data[result['project_member_id']] = result
-            if len(result['data']) < result['file_count']:
-                member_data = get_page(result['exchange_member'])
-                final_data = member_data['data']
-                while member_data['next']:
-                    member_data = get_page(member_data['next'])
-                    final_data = final_data + member_data['data']
-                self.project_data[
-                    result['project_member_id']]['data'] = final_data
+        for result in iter_member_data(self.master_access_token):
+            self.project_data[result['project_member_id']] = (
+                compact_member_data(result))
+        self.file_index = FileIndex(self.project_data)
         return self.project_data
 
+    def iter_files(self, source=None, basename_glob=None, created_after=None,
+                   members=None, shared=None):
+        """
+        Yield (project_member_id, datafile) for the project's files matching
+        all of the given filters.
+
+        Files are selected using the smallest matching
+        :class:`FileIndex<ohapi.projects.FileIndex>` entry (or the listed
+        members' files), then checked against the other filters, so
+        selective queries don't scan every file in the project.
+
+        :param source: If provided, only files from this source are
+            selected. It's default value is None.
+        :param basename_glob: If provided, only files with a basename
+            matching this glob pattern (e.g. "*.vcf.gz") are selected. It's
+            default value is None.
+        :param created_after: If provided, only files created after this
+            time are selected. This may be anything arrow can parse, or
+            microseconds since the epoch as an int. It's default value is
+            None.
+        :param members: If provided, only files of these project member IDs
+            are selected. It's default value is None.
+        :param shared: If True, only files from sources shared with the
+            project are selected. If False, only the project's own files are
+            selected. It's default value is None.
+        """
+        created_after = _created_after_ts(created_after)
+        if members is not None:
+            members = set(members)
+
+        candidates = []
+        if members is not None:
+            member_files = []
+            for member_id in members:
+                if member_id in self.project_data:
+                    member_files += [
+                        (member_id, datafile) for datafile in
+                        self.project_data[member_id]['data']]
+            candidates.append(member_files)
+        if (source is not None or basename_glob is not None or
+                created_after is not None) and (
+                    members is None or not self.lazy):
+            if self.file_index is None:
+                self.file_index = FileIndex(self.project_data)
+            if source is not None:
+                candidates.append(self.file_index.source(source))
+            if basename_glob is not None:
+                candidates.append(
+                    self.file_index.basename_glob(basename_glob))
+            if created_after is not None:
+                candidates.append(
+                    self.file_index.created_after(created_after))
+        if candidates:
+            items = min(candidates, key=len)
+        else:
+            items = ((member_id, datafile) for member_id, member_data in
+                     self.project_data.items() for datafile in
+                     member_data['data'])
+
+        for member_id, datafile in items:
+            if members is not None and member_id not in members:
+                continue
+            if source is not None and datafile.get('source') != source:
+                continue
+            if basename_glob is not None and not fnmatchcase(
+                    datafile.get('basename') or '', basename_glob):
+                continue
+            if created_after is not None:
+                created_ts = _created_ts(datafile)
+                if created_ts is None or created_ts <= created_after:
+                    continue
+            if shared is not None and shared != _is_shared(
+                    self.project_data[member_id], datafile):
+                continue
+            yield member_id, datafile
+
     @classmethod
     def download_member_project_data(cls, member_data, target_member_dir,
                                      max_size=MAX_SIZE_DEFAULT,
-                                     id_filename=False):
+                                     id_filename=False, sha256=False,
+                                     manifest=None, created_after=None,
+                                     sink=None):
         """
         Download files to sync a local dir to match OH member project data.
 
+        Files uploaded with an "md5" in their metadata are verified as they
+        are downloaded. A file that fails to download or verify is logged
+        and skipped. Returns a list of (target filepath, exception) pairs
+        for the files that failed.
+
         :param member_data: This field is data related to member in a project.
         :param target_member_dir: This field is the target directory where data
             will be downloaded.
         :param max_size: This field is the maximum file size. It's default
             value is 128m.
+        :param sha256: If True, SHA-256 digests are also computed. It's
+            default value is False.
+        :param manifest: If provided, this field is the filepath of a JSON
+            Lines manifest recording the digests of downloaded files. It's
+            default value is None.
+        :param created_after: If provided, only files created after this
+            time are downloaded. Files are filtered before any of them are
+            checked or downloaded. It's default value is None.
+        :param sink: If provided, this field is the sink (see
+            :func:`open_sink<ohapi.utils_fs.open_sink>`) files are written
+            to, e.g. a tar or zip archive, and target_member_dir is a path
+            within it. It's default value is None, for local files.
         """
         logging.debug('Download member project data...')
+        failures = _download_files(cls._member_project_data_downloads(
+            member_data, target_member_dir, max_size=max_size,
+            id_filename=id_filename, sha256=sha256, manifest=manifest,
+            created_after=created_after, sink=sink))
+        _log_download_failures(failures)
+        return failures
+
+    @classmethod
+    def _member_project_data_downloads(cls, member_data, target_member_dir,
+                                       max_size=MAX_SIZE_DEFAULT,
+                                       id_filename=False, sha256=False,
+                                       manifest=None, created_after=None,
+                                       sink=None):
+        """
+        Return the download_file keyword arguments for each file downloaded
+        by :func:`download_member_project_data
+        <ohapi.projects.OHProject.download_member_project_data>`.
+        """
         sources_shared = member_data['sources_shared']
         file_data = cls._get_member_file_data(member_data,
-                                              id_filename=id_filename)
+                                              id_filename=id_filename,
+                                              created_after=created_after)
+        downloads = []
         for basename in file_data:
             # This is using a trick to identify a project's own data in an API
             # response, without knowing the project's identifier: if the data
@@ -86,19 +794,28 @@ class OHProject:
             if file_data[basename]['source'] in sources_shared:
                 continue
             target_filepath = os.path.join(target_member_dir, basename)
-            download_file(download_url=file_data[basename]['download_url'],
-                          target_filepath=target_filepath,
-                          max_bytes=parse_size(max_size))
+            downloads.append({
+                'download_url': file_data[basename]['download_url'],
+                'target_filepath': target_filepath,
+                'max_bytes': parse_size(max_size),
+                'md5': cls._get_remote_md5(file_data[basename]),
+                'sha256': sha256, 'manifest': manifest, 'sink': sink})
+        return downloads
 
     @classmethod
     def download_member_shared(cls, member_data, target_member_dir, source=None,
-                               max_size=MAX_SIZE_DEFAULT, id_filename=False):
+                               max_size=MAX_SIZE_DEFAULT, id_filename=False,
+                               sha256=False, manifest=None,
+                               created_after=None, sink=None):
         """
         Download files to sync a local dir to match OH member shared data.
 
         Files are downloaded to match their "basename" on Open Humans.
         If there are multiple files with the same name, the most recent is
-        downloaded.
+        downloaded. Files with an "md5" in their metadata are verified as
+        they are downloaded. A file that fails to download or verify is
+        logged and skipped. Returns a list of (target filepath, exception)
+        pairs for the files that failed.
 
         :param member_data: This field is data related to member in a project.
         :param target_member_dir: This field is the target directory where data
@@ -106,13 +823,45 @@ class OHProject:
         :param source: This field is the source from which to download data.
         :param max_size: This field is the maximum file size. It's default
             value is 128m.
+        :param sha256: If True, SHA-256 digests are also computed. It's
+            default value is False.
+        :param manifest: If provided, this field is the filepath of a JSON
+            Lines manifest recording the digests of downloaded files. It's
+            default value is None.
+        :param created_after: If provided, only files created after this
+            time are downloaded. Files are filtered before any of them are
+            checked or downloaded. It's default value is None.
+        :param sink: If provided, this field is the sink (see
+            :func:`open_sink<ohapi.utils_fs.open_sink>`) files are written
+            to, e.g. a tar or zip archive, and target_member_dir is a path
+            within it. It's default value is None, for local files.
         """
         logging.debug('Download member shared data...')
+        logging.info('Downloading member data to {}'.format(target_member_dir))
+        failures = _download_files(cls._member_shared_downloads(
+            member_data, target_member_dir, source=source,
+            max_size=max_size, id_filename=id_filename, sha256=sha256,
+            manifest=manifest, created_after=created_after, sink=sink))
+        _log_download_failures(failures)
+        return failures
+
+    @classmethod
+    def _member_shared_downloads(cls, member_data, target_member_dir,
+                                 source=None, max_size=MAX_SIZE_DEFAULT,
+                                 id_filename=False, sha256=False,
+                                 manifest=None, created_after=None,
+                                 sink=None):
+        """
+        Return the download_file keyword arguments for each file downloaded
+        by :func:`download_member_shared
+        <ohapi.projects.OHProject.download_member_shared>`, creating their
+        source directories.
+        """
         sources_shared = member_data['sources_shared']
         file_data = cls._get_member_file_data(member_data,
-                                              id_filename=id_filename)
-
-        logging.info('Downloading member data to {}'.format(target_member_dir))
+                                              id_filename=id_filename,
+                                              created_after=created_after)
+        downloads = []
         for basename in file_data:
 
             # If not in sources shared, it's the project's own data. Skip.
@@ -128,20 +877,36 @@ class OHProject:
             else:
                 source_data_dir = os.path.join(target_member_dir,
                                                file_data[basename]['source'])
-                if not os.path.exists(source_data_dir):
-                    os.mkdir(source_data_dir)
+                if sink is None:
+                    os.makedirs(source_data_dir, exist_ok=True)
                 target_filepath = os.path.join(source_data_dir, basename)
 
-            download_file(download_url=file_data[basename]['download_url'],
-                          target_filepath=target_filepath,
-                          max_bytes=parse_size(max_size))
+            downloads.append({
+                'download_url': file_data[basename]['download_url'],
+                'target_filepath': target_filepath,
+                'max_bytes': parse_size(max_size),
+                'md5': cls._get_remote_md5(file_data[basename]),
+                'sha256': sha256, 'manifest': manifest, 'sink': sink})
+        return downloads
 
     def download_all(self, target_dir, source=None, project_data=False,
                      memberlist=None, excludelist=None,
-                     max_size=MAX_SIZE_DEFAULT, id_filename=False):
+                     max_size=MAX_SIZE_DEFAULT, id_filename=False,
+                     sha256=False, manifest=None, created_after=None,
+                     shard=None, sink=None, limiter=None):
         """
         Download data for all users including shared data files.
 
+        A file that fails to download or verify (e.g. an MD5 mismatch) is
+        logged and skipped, and the other files are still downloaded.
+        Returns a list of (target filepath, exception) pairs for the files
+        that failed.
+
+        When a source or created_after is given, members without a matching
+        file are found with :func:`iter_files
+        <ohapi.projects.OHProject.iter_files>` and skipped, so their files
+        aren't checked (unless the project is lazy).
+
         :param target_dir: This field is the target directory to download data.
         :param source: This field is the data source. It's default value is
             None.
@@ -153,36 +918,136 @@ class OHProject:
             skipped. It's default value is None.
         :param max_size: This field is the maximum file size. It's default
             value is 128m.
+        :param sha256: If True, SHA-256 digests are also computed. It's
+            default value is False.
+        :param manifest: If provided, this field is the filepath of a JSON
+            Lines manifest recording the digests of downloaded files. It's
+            default value is None.
+        :param created_after: If provided, only files created after this
+            time are downloaded. Files are filtered before any of them are
+            checked or downloaded. It's default value is None.
+        :param shard: If provided, only members in this shard ("K/N") are
+            downloaded, so a project can be split between hosts. See
+            :func:`member_shard<ohapi.projects.member_shard>`. It's default
+            value is None.
+        :param sink: If provided, this field is the sink (see
+            :func:`open_sink<ohapi.utils_fs.open_sink>`) files are written
+            to, e.g. a tar or zip archive, and target_dir is a path
+            within it. It's default value is None, for local files.
+        :param limiter: If provided, this field is an :class:`AdaptiveLimiter
+            <ohapi.api.AdaptiveLimiter>`, and files are downloaded
+            concurrently, as many at once as it allows. Archive sinks are
+            written one file at a time, so they can't be used with it. It's
+            default value is None, for one download at a time.
         """
+        if limiter is not None and not (
+                sink is None or isinstance(sink, DirectorySink)):
+            raise ValueError('Concurrent downloads need a directory, not an '
+                             'archive.')
         members = self.project_data.keys()
-        for member in members:
-            if not (memberlist is None) and member not in memberlist:
-                logging.debug('Skipping {}, not in memberlist'.format(member))
-                continue
-            if excludelist and member in excludelist:
-                logging.debug('Skipping {}, in excludelist'.format(member))
-                continue
+        created_after = _created_after_ts(created_after)
+        # The source only applies to shared data.
+        file_source = None if project_data else source
+        if (file_source is not None or created_after is not None) and (
+                not self.lazy):
+            # Only members with a matching file, found with the file index,
+            # have their files selected for download.
+            matched = set(member for member, _ in self.iter_files(
+                source=file_source, created_after=created_after,
+                shared=not project_data))
+            members = [member for member in members if member in matched]
+        downloads = []
+        failures = []
+        for member in select_members(members, memberlist=memberlist,
+                                     excludelist=excludelist, shard=shard):
             member_dir = os.path.join(target_dir, member)
-            if not os.path.exists(member_dir):
-                os.mkdir(member_dir)
+            if sink is None:
+                os.makedirs(member_dir, exist_ok=True)
             if project_data:
-                self.download_member_project_data(
+                member_downloads = self._member_project_data_downloads(
                     member_data=self.project_data[member],
                     target_member_dir=member_dir,
                     max_size=max_size,
-                    id_filename=id_filename)
+                    id_filename=id_filename,
+                    sha256=sha256,
+                    manifest=manifest,
+                    created_after=created_after,
+                    sink=sink)
             else:
-                self.download_member_shared(
+                logging.info('Downloading member data to {}'.format(
+                    member_dir))
+                member_downloads = self._member_shared_downloads(
                     member_data=self.project_data[member],
                     target_member_dir=member_dir,
                     source=source,
                     max_size=max_size,
-                    id_filename=id_filename)
+                    id_filename=id_filename,
+                    sha256=sha256,
+                    manifest=manifest,
+                    created_after=created_after,
+                    sink=sink)
+            if limiter is None:
+                failures += _download_files(member_downloads)
+            else:
+                downloads += member_downloads
+        if downloads:
+            failures += _download_files(downloads, limiter=limiter)
+        _log_download_failures(failures)
+        return failures
+
+    def latest_created(self, members=None):
+        """
+        Return the created time of the project's most recently created file,
+        in microseconds since the Unix epoch, or None if there are no files
+        with a created time. Used as the high-water mark for incremental
+        downloads, see :func:`download<ohapi.command_line.download>`.
+
+        :param members: If provided, only files of these project member IDs
+            are considered. It's default value is None.
+        """
+        if members is None and not self.lazy:
+            if self.file_index is None:
+                self.file_index = FileIndex(self.project_data)
+            created_ts = self.file_index.created_ts
+            return created_ts[-1] if created_ts else None
+        return max_created(
+            datafile for _, datafile in self.iter_files(members=members))
+
+    def delete_member_files(self, targets, max_workers=MAX_WORKERS_DEFAULT,
+                            allow_all_files=False):
+        """
+        Delete many project member files concurrently.
+
+        If allow_all_files is True, members whose every project file (as
+        listed when the project was loaded) is targeted are cleaned up with
+        a single all_files request. See
+        :func:`delete_files_bulk<ohapi.api.delete_files_bulk>`.
+
+        :param targets: This field is an iterable of (project_member_id, file)
+            pairs, where file is a file basename, a file ID, or None to delete
+            all files.
+        :param max_workers: This field is the maximum number of concurrent
+            delete requests. It's default value is 4.
+        :param allow_all_files: If True, whole members may be deleted with
+            one all_files request. Only use it if no files were added since
+            the project was loaded. It's default value is False.
+        """
+        targets = list(targets)
+        member_files = {member_id: [] for member_id, _ in targets if
+                        member_id in self.project_data}
+        for member_id, datafile in self.iter_files(members=member_files,
+                                                   shared=False):
+            member_files[member_id].append(datafile)
+        return delete_files_bulk(access_token=self.master_access_token,
+                                 targets=targets,
+                                 member_files=member_files,
+                                 max_workers=max_workers,
+                                 allow_all_files=allow_all_files)
 
     @staticmethod
     def upload_member_from_dir(member_data, target_member_dir, metadata,
                                access_token, mode='default',
-                               max_size=MAX_SIZE_DEFAULT):
+                               max_size=MAX_SIZE_DEFAULT, compress=None):
         """
         Upload files in target directory to an Open Humans member's account.
 
@@ -195,38 +1060,137 @@ class OHProject:
         If the 'mode' parameter is 'sync': files on Open Humans that are not
         in the local directory will be deleted.
 
+        If metadata is None, files are uploaded without a separate pass to
+        describe them: metadata is drafted from the directory listing (see
+        :func:`describe_local_files<ohapi.utils_fs.describe_local_files>`)
+        and each file's MD5 is computed while it is read for upload. Files
+        over 32m are read twice, as the MD5 is sent before the upload (see
+        :func:`upload_stream<ohapi.api.upload_stream>`).
+
         :param member_data: This field is data related to member in a project.
         :param target_member_dir: This field is the target directory from where
             data will be uploaded.
-        :param metadata: This field is metadata for files to be uploaded.
+        :param metadata: This field is metadata for files to be uploaded, or
+            None to draft it while uploading.
         :param access_token: This field is user specific access token.
         :param mode: This field takes three value default, sync, safe. It's
             default value is 'default'.
         :param max_size: This field is the maximum file size. It's default
             value is 128m.
+        :param compress: If 'gzip' or 'bz2', files are compressed while they
+            are uploaded, and are matched to remote files by their compressed
+            names. It's default value is None.
         """
-        if not validate_metadata(target_member_dir, metadata):
+        set_md5 = metadata is None
+        if set_md5:
+            metadata = describe_local_files(target_member_dir,
+                                            max_bytes=parse_size(max_size))
+        elif not validate_metadata(target_member_dir, metadata):
             raise ValueError('Metadata should match directory contents!')
         project_data = {f['basename']: f for f in member_data['data'] if
                         f['source'] not in member_data['sources_shared']}
+        if compress:
+            remote_names = {filename: compressed_filename(filename, compress)
+                            for filename in metadata}
+        else:
+            remote_names = {filename: filename for filename in metadata}
         for filename in metadata:
-            if filename in project_data and mode == 'safe':
+            remote_name = remote_names[filename]
+            if remote_name in project_data and mode == 'safe':
                 logging.info('Skipping {}, remote exists with matching'
                              ' name'.format(filename))
                 continue
             filepath = os.path.join(target_member_dir, filename)
-            remote_file_info = (project_data[filename] if filename in
+            remote_file_info = (project_data[remote_name] if remote_name in
                                 project_data else None)
             upload_aws(target_filepath=filepath,
                        metadata=metadata[filename],
                        access_token=access_token,
                        project_member_id=member_data['project_member_id'],
-                       remote_file_info=remote_file_info)
+                       remote_file_info=remote_file_info,
+                       compress=compress,
+                       set_md5=set_md5)
+        if mode == 'sync':
+            OHProject._delete_unmatched(member_data, project_data,
+                                        set(remote_names.values()),
+                                        access_token)
+
+    @staticmethod
+    def _delete_unmatched(member_data, project_data, uploaded, access_token):
+        project_member_id = member_data['project_member_id']
+        targets = []
+        for filename in project_data:
+            if filename not in uploaded:
+                logging.debug("Deleting {}".format(filename))
+                targets.append((project_member_id, filename))
+        # project_data was listed before this sync's uploads, so files
+        # are deleted one by one, never with an all_files request.
+        if targets:
+            delete_files_bulk(access_token=access_token, targets=targets)
+
+    @staticmethod
+    def upload_member_files(member_data, files, metadata, access_token,
+                            mode='default', compress=None):
+        """
+        Upload files read from file objects, e.g. the entries of an archive
+        (see :func:`iter_archive_files<ohapi.utils_fs.iter_archive_files>`),
+        to an Open Humans member's account, in the same way as
+        :func:`upload_member_from_dir
+        <ohapi.projects.OHProject.upload_member_from_dir>`.
+
+        Each file is streamed to :func:`upload_stream
+        <ohapi.api.upload_stream>` as it's read. As files aren't known in
+        advance, each file is checked against the metadata before it's
+        uploaded, and files in the metadata but not in files are reported
+        (with a ValueError) once the others are uploaded, before any sync
+        deletes.
+
+        :param member_data: This field is data related to member in a project.
+        :param files: This field is an iterable of (filename, mtime, fileobj)
+            for the files to upload, where mtime is used as the creation date
+            of drafted metadata.
+        :param metadata: This field is metadata for files to be uploaded, or
+            None to draft it while uploading.
+        :param access_token: This field is user specific access token.
+        :param mode: This field takes three value default, sync, safe. It's
+            default value is 'default'.
+        :param compress: If 'gzip' or 'bz2', files are compressed while they
+            are uploaded, and are matched to remote files by their compressed
+            names. It's default value is None.
+        """
+        set_md5 = metadata is None
+        project_member_id = member_data['project_member_id']
+        project_data = {f['basename']: f for f in member_data['data'] if
+                        f['source'] not in member_data['sources_shared']}
+        seen = set()
+        uploaded = set()
+        for filename, mtime, fileobj in files:
+            if set_md5:
+                file_metadata = draft_file_metadata(filename, mtime)
+            elif filename in metadata:
+                file_metadata = metadata[filename]
+            else:
+                raise ValueError('Metadata should match files: {} not found '
+                                 'in metadata'.format(filename))
+            seen.add(filename)
+            remote_name = (compressed_filename(filename, compress) if compress
+                           else filename)
+            uploaded.add(remote_name)
+            if remote_name in project_data and mode == 'safe':
+                logging.info('Skipping {}, remote exists with matching'
+                             ' name'.format(filename))
+                continue
+            upload_stream(stream=fileobj, filename=filename,
+                          metadata=file_metadata, access_token=access_token,
+                          remote_file_info=project_data.get(remote_name),
+                          project_member_id=project_member_id,
+                          file_identifier='{}/{}'.format(project_member_id,
+                                                         filename),
+                          compress=compress, set_md5=set_md5)
+        if not set_md5 and set(metadata) - seen:
+            raise ValueError('Metadata should match files: {} not '
+                             'found'.format(', '.join(sorted(
+                                 set(metadata) - seen))))
         if mode == 'sync':
-            for filename in project_data:
-                if filename not in metadata:
-                    logging.debug("Deleting {}".format(filename))
-                    delete_file(
-                        file_basename=filename,
-                        access_token=access_token,
-                        project_member_id=member_data['project_member_id'])
+            OHProject._delete_unmatched(member_data, project_data, uploaded,
+                                        access_token)
@@ -20,7 +20,8 @@ import sys
 
 from humanfriendly import format_size, parse_size
 
-from .api import get_page
+from .api import REQUEST_TIMEOUT, get_page
+from .utils_fs import DirectorySink, open_sink
 
 
 BASE_URL = 'https://www.openhumans.org'
@@ -34,7 +35,7 @@ def signal_handler_cb(signal_name, frame):
     os._exit(1)
 
 
-def download_url(result, directory, max_bytes):
+def download_url(result, directory, max_bytes, sink=None):
     """
     Download a file.
 
@@ -43,8 +44,14 @@ def download_url(result, directory, max_bytes):
     :param directory: This field is the target directory to which data will be
         downloaded.
     :param max_bytes: This field is the maximum file size in bytes.
+    :param sink: If provided, this field is the sink (see
+        :func:`open_sink<ohapi.utils_fs.open_sink>`) the file is written to,
+        instead of directory. It's default value is None.
     """
-    response = requests.get(result['download_url'], stream=True)
+    if sink is None:
+        sink = DirectorySink(directory)
+    response = requests.get(result['download_url'], stream=True,
+                            timeout=REQUEST_TIMEOUT)
 
     # TODO: make this more robust by parsing the URL
     filename = response.url.split('/')[-1]
@@ -61,33 +68,20 @@ def download_url(result, directory, max_bytes):
 
     logging.info('Downloading {} ({})'.format(filename, format_size(size)))
 
-    output_path = os.path.join(directory, filename)
+    if sink.exists(filename, size):
+        logging.info('Skipping "{}"; exists and is the right size'.format(
+            filename))
 
-    try:
-        stat = os.stat(output_path)
-
-        if stat.st_size == size:
-            logging.info('Skipping "{}"; exists and is the right size'.format(
-                filename))
-
-            return
-        else:
-            logging.info('Removing "{}"; exists and is the wrong size'.format(
-                filename))
-
-            os.remove(output_path)
-    except OSError:
-        # TODO: check errno here?
-        pass
+        return
 
-    with open(output_path, 'wb') as f:
+    def chunks():
         total_length = response.headers.get('content-length')
         total_length = int(total_length)
         dl = 0
         for chunk in response.iter_content(chunk_size=8192):
             if chunk:
                 dl += len(chunk)
-                f.write(chunk)
+                yield chunk
                 d = int(50 * dl / total_length)
                 sys.stdout.write("\r[%s%s]%d%s" % ('.' * d,
                                                    '' * (50 - d),
@@ -96,6 +90,8 @@ def download_url(result, directory, max_bytes):
                 sys.stdout.flush
         print("\n")
 
+    sink.write(filename, size, chunks())
+
     logging.info('Downloaded {}'.format(filename))
 
 
@@ -109,7 +105,8 @@ def download(source=None, username=None, directory='.', max_size='128m',
     :param username: This fiels is username of user. It's default value is
         None.
     :param directory: This field is the target directory to which data is
-        downloaded.
+        downloaded. If it's an archive filepath (e.g. "public.tar.gz" or
+        "public.zip"), files are streamed into a new archive instead.
     :param max_size: This field is the maximum file size. It's default value is
         128m.
     :param quiet: This field is the logging level. It's default value is
@@ -163,13 +160,20 @@ def download(source=None, username=None, directory='.', max_size='128m',
 
     logging.info('Downloading {} files'.format(len(results)))
 
-    download_url_partial = partial(download_url, directory=directory,
-                                   max_bytes=max_bytes)
+    with open_sink(directory) as sink:
+        download_url_partial = partial(download_url, directory=directory,
+                                       max_bytes=max_bytes, sink=sink)
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
-        for value in executor.map(download_url_partial, results):
-            if value:
-                logging.info(value)
+        # Archives and in-memory sinks are shared between threads, which
+        # take turns writing to them.
+        if isinstance(sink, DirectorySink):
+            executor_class = concurrent.futures.ProcessPoolExecutor
+        else:
+            executor_class = concurrent.futures.ThreadPoolExecutor
+        with executor_class(max_workers=4) as executor:
+            for value in executor.map(download_url_partial, results):
+                if value:
+                    logging.info(value)
 
 
 def get_members_by_source(base_url=BASE_URL_API):
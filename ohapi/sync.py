@@ -0,0 +1,453 @@
+"""
+Plan and run syncs between an Open Humans project and local directories.
+
+Planning compares project data with local files (and optionally a manifest
+of earlier downloads) without transferring any data, producing a
+:class:`SyncPlan<ohapi.sync.SyncPlan>` of downloads, uploads, deletes and
+skips. A plan can be printed as a dry-run, saved and loaded as JSON, checked
+against free disk space, and run with
+:func:`execute_plan<ohapi.sync.execute_plan>`.
+"""
+from collections import OrderedDict, namedtuple
+import json
+import logging
+import os
+import shutil
+
+from humanfriendly import format_size, parse_size
+import requests
+
+from .api import (MAX_WORKERS_DEFAULT, REQUEST_TIMEOUT, _run_concurrently,
+                  compressed_filename, delete_files_bulk, handle_error,
+                  upload_aws)
+from .projects import MAX_SIZE_DEFAULT, OHProject, select_members
+from .utils_fs import (describe_local_files, download_file, read_manifest,
+                       validate_metadata)
+
+ACTIONS = ('download', 'upload', 'delete', 'skip')
+
+
+class SyncAction(namedtuple('SyncAction', [
+        'action', 'project_member_id', 'filename', 'path', 'size', 'reason',
+        'details'])):
+    """
+    A single step of a :class:`SyncPlan<ohapi.sync.SyncPlan>`.
+
+    action is one of "download", "upload", "delete" or "skip". filename is
+    the file's name on Open Humans and path its local filepath. size is the
+    number of bytes to transfer, or None if it isn't known. details holds
+    what's needed to run the action, e.g. a download's "download_url".
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        return OrderedDict(zip(self._fields, self))
+
+
+class SyncPlan(object):
+    """
+    An ordered list of :class:`SyncAction<ohapi.sync.SyncAction>` objects,
+    with byte totals for each kind of action.
+    """
+    def __init__(self, actions=None):
+        self.actions = list(actions or [])
+
+    def add(self, action, project_member_id, filename, path=None, size=None,
+            reason=None, **details):
+        self.actions.append(SyncAction(action, project_member_id, filename,
+                                       path, size, reason, details))
+
+    def extend(self, plan):
+        self.actions += plan.actions
+
+    def __iter__(self):
+        return iter(self.actions)
+
+    def __len__(self):
+        return len(self.actions)
+
+    def totals(self):
+        """
+        Return an OrderedDict mapping each action to a dict with its "count",
+        "bytes" (of known sizes) and "unknown" (count of unknown sizes).
+        """
+        totals = OrderedDict(
+            (action, {'count': 0, 'bytes': 0, 'unknown': 0}) for
+            action in ACTIONS)
+        for sync_action in self.actions:
+            total = totals[sync_action.action]
+            total['count'] += 1
+            if sync_action.size is None:
+                total['unknown'] += 1
+            else:
+                total['bytes'] += sync_action.size
+        return totals
+
+    def sorted_by_size(self, reverse=True):
+        """
+        Return a copy of the plan with actions ordered by size, largest
+        first unless reverse is False. Actions of unknown size come last.
+        """
+        known = [a for a in self.actions if a.size is not None]
+        unknown = [a for a in self.actions if a.size is None]
+        return SyncPlan(sorted(known, key=lambda a: a.size,
+                               reverse=reverse) + unknown)
+
+    def check_disk_space(self, target_dir):
+        """
+        Raise a ValueError if the known size of the plan's downloads is more
+        than the free space where target_dir is.
+
+        :param target_dir: This field is the directory downloads go to.
+        """
+        needed = self.totals()['download']['bytes']
+        free = shutil.disk_usage(target_dir).free
+        if needed > free:
+            raise ValueError('Downloads need {} but only {} is free in '
+                             '{}'.format(format_size(needed),
+                                         format_size(free), target_dir))
+
+    def format(self, verbose=True):
+        """
+        Return the plan as text for a dry-run: one line per action (unless
+        verbose is False), then a summary line for each kind of action.
+        """
+        lines = []
+        if verbose:
+            for a in self.actions:
+                size = 'unknown size' if a.size is None else format_size(
+                    a.size)
+                line = '{} {}/{} ({})'.format(a.action, a.project_member_id,
+                                              a.filename, size)
+                if a.reason:
+                    line += ': {}'.format(a.reason)
+                lines.append(line)
+        for action, total in self.totals().items():
+            if not total['count']:
+                continue
+            line = '{}: {} files, {}'.format(action, total['count'],
+                                             format_size(total['bytes']))
+            if total['unknown']:
+                line += ' ({} of unknown size)'.format(total['unknown'])
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return json.dumps([a.to_dict() for a in self.actions])
+
+    @classmethod
+    def from_json(cls, plan_json):
+        return cls(SyncAction(**a) for a in json.loads(plan_json))
+
+    def save(self, filepath):
+        with open(filepath, 'w') as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath) as f:
+            return cls.from_json(f.read())
+
+
+def remote_file_size(download_url):
+    """
+    Return the size of a remote file from its response headers, without
+    downloading it, or None if the response doesn't give its length (e.g.
+    it's chunked).
+
+    :param download_url: This field is the url from which data would be
+        downloaded.
+    """
+    response = requests.get(download_url, stream=True,
+                            timeout=REQUEST_TIMEOUT)
+    try:
+        handle_error(response, 200)
+        size = response.headers.get('Content-Length')
+        return None if size is None else int(size)
+    finally:
+        response.close()
+
+
+def _fetch_sizes(plan, max_workers):
+    actions = [a for a in plan.actions if a.action == 'download']
+    sizes = _run_concurrently(
+        remote_file_size, [{'download_url': a.details['download_url']} for
+                           a in actions], max_workers=max_workers)
+    return dict(zip([id(a) for a in actions], sizes))
+
+
+def plan_member_download(member_data, target_member_dir, source=None,
+                         project_data=False, id_filename=False,
+                         manifest_records=None, created_after=None):
+    """
+    Plan downloads to sync a local dir to match a member's data, in the same
+    way as :func:`download_member_shared
+    <ohapi.projects.OHProject.download_member_shared>` (or
+    :func:`download_member_project_data
+    <ohapi.projects.OHProject.download_member_project_data>` if
+    project_data is True). Download sizes aren't known until they're
+    fetched, see :func:`plan_download<ohapi.sync.plan_download>`.
+
+    :param member_data: This field is data related to member in a project.
+    :param target_member_dir: This field is the target directory where data
+        would be downloaded.
+    :param source: This field is the source from which to download data.
+        It's default value is None.
+    :param project_data: If True, the project's own data is planned instead
+        of shared data. It's default value is False.
+    :param manifest_records: This field is a dict of manifest records (see
+        :func:`read_manifest<ohapi.utils_fs.read_manifest>`). Local files
+        recorded with the remote file's md5 are skipped. It's default value
+        is None.
+    :param created_after: If provided, only files created after this time
+        are planned. It's default value is None.
+    """
+    plan = SyncPlan()
+    member_id = member_data['project_member_id']
+    sources_shared = member_data['sources_shared']
+    file_data = OHProject._get_member_file_data(member_data,
+                                                id_filename=id_filename,
+                                                created_after=created_after)
+    for basename, datafile in file_data.items():
+        shared = datafile['source'] in sources_shared
+        if project_data == shared:
+            continue
+        if project_data or source:
+            if source and source != datafile['source']:
+                continue
+            path = os.path.join(target_member_dir, basename)
+        else:
+            path = os.path.join(target_member_dir, datafile['source'],
+                                basename)
+        md5 = OHProject._get_remote_md5(datafile)
+        record = (manifest_records or {}).get(path)
+        if (md5 and record and record.get('md5') == md5 and
+                os.path.exists(path) and
+                os.stat(path).st_size == record.get('size')):
+            plan.add('skip', member_id, basename, path, reason='matches '
+                     'manifest md5')
+            continue
+        plan.add('download', member_id, basename, path,
+                 download_url=datafile['download_url'], md5=md5)
+    return plan
+
+
+def plan_download(project, target_dir, source=None, project_data=False,
+                  memberlist=None, excludelist=None,
+                  max_size=MAX_SIZE_DEFAULT, id_filename=False,
+                  manifest=None, fetch_sizes=False,
+                  max_workers=MAX_WORKERS_DEFAULT, created_after=None,
+                  shard=None):
+    """
+    Plan downloads for all members of a project, in the same way as
+    :func:`download_all<ohapi.projects.OHProject.download_all>`.
+
+    :param project: This field is the
+        :class:`OHProject<ohapi.projects.OHProject>`.
+    :param target_dir: This field is the target directory to download data.
+    :param source: This field is the data source. It's default value is
+        None.
+    :param project_data: This field is data related to particular project.
+        It's default value is False.
+    :param memberlist: This field is list of members whose data will be
+        downloaded. It's default value is None.
+    :param excludelist: This field is list of members whose data will be
+        skipped. It's default value is None.
+    :param max_size: This field is the maximum file size. It's default
+        value is 128m.
+    :param manifest: If provided, this field is the filepath of a manifest of
+        earlier downloads. Local files recorded with the remote file's md5
+        are skipped. It's default value is None.
+    :param fetch_sizes: If True, the size of each download is fetched from
+        its response headers (without downloading it), so that byte totals
+        are known and files that are too large, or already exist with the
+        right size, are skipped. It's default value is False.
+    :param max_workers: This field is the maximum number of concurrent
+        requests when fetching sizes. It's default value is 4.
+    :param created_after: If provided, only files created after this time
+        are planned. It's default value is None.
+    :param shard: If provided, only members in this shard ("K/N") are
+        planned. It's default value is None.
+    """
+    manifest_records = read_manifest(manifest) if manifest else None
+    plan = SyncPlan()
+    for member_id in select_members(project.project_data,
+                                    memberlist=memberlist,
+                                    excludelist=excludelist, shard=shard):
+        plan.extend(plan_member_download(
+            project.project_data[member_id],
+            os.path.join(target_dir, member_id), source=source,
+            project_data=project_data, id_filename=id_filename,
+            manifest_records=manifest_records,
+            created_after=created_after))
+    if fetch_sizes:
+        plan = add_download_sizes(plan, max_size=max_size,
+                                  max_workers=max_workers)
+    return plan
+
+
+def add_download_sizes(plan, max_size=MAX_SIZE_DEFAULT,
+                       max_workers=MAX_WORKERS_DEFAULT):
+    """
+    Return a copy of a plan with download sizes fetched from response
+    headers. Downloads larger than max_size, or of local files that exist
+    with the right size, become skips. Downloads whose size isn't given
+    are kept, with an unknown size.
+
+    :param plan: This field is the :class:`SyncPlan<ohapi.sync.SyncPlan>`.
+    :param max_size: This field is the maximum file size. It's default
+        value is 128m.
+    :param max_workers: This field is the maximum number of concurrent
+        requests. It's default value is 4.
+    """
+    max_bytes = parse_size(max_size)
+    sizes = _fetch_sizes(plan, max_workers)
+    sized = SyncPlan()
+    for a in plan:
+        if id(a) not in sizes:
+            sized.actions.append(a)
+            continue
+        size = sizes[id(a)]
+        if size is None:
+            sized.actions.append(a)
+        elif size > max_bytes:
+            sized.add('skip', a.project_member_id, a.filename, a.path, size,
+                      'exceeds maximum size', **a.details)
+        elif (os.path.exists(a.path) and
+                os.stat(a.path).st_size == size):
+            sized.add('skip', a.project_member_id, a.filename, a.path, size,
+                      'exists with matching size', **a.details)
+        else:
+            sized.actions.append(a._replace(size=size))
+    return sized
+
+
+def plan_upload(member_data, target_member_dir, metadata, mode='default',
+                max_size=MAX_SIZE_DEFAULT, compress=None):
+    """
+    Plan uploads of files in a target directory to an Open Humans member's
+    account, in the same way as :func:`upload_member_from_dir
+    <ohapi.projects.OHProject.upload_member_from_dir>`. Sizes are local file
+    sizes, before any compression.
+
+    :param member_data: This field is data related to member in a project.
+    :param target_member_dir: This field is the target directory from where
+        data will be uploaded.
+    :param metadata: This field is metadata for files to be uploaded, or
+        None to draft it while uploading.
+    :param mode: This field takes three value default, sync, safe. It's
+        default value is 'default'.
+    :param max_size: This field is the maximum file size. It's default
+        value is 128m.
+    :param compress: If 'gzip' or 'bz2', files are compressed while they are
+        uploaded. It's default value is None.
+    """
+    member_id = member_data['project_member_id']
+    set_md5 = metadata is None
+    if set_md5:
+        metadata = describe_local_files(target_member_dir,
+                                        max_bytes=parse_size(max_size))
+    elif not validate_metadata(target_member_dir, metadata):
+        raise ValueError('Metadata should match directory contents!')
+    project_files = {f['basename']: f for f in member_data['data'] if
+                     f['source'] not in member_data['sources_shared']}
+    plan = SyncPlan()
+    uploaded = set()
+    for filename in metadata:
+        remote_name = (compressed_filename(filename, compress) if compress
+                       else filename)
+        uploaded.add(remote_name)
+        path = os.path.join(target_member_dir, filename)
+        size = os.stat(path).st_size
+        remote_file = project_files.get(remote_name)
+        if remote_file and mode == 'safe':
+            plan.add('skip', member_id, remote_name, path, size,
+                     'remote exists with matching name')
+            continue
+        plan.add('upload', member_id, remote_name, path, size,
+                 metadata=dict(metadata[filename]), compress=compress,
+                 set_md5=set_md5,
+                 remote_file_info=({'download_url':
+                                    remote_file['download_url']} if
+                                   remote_file else None))
+    if mode == 'sync':
+        for remote_name in project_files:
+            if remote_name not in uploaded:
+                plan.add('delete', member_id, remote_name,
+                         reason='not in local directory')
+    return plan
+
+
+def _run_download(action, max_size, sha256, manifest):
+    target_dir = os.path.dirname(action.path)
+    if target_dir:
+        os.makedirs(target_dir, exist_ok=True)
+    return download_file(download_url=action.details['download_url'],
+                         target_filepath=action.path,
+                         max_bytes=parse_size(max_size),
+                         md5=action.details.get('md5'), sha256=sha256,
+                         manifest=manifest)
+
+
+def _run_upload(action, access_token):
+    return upload_aws(target_filepath=action.path,
+                      metadata=action.details['metadata'],
+                      access_token=access_token,
+                      project_member_id=action.project_member_id,
+                      remote_file_info=action.details.get('remote_file_info'),
+                      compress=action.details.get('compress'),
+                      set_md5=action.details.get('set_md5', False))
+
+
+def execute_plan(plan, access_token=None, max_workers=MAX_WORKERS_DEFAULT,
+                 max_size=MAX_SIZE_DEFAULT, sha256=False, manifest=None,
+                 order_by_size=True, limiter=None):
+    """
+    Run a :class:`SyncPlan<ohapi.sync.SyncPlan>`, with up to max_workers
+    downloads or uploads at once. Deletes are sent last, with
+    :func:`delete_files_bulk<ohapi.api.delete_files_bulk>`. Returns the
+    results of the actions that were run, in the order they were run.
+
+    :param plan: This field is the plan to run.
+    :param access_token: This field is the master access token, needed for
+        uploads and deletes. It's default value is None.
+    :param max_workers: This field is the maximum number of concurrent
+        transfers. It's default value is 4.
+    :param max_size: This field is the maximum file size to download. It's
+        default value is 128m.
+    :param sha256: If True, SHA-256 digests of downloads are also computed.
+        It's default value is False.
+    :param manifest: If provided, this field is the filepath of a manifest
+        recording the digests of downloaded files. It's default value is
+        None.
+    :param order_by_size: If True, the largest transfers are started first.
+        It's default value is True.
+    :param limiter: If provided, this field is an :class:`AdaptiveLimiter
+        <ohapi.api.AdaptiveLimiter>` adapting the number of concurrent
+        transfers and deletes, instead of max_workers. It's default value is
+        None.
+    """
+    if order_by_size:
+        plan = plan.sorted_by_size()
+    transfers = [a for a in plan if a.action in ('download', 'upload')]
+    if (any(a.action in ('upload', 'delete') for a in plan) and
+            not access_token):
+        raise ValueError('An access token is needed for uploads and '
+                         'deletes.')
+
+    def run(action):
+        logging.debug('Running {} of {}'.format(action.action, action.path))
+        if action.action == 'download':
+            return _run_download(action, max_size, sha256, manifest)
+        return _run_upload(action, access_token)
+
+    results = _run_concurrently(run, [{'action': a} for a in transfers],
+                                max_workers=max_workers, limiter=limiter)
+    deletes = [(a.project_member_id, a.filename) for a in plan if
+               a.action == 'delete']
+    if deletes:
+        results += delete_files_bulk(access_token=access_token,
+                                     targets=deletes,
+                                     max_workers=max_workers,
+                                     limiter=limiter)
+    return results
@@ -1,12 +1,23 @@
+import bz2
+import gzip
+import hashlib
 import io
+import json
+import threading
+import time
 from unittest import TestCase
+from unittest.mock import Mock, patch
 
 import pytest
 import vcr
 
+import ohapi.api
+
 from ohapi.api import (
-    SettingsError, oauth2_auth_url, oauth2_token_exchange,
-    get_page, message, delete_file, upload_file, upload_stream)
+    AdaptiveLimiter, SettingsError, oauth2_auth_url, oauth2_token_exchange,
+    compress_chunks, compressed_filename, get_page, message, delete_file,
+    delete_files_bulk, handle_error, spool_stream, upload_file, upload_iter,
+    upload_stream, _run_concurrently)
 
 parameter_defaults = {
     'CLIENT_ID_VALID': 'validclientid',
@@ -194,6 +205,52 @@ class APITestGetPage(TestCase):
         except Exception:
             pass
 
+    def _get_pages_concurrently(self, url, response, threads=4):
+        """
+        Call get_page from several threads, completing the (single) request
+        once the other calls are waiting for it.
+        """
+        def get(url):
+            flight = ohapi.api._flights[url]
+            while flight.followers < threads - 1:
+                time.sleep(0.001)
+            return response
+
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(get_page(url))
+            except Exception as e:
+                errors.append(e)
+
+        with patch('ohapi.api.requests.get', side_effect=get) as mock_get:
+            workers = [threading.Thread(target=call) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        self.assertEqual(mock_get.call_count, 1)
+        return results, errors
+
+    def test_get_page_coalesces_concurrent_requests(self):
+        url = 'https://www.openhumans.org/api/public-data/?offset=0'
+        response = Mock(status_code=200)
+        response.json.return_value = {'next': None, 'results': [{'id': 1}]}
+        results, errors = self._get_pages_concurrently(url, response)
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [response.json.return_value] * 4)
+        # Each caller gets its own copy.
+        results[0]['results'].append({'id': 2})
+        self.assertEqual(results[1]['results'], [{'id': 1}])
+        self.assertEqual(ohapi.api._flights, {})
+
+        response = Mock(status_code=503, content=b'')
+        results, errors = self._get_pages_concurrently(url, response)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 4)
+
 
 class APITestMessage(TestCase):
     """
@@ -490,3 +547,247 @@ class APITestUpload(TestCase):
             project_member_id=VALID_PMI1)
         self.assertEqual(response.status_code, 200)
         assert response.json() == {'size': 446, 'status': 'ok'}
+
+
+class APITestUploadIter(TestCase):
+    """
+    Tests for :func:`upload_iter<ohapi.api.upload_iter>`.
+    """
+
+    def setUp(self):
+        pass
+
+    def test_spool_stream_generator(self):
+        chunks = (b'x' * 10 for _ in range(5))
+        with spool_stream(chunks, spool_size=16) as spooled:
+            self.assertEqual(spooled.read(), b'x' * 50)
+
+    def test_spool_stream_max_bytes_exceeded(self):
+        def chunks():
+            for _ in range(5):
+                yield b'x' * 10
+            raise AssertionError('Producer read past max_bytes')
+        self.assertRaisesRegex(
+            ValueError, 'Maximum file size exceeded', spool_stream,
+            chunks(), max_bytes=25)
+
+    def test_upload_iter_passes_seekable_stream(self):
+        uploaded = {}
+
+        def fake_upload_stream(stream, **kwargs):
+            uploaded['data'] = stream.read()
+            uploaded['filename'] = kwargs['filename']
+
+        chunks = (b'abc' for _ in range(3))
+        with patch('ohapi.api.upload_stream', fake_upload_stream):
+            upload_iter(chunks, filename='data.txt', metadata=FILE_METADATA,
+                        access_token=ACCESS_TOKEN,
+                        project_member_id=VALID_PMI1)
+        self.assertEqual(uploaded, {'data': b'abcabcabc',
+                                    'filename': 'data.txt'})
+
+    def test_upload_stream_non_seekable(self):
+        with patch('ohapi.api.upload_iter') as mocked_upload_iter:
+            class Pipe(io.RawIOBase):
+                def seekable(self):
+                    return False
+            stream = Pipe()
+            upload_stream(stream, filename='data.txt',
+                          metadata=FILE_METADATA,
+                          access_token=ACCESS_TOKEN,
+                          project_member_id=VALID_PMI1)
+            self.assertTrue(mocked_upload_iter.called)
+
+    def test_upload_stream_set_md5(self):
+        data = b'some stuff' * 100
+
+        def upload(spool_size):
+            uploaded = {}
+
+            def fake_post(url, data, timeout=None):
+                if 'metadata' in data:
+                    uploaded['metadata'] = json.loads(data['metadata'])
+                return Mock(status_code=201 if 'metadata' in data else 200,
+                            json=lambda: {'url': 'https://s3/', 'id': 1})
+
+            def fake_put(url, data, timeout=None):
+                uploaded['data'] = data.read()
+                return Mock(status_code=200)
+
+            with patch('ohapi.api.SPOOL_SIZE_DEFAULT', spool_size), \
+                    patch('ohapi.api.requests.post', fake_post), \
+                    patch('ohapi.api.requests.put', fake_put):
+                upload_stream(io.BytesIO(data), filename='data.txt',
+                              metadata=FILE_METADATA,
+                              access_token=ACCESS_TOKEN,
+                              project_member_id=VALID_PMI1, set_md5=True)
+            return uploaded
+
+        for spool_size in [len(data), 16]:
+            uploaded = upload(spool_size)
+            self.assertEqual(uploaded['data'], data)
+            self.assertEqual(uploaded['metadata'],
+                             dict(FILE_METADATA,
+                                  md5=hashlib.md5(data).hexdigest()))
+
+
+class APITestCompress(TestCase):
+    """
+    Tests for :func:`compress_chunks<ohapi.api.compress_chunks>` and
+    compressed uploads.
+    """
+
+    def setUp(self):
+        pass
+
+    def test_compressed_filename(self):
+        self.assertEqual(compressed_filename('data.csv', 'gzip'),
+                         'data.csv.gz')
+        self.assertEqual(compressed_filename('data.csv', 'bz2'),
+                         'data.csv.bz2')
+        self.assertEqual(compressed_filename('data.csv.gz', 'bz2'),
+                         'data.csv.gz')
+        self.assertRaises(ValueError, compressed_filename, 'data.csv', 'xz')
+
+    def test_compress_chunks_round_trip(self):
+        data = b'a,b,c\n1,2,3\n' * 1000
+        gzipped = b''.join(compress_chunks(io.BytesIO(data), 'gzip'))
+        self.assertEqual(gzip.decompress(gzipped), data)
+        bzipped = b''.join(compress_chunks(io.BytesIO(data), 'bz2'))
+        self.assertEqual(bz2.decompress(bzipped), data)
+
+    def test_upload_stream_compress(self):
+        uploaded = {}
+
+        def fake_upload_stream(stream, **kwargs):
+            uploaded['data'] = stream.read()
+            uploaded['filename'] = kwargs['filename']
+            uploaded['metadata'] = kwargs['metadata']
+
+        data = b'a,b,c\n1,2,3\n' * 1000
+        metadata = {'tags': ['csv'], 'description': 'Test data',
+                    'md5': 'uncompressedmd5'}
+        with patch('ohapi.api.upload_stream', fake_upload_stream):
+            upload_stream(io.BytesIO(data), filename='data.csv',
+                          metadata=metadata, access_token=ACCESS_TOKEN,
+                          project_member_id=VALID_PMI1, compress='gzip')
+        self.assertEqual(uploaded['filename'], 'data.csv.gz')
+        self.assertEqual(gzip.decompress(uploaded['data']), data)
+        self.assertEqual(uploaded['metadata']['md5'],
+                         hashlib.md5(uploaded['data']).hexdigest())
+        self.assertEqual(metadata['md5'], 'uncompressedmd5')
+
+
+class APITestDeleteFilesBulk(TestCase):
+    """
+    Tests for :func:`delete_files_bulk<ohapi.api.delete_files_bulk>`.
+    """
+
+    def setUp(self):
+        pass
+
+    def _deleted(self, *args, **kwargs):
+        with patch('ohapi.api.delete_file') as mocked_delete_file:
+            delete_files_bulk(ACCESS_TOKEN, *args, **kwargs)
+        return sorted(
+            sorted((k, v) for k, v in call[1].items() if
+                   k not in ('access_token', 'base_url'))
+            for call in mocked_delete_file.call_args_list)
+
+    def test_delete_files_bulk_basenames_and_ids(self):
+        deleted = self._deleted([('12345678', 'a.txt'),
+                                 ('12345678', 1234),
+                                 ('23456789', None)])
+        self.assertEqual(deleted, [
+            [('all_files', True), ('project_member_id', '23456789')],
+            [('file_basename', 'a.txt'), ('project_member_id', '12345678')],
+            [('file_id', 1234), ('project_member_id', '12345678')]])
+
+    def test_delete_files_bulk_collapses_to_all_files(self):
+        member_files = {
+            '12345678': [{'basename': 'a.txt', 'id': 1},
+                         {'basename': 'b.txt', 'id': 2}],
+            '23456789': [{'basename': 'a.txt', 'id': 3},
+                         {'basename': 'b.txt', 'id': 4}],
+        }
+        deleted = self._deleted([('12345678', 'a.txt'), ('12345678', 2),
+                                 ('23456789', 'a.txt')],
+                                member_files=member_files,
+                                allow_all_files=True)
+        self.assertEqual(deleted, [
+            [('all_files', True), ('project_member_id', '12345678')],
+            [('file_basename', 'a.txt'), ('project_member_id', '23456789')]])
+        deleted = self._deleted([('12345678', 'a.txt'), ('12345678', 2)],
+                                member_files=member_files)
+        self.assertEqual(deleted, [
+            [('file_basename', 'a.txt'), ('project_member_id', '12345678')],
+            [('file_id', 2), ('project_member_id', '12345678')]])
+
+
+class APITestAdaptiveLimiter(TestCase):
+    """
+    Tests for :class:`AdaptiveLimiter<ohapi.api.AdaptiveLimiter>`.
+    """
+
+    def test_additive_increase_multiplicative_decrease(self):
+        limiter = AdaptiveLimiter(max_limit=8, initial_limit=2,
+                                  max_latency=1.0)
+        for _ in range(2):
+            limiter.record('success', latency=0.1)
+        self.assertEqual(limiter.limit, 3)
+        limiter.record('success', latency=5.0)
+        limiter.record('error')
+        self.assertEqual(limiter.limit, 3)
+        for _ in range(100):
+            limiter.record('success')
+        self.assertEqual(limiter.limit, 8)
+
+        started = time.monotonic()
+        limiter.record('throttled', started=started)
+        self.assertEqual(limiter.limit, 4)
+        # Calls started before the last decrease don't decrease it again.
+        limiter.record('throttled', started=started)
+        self.assertEqual(limiter.limit, 4)
+        for _ in range(3):
+            limiter.record('throttled')
+        self.assertEqual(limiter.limit, 1)
+        metrics = limiter.metrics()
+        self.assertEqual(metrics['limit'], 1)
+        self.assertEqual(metrics['throttled'], 5)
+        self.assertEqual(metrics['decreases'], 4)
+        self.assertEqual(metrics['failed'], 1)
+        self.assertEqual(metrics['in_flight'], 0)
+        self.assertRaises(ValueError, AdaptiveLimiter, max_limit=0)
+
+    def test_handle_error_reports_to_slot(self):
+        limiter = AdaptiveLimiter(max_limit=4, initial_limit=4)
+        self.assertRaises(Exception, handle_error,
+                          Mock(status_code=429, content=b''), 200)
+        self.assertEqual(limiter.metrics()['throttled'], 0)
+        with limiter.slot():
+            self.assertRaises(Exception, handle_error,
+                              Mock(status_code=503, content=b''), 200)
+        self.assertEqual(limiter.limit, 2)
+        with limiter.slot():
+            handle_error(Mock(status_code=200), 200)
+        self.assertEqual(limiter.metrics()['succeeded'], 1)
+
+    def test_run_concurrently_within_limit(self):
+        limiter = AdaptiveLimiter(max_limit=4, initial_limit=2)
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def call(n):
+            with lock:
+                running.append(n)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(n)
+            return n
+
+        results = _run_concurrently(call, [{'n': n} for n in range(12)],
+                                    limiter=limiter)
+        self.assertEqual(results, list(range(12)))
+        self.assertLessEqual(max(peak), 2)
@@ -1,5 +1,20 @@
 from unittest import TestCase
-from ohapi.projects import OHProject
+from unittest.mock import Mock, patch
+from io import BytesIO
+import copy
+import json
+import operator
+import os
+import pickle
+import shutil
+import tarfile
+import tempfile
+from ohapi.api import AdaptiveLimiter
+from ohapi.projects import (FileRecord, LazyProjectData, OHProject,
+                            compact_member_data, format_created,
+                            iter_member_data, member_shard, parse_created,
+                            parse_shard, select_members)
+from ohapi.utils_fs import MemorySink, iter_archive_files
 import vcr
 
 parameter_defaults = {
@@ -61,6 +76,90 @@ class ProjectsTest(TestCase):
         self.assertEqual(response, {1: {'basename': 1}})
 
 
+class ProjectsTestFileRecord(TestCase):
+    """
+    Tests for :class:`FileRecord<ohapi.projects.FileRecord>`
+
+    """
+
+    def setUp(self):
+        pass
+
+    def test_file_record_dict_access(self):
+        file_data = {'id': 1, 'basename': 'a.txt',
+                     'source': 'direct-sharing-1',
+                     'created': '2018-01-01T00:00:01.500000Z',
+                     'download_url': 'https://example.com/a.txt',
+                     'metadata': {'tags': ['txt']}, 'datatypes': []}
+        record = FileRecord(file_data)
+        self.assertEqual(record, file_data)
+        self.assertEqual(file_data, record)
+        self.assertEqual(record.to_dict(), file_data)
+        # Other fields are decoded for each read.
+        record['metadata']['tags'].append('csv')
+        self.assertEqual(record['metadata'], {'tags': ['txt']})
+        self.assertEqual(record['basename'], 'a.txt')
+        self.assertEqual(record['datatypes'], [])
+        self.assertEqual(record.get('missing'), None)
+        self.assertNotIn('missing', record)
+        self.assertEqual(record.created_ts, 1514764801500000)
+        self.assertRaises(AttributeError, setattr, record, 'basename', 'b')
+        self.assertRaises(TypeError, operator.setitem, record, 'basename',
+                          'b')
+        self.assertEqual(json.loads(json.dumps(record.to_dict())), file_data)
+        self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+        self.assertIsInstance(copy.deepcopy(record), FileRecord)
+        partial = FileRecord({'basename': 'b.txt'})
+        self.assertEqual(dict(partial), {'basename': 'b.txt'})
+        self.assertIsNone(partial.created_ts)
+        self.assertNotIn('created', partial)
+        # Created strings not in the API's format are kept as they were.
+        for created in ('2018-01-01', '2018-01-01T02:00:00+02:00', 'never'):
+            record = FileRecord({'basename': 'b.txt', 'created': created})
+            self.assertEqual(record['created'], created)
+        self.assertEqual(record.created_ts, None)
+        self.assertEqual(
+            FileRecord({'created': '2018-01-01'}).created_ts,
+            FileRecord({'created': '2018-01-01T00:00:00Z'}).created_ts)
+
+    def test_compact_member_data(self):
+        member_data = {'sources_shared': ['direct-sharing-1'],
+                       'data': [{'basename': 'a.txt'}, {'basename': 'b.txt'}]}
+        member_data = compact_member_data(member_data)
+        self.assertTrue(all(isinstance(f, FileRecord) for f in
+                            member_data['data']))
+        self.assertEqual(json.loads(json.dumps(member_data)),
+                         {'sources_shared': ['direct-sharing-1'],
+                          'data': [{'basename': 'a.txt'},
+                                   {'basename': 'b.txt'}]})
+        response = OHProject._get_member_file_data(member_data=member_data)
+        self.assertEqual(set(response), {'a.txt', 'b.txt'})
+
+    def test_get_member_file_data_latest_cached(self):
+        member_data = compact_member_data({'data': [
+            {'id': 1, 'basename': 'a.txt', 'created': '2018-01-02T00:00:00Z'},
+            {'id': 2, 'basename': 'a.txt', 'created': '2018-01-03T00:00:00Z'},
+            {'id': 3, 'basename': 'a.txt', 'created': '2018-01-01T00:00:00Z'},
+            {'id': 4, 'basename': 'b.txt', 'created': '2018-01-01T00:00:00Z'},
+        ]})
+        with patch('ohapi.projects.parse_created',
+                   wraps=parse_created) as mock_parse:
+            response = OHProject._get_member_file_data(member_data)
+            self.assertEqual(response['a.txt']['id'], 2)
+            self.assertEqual(response['b.txt']['id'], 4)
+            self.assertEqual(
+                OHProject._get_member_file_data(member_data, id_filename=True),
+                {'1.a.txt': member_data['data'][0],
+                 '2.a.txt': member_data['data'][1],
+                 '3.a.txt': member_data['data'][2],
+                 '4.b.txt': member_data['data'][3]})
+            self.assertFalse(mock_parse.called)
+        self.assertIn(False, member_data.file_data_cache)
+        member_data['data'] = []
+        self.assertEqual(member_data.file_data_cache, {})
+        self.assertEqual(OHProject._get_member_file_data(member_data), {})
+
+
 class ProjectsTestUpdateData(TestCase):
     """
     Tests for :func:`update_data<ohapi.projects._update_data>`
@@ -83,3 +182,416 @@ class ProjectsTestUpdateData(TestCase):
     @my_vcr.use_cassette
     def test_update_data_invalid_master_access_token(self):
         self.assertRaises(Exception, OHProject, MASTER_ACCESS_TOKEN_INVALID)
+
+
+class ProjectsTestProjectData(TestCase):
+    """
+    Tests for serializing :class:`OHProject<ohapi.projects.OHProject>`
+    project_data
+
+    """
+
+    def setUp(self):
+        pass
+
+    def test_project_data_json(self):
+        members = [{'project_member_id': '01234567', 'file_count': 1,
+                    'sources_shared': [],
+                    'data': [{'id': 1, 'basename': 'a.txt',
+                              'created': '2018-01-31T21:49:38.478718Z',
+                              'metadata': {'md5': 'a' * 32}}]}]
+        with patch('ohapi.projects.iter_member_data',
+                   return_value=iter(copy.deepcopy(members))):
+            ohproject = OHProject(master_access_token=MASTER_ACCESS_TOKEN)
+        self.assertEqual(json.loads(json.dumps(ohproject.project_data)),
+                         {'01234567': members[0]})
+
+
+class ProjectsTestLazy(TestCase):
+    """
+    Tests for :class:`LazyProjectData<ohapi.projects.LazyProjectData>`
+
+    """
+
+    def setUp(self):
+        pass
+
+    def test_lazy_project_loads_members_on_demand(self):
+        member = {'project_member_id': '01234567', 'file_count': 1,
+                  'data': [{'basename': 'a.txt'}]}
+        with patch('ohapi.projects.iter_pages') as mock_pages, \
+                patch('ohapi.projects.exchange_oauth2_member',
+                      return_value=member) as mock_exchange:
+            ohproject = OHProject(master_access_token=MASTER_ACCESS_TOKEN,
+                                  lazy=True)
+            self.assertIsInstance(ohproject.project_data, LazyProjectData)
+            self.assertEqual(ohproject.project_data['01234567'], member)
+            self.assertEqual(ohproject.project_data['01234567'], member)
+            mock_exchange.assert_called_once_with(
+                MASTER_ACCESS_TOKEN, project_member_id='01234567')
+            self.assertFalse(mock_pages.called)
+
+    def test_lazy_project_members_list(self):
+        pages = [
+            {'next': 'page2', 'results': [
+                {'project_member_id': '01234567', 'file_count': 1,
+                 'data': [{'basename': 'a.txt'}]}]},
+            {'next': None, 'results': [
+                {'project_member_id': '12345678', 'file_count': 2,
+                 'data': [{'basename': 'a.txt'}]}]}]
+        full_member = dict(pages[1]['results'][0],
+                           data=[{'basename': 'a.txt'},
+                                 {'basename': 'b.txt'}])
+        with patch('ohapi.projects.iter_pages',
+                   return_value=iter(pages)) as mock_pages, \
+                patch('ohapi.projects.exchange_oauth2_member',
+                      return_value=full_member) as mock_exchange:
+            project_data = LazyProjectData(MASTER_ACCESS_TOKEN)
+            self.assertIn('12345678', project_data)
+            self.assertNotIn('23456789', project_data)
+            self.assertEqual(list(project_data), ['01234567', '12345678'])
+            self.assertEqual(list(project_data.keys()),
+                             ['01234567', '12345678'])
+            self.assertEqual(len(project_data), 2)
+            self.assertEqual(mock_pages.call_count, 1)
+            # Membership and keys come from the IDs alone, without keeping
+            # any member's file data.
+            self.assertEqual(project_data._member_data, {})
+            self.assertFalse(mock_exchange.called)
+            self.assertRaises(KeyError, project_data.__getitem__, '23456789')
+            self.assertFalse(mock_exchange.called)
+            self.assertEqual(project_data['12345678'], full_member)
+            self.assertEqual(mock_exchange.call_count, 1)
+
+    def test_lazy_project_unknown_member(self):
+        pages = [{'next': None, 'results': [
+            {'project_member_id': '01234567', 'file_count': 1,
+             'data': [{'basename': 'a.txt'}]}]}]
+        with patch('ohapi.projects.iter_pages', return_value=pages), \
+                patch('ohapi.projects.exchange_oauth2_member',
+                      side_effect=Exception('API response status code 400')):
+            project_data = LazyProjectData(MASTER_ACCESS_TOKEN)
+            self.assertRaises(KeyError, project_data.__getitem__, '23456789')
+            self.assertIsNone(project_data.get('34567890'))
+        with patch('ohapi.projects.iter_pages', return_value=pages), \
+                patch('ohapi.projects.exchange_oauth2_member',
+                      side_effect=Exception('API response status code 500')):
+            project_data = LazyProjectData(MASTER_ACCESS_TOKEN)
+            # Members that exist don't hide other errors.
+            self.assertRaises(Exception, project_data.__getitem__, '01234567')
+            self.assertRaises(Exception, project_data.get, '01234567')
+
+
+class ProjectsTestIterFiles(TestCase):
+    """
+    Tests for :func:`iter_files<ohapi.projects.OHProject.iter_files>`
+
+    """
+
+    def setUp(self):
+        members = [
+            {'project_member_id': '01234567', 'file_count': 2,
+             'sources_shared': ['direct-sharing-1'],
+             'data': [
+                 {'id': 1, 'basename': 'a.vcf.gz',
+                  'source': 'direct-sharing-1',
+                  'created': '2018-01-01T00:00:00Z',
+                  'download_url': 'https://example.com/a.vcf.gz'},
+                 {'id': 2, 'basename': 'b.json', 'source': 'direct-sharing-2',
+                  'created': '2018-02-01T00:00:00Z'}]},
+            {'project_member_id': '12345678', 'file_count': 1,
+             'sources_shared': ['direct-sharing-1'],
+             'data': [
+                 {'id': 3, 'basename': 'c.vcf.gz',
+                  'source': 'direct-sharing-1',
+                  'created': '2018-03-01T00:00:00Z',
+                  'download_url': 'https://example.com/c.vcf.gz'}]}]
+        with patch('ohapi.projects.iter_member_data', return_value=members):
+            self.project = OHProject(master_access_token=MASTER_ACCESS_TOKEN)
+
+    def _ids(self, **kwargs):
+        return sorted(datafile['id'] for _, datafile in
+                      self.project.iter_files(**kwargs))
+
+    def test_iter_files(self):
+        self.assertEqual(self._ids(), [1, 2, 3])
+        self.assertEqual(self._ids(source='direct-sharing-1'), [1, 3])
+        self.assertEqual(self._ids(basename_glob='*.vcf.gz'), [1, 3])
+        self.assertEqual(self._ids(basename_glob='b.json'), [2])
+        self.assertEqual(self._ids(created_after='2018-01-15'), [2, 3])
+        self.assertEqual(self._ids(members=['12345678']), [3])
+        self.assertEqual(self._ids(shared=False), [2])
+        self.assertEqual(self._ids(source='direct-sharing-1',
+                                   created_after='2018-02-01',
+                                   members=['01234567', '12345678']), [3])
+        self.assertEqual(self._ids(members=['23456789']), [])
+
+    def test_created_parsed_once(self):
+        created_after = parse_created('2018-01-15')
+        member_data = self.project.project_data['01234567']
+        with patch('ohapi.projects.parse_created') as mock_parse:
+            self.assertEqual(self._ids(created_after=created_after), [2, 3])
+            self.assertEqual(format_created(self.project.latest_created()),
+                             '2018-03-01T00:00:00+00:00')
+            self.assertEqual(format_created(self.project.latest_created(
+                members=['01234567'])), '2018-02-01T00:00:00+00:00')
+            self.assertEqual(
+                list(OHProject._get_member_file_data(
+                    member_data, created_after=created_after)), ['b.json'])
+            self.assertFalse(mock_parse.called)
+
+    def test_parse_created(self):
+        self.assertEqual(parse_created('2018-01-31T21:49:38.478718Z'),
+                         1517435378478718)
+        self.assertEqual(parse_created('2018-01-31T21:49:38.5+00:00'),
+                         1517435378500000)
+        # Other formats and out of range fields are parsed by arrow.
+        self.assertEqual(parse_created('2018-01-31T24:00:00Z'),
+                         parse_created('2018-02-01'))
+        self.assertIsNone(parse_created('2018-02-30T00:00:00Z'))
+        self.assertIsNone(parse_created(None))
+
+    def test_download_all_sink(self):
+        sink = MemorySink()
+        with patch('ohapi.projects.download_file') as mock_download:
+            self.project.download_all('', source='direct-sharing-1',
+                                      sink=sink)
+        self.assertEqual(
+            sorted(call[1]['target_filepath'] for call in
+                   mock_download.call_args_list),
+            [os.path.join('01234567', 'a.vcf.gz'),
+             os.path.join('12345678', 'c.vcf.gz')])
+        self.assertTrue(all(call[1]['sink'] is sink for call in
+                            mock_download.call_args_list))
+
+    def test_download_all_file_index(self):
+        # Members without a matching file in the index are never looked at.
+        with patch('ohapi.projects.download_file') as mock_download, \
+                patch.object(OHProject, '_member_shared_downloads',
+                             wraps=OHProject._member_shared_downloads) as \
+                mock_downloads:
+            self.project.download_all('', source='direct-sharing-1',
+                                      created_after='2018-02-15',
+                                      sink=MemorySink())
+            self.assertEqual(
+                [call[1]['member_data']['project_member_id'] for call in
+                 mock_downloads.call_args_list], ['12345678'])
+            mock_downloads.reset_mock()
+            self.project.download_all('', source='direct-sharing-2',
+                                      sink=MemorySink())
+            self.assertFalse(mock_downloads.called)
+        self.assertEqual(
+            [call[1]['target_filepath'] for call in
+             mock_download.call_args_list],
+            [os.path.join('12345678', 'c.vcf.gz')])
+
+    def test_download_all_limiter(self):
+        limiter = AdaptiveLimiter(max_limit=2)
+        with patch('ohapi.projects.download_file') as mock_download:
+            self.assertRaises(ValueError, self.project.download_all, '',
+                              sink=MemorySink(), limiter=limiter)
+            target_dir = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, target_dir)
+            self.project.download_all(target_dir, source='direct-sharing-1',
+                                      limiter=limiter)
+        self.assertEqual(
+            sorted(call[1]['target_filepath'] for call in
+                   mock_download.call_args_list),
+            [os.path.join(target_dir, '01234567', 'a.vcf.gz'),
+             os.path.join(target_dir, '12345678', 'c.vcf.gz')])
+        self.assertEqual(limiter.metrics()['in_flight'], 0)
+
+    def test_download_all_failures(self):
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+        failed_path = os.path.join(target_dir, '01234567', 'a.vcf.gz')
+        error = ValueError('MD5 mismatch')
+
+        def download(target_filepath, **kwargs):
+            if target_filepath == failed_path:
+                raise error
+
+        for limiter in (None, AdaptiveLimiter(max_limit=2)):
+            with patch('ohapi.projects.download_file',
+                       side_effect=download) as mock_download:
+                failures = self.project.download_all(
+                    target_dir, source='direct-sharing-1', limiter=limiter)
+            # The other member's file is still downloaded.
+            self.assertEqual(mock_download.call_count, 2)
+            self.assertEqual(failures, [(failed_path, error)])
+
+    def test_download_all_created_after(self):
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+        with patch('ohapi.projects.download_file') as mock_download:
+            self.project.download_all(target_dir,
+                                      created_after='2018-02-15')
+        self.assertEqual(
+            [call[1]['target_filepath'] for call in
+             mock_download.call_args_list],
+            [os.path.join(target_dir, '12345678', 'direct-sharing-1',
+                          'c.vcf.gz')])
+        self.assertEqual(os.listdir(target_dir), ['12345678'])
+        self.assertEqual(format_created(self.project.latest_created()),
+                         '2018-03-01T00:00:00+00:00')
+        self.assertEqual(format_created(self.project.latest_created(
+            members=['01234567'])), '2018-02-01T00:00:00+00:00')
+
+
+class ProjectsTestUploadMemberFiles(TestCase):
+    """
+    Tests for :func:`upload_member_files
+    <ohapi.projects.OHProject.upload_member_files>`
+    """
+
+    def setUp(self):
+        self.member_data = {
+            'project_member_id': '01234567',
+            'sources_shared': ['direct-sharing-1'],
+            'data': [{'id': 1, 'basename': 'a.txt',
+                      'source': 'direct-sharing-2',
+                      'download_url': 'https://example.com/a.txt'}]}
+
+    def test_upload_member_files(self):
+        files = [('a.txt', 1514764800, BytesIO(b'a')),
+                 ('b.txt', 1514764800, BytesIO(b'b'))]
+        with patch('ohapi.projects.upload_stream') as mock_upload:
+            OHProject.upload_member_files(self.member_data, iter(files),
+                                          None, 'token', mode='safe')
+        self.assertEqual(mock_upload.call_count, 1)
+        kwargs = mock_upload.call_args[1]
+        self.assertEqual(kwargs['filename'], 'b.txt')
+        self.assertTrue(kwargs['set_md5'])
+        self.assertEqual(kwargs['metadata']['creation_date'],
+                         '2018-01-01T00:00:00+00:00')
+
+        metadata = {'a.txt': {'tags': [], 'description': ''}}
+        with patch('ohapi.projects.upload_stream') as mock_upload:
+            self.assertRaises(ValueError, OHProject.upload_member_files,
+                              self.member_data, iter(files), metadata,
+                              'token')
+        self.assertEqual(mock_upload.call_count, 1)
+        metadata['c.txt'] = metadata['b.txt'] = metadata['a.txt']
+        with patch('ohapi.projects.upload_stream') as mock_upload, \
+                patch('ohapi.projects.delete_files_bulk') as mock_delete:
+            self.assertRaises(ValueError, OHProject.upload_member_files,
+                              self.member_data, iter(files), metadata,
+                              'token', mode='sync')
+        self.assertEqual(mock_upload.call_count, 2)
+        self.assertFalse(mock_delete.called)
+
+    def test_upload_member_files_from_tar(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        tar_path = os.path.join(tempdir, 'files.tar.gz')
+        with tarfile.open(tar_path, 'w:gz') as archive:
+            tarinfo = tarfile.TarInfo('b.txt')
+            tarinfo.size = 10
+            archive.addfile(tarinfo, BytesIO(b'some stuff'))
+        files = ((filename, mtime, fileobj) for
+                 _, filename, _, mtime, fileobj in
+                 iter_archive_files(tar_path))
+        uploaded = []
+
+        def put(url, data, timeout=None):
+            uploaded.append(data.read())
+            return Mock(status_code=200)
+
+        with patch('ohapi.api.requests.post', side_effect=[
+                Mock(status_code=201, json=lambda: {'url': 'https://s3/',
+                                                    'id': 2}),
+                Mock(status_code=200)]) as mock_post, \
+                patch('ohapi.api.requests.put', side_effect=put):
+            OHProject.upload_member_files(self.member_data, files, None,
+                                          'token')
+        self.assertEqual(uploaded, [b'some stuff'])
+        self.assertEqual(
+            mock_post.call_args_list[0][1]['data']['filename'], 'b.txt')
+
+    def test_upload_member_from_dir_sync_keeps_new_files(self):
+        member_data = {
+            'project_member_id': '01234567',
+            'sources_shared': [],
+            'data': [{'id': 1, 'basename': 'old.csv',
+                      'source': 'direct-sharing-1',
+                      'download_url': 'https://example.com/old.csv'}]}
+        target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target_dir)
+        with open(os.path.join(target_dir, 'new.csv'), 'w') as f:
+            f.write('some stuff')
+        with patch('ohapi.projects.upload_aws') as mock_upload, \
+                patch('ohapi.api.delete_file') as mock_delete:
+            OHProject.upload_member_from_dir(member_data, target_dir, None,
+                                             'token', mode='sync')
+        self.assertEqual(mock_upload.call_args[1]['target_filepath'],
+                         os.path.join(target_dir, 'new.csv'))
+        # old.csv was the only remote file, but new.csv was just uploaded,
+        # so old.csv is deleted by name rather than with all_files.
+        self.assertEqual(mock_delete.call_count, 1)
+        self.assertEqual(mock_delete.call_args[1]['file_basename'],
+                         'old.csv')
+        self.assertNotIn('all_files', mock_delete.call_args[1])
+
+
+class ProjectsTestSelectMembers(TestCase):
+    """
+    Tests for :func:`select_members<ohapi.projects.select_members>`
+
+    """
+
+    def test_select_members_shards(self):
+        member_ids = ['{:08d}'.format(i) for i in range(200)]
+        shards = [list(select_members(member_ids, shard='{}/3'.format(k)))
+                  for k in (1, 2, 3)]
+        self.assertEqual(sorted(sum(shards, [])), member_ids)
+        self.assertTrue(all(shards))
+        self.assertEqual(shards[1], list(select_members(member_ids,
+                                                        shard=(2, 3))))
+        self.assertEqual(member_shard('01234567', 3),
+                         member_shard('01234567', 3))
+        selected = list(select_members(
+            member_ids, memberlist=member_ids[:10],
+            excludelist=[member_ids[0]], shard='1/1'))
+        self.assertEqual(selected, member_ids[1:10])
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard(' 2/4 '), (2, 4))
+        self.assertRaises(ValueError, parse_shard, '0/4')
+        self.assertRaises(ValueError, parse_shard, '5/4')
+        self.assertRaises(ValueError, parse_shard, 'two')
+
+
+class ProjectsTestIterMemberData(TestCase):
+    """
+    Tests for :func:`iter_member_data<ohapi.projects.iter_member_data>`
+
+    """
+
+    def setUp(self):
+        pass
+
+    def test_iter_member_data(self):
+        pages = {
+            'members2': {'next': None, 'results': [
+                {'project_member_id': '23456789', 'file_count': 0,
+                 'data': []}]},
+            'exchange1': {'next': 'exchange1b',
+                          'data': [{'basename': 'a.txt'}]},
+            'exchange1b': {'next': None, 'data': [{'basename': 'b.txt'}]},
+        }
+        first_page = {'next': 'members2', 'results': [
+            {'project_member_id': '01234567', 'file_count': 2,
+             'data': [{'basename': 'a.txt'}],
+             'exchange_member': 'exchange1'},
+            {'project_member_id': '12345678', 'file_count': 1,
+             'data': [{'basename': 'c.txt'}]}]}
+        with patch('ohapi.api.get_page', side_effect=lambda url: (
+                first_page if 'members/' in url else pages[url])), \
+                patch('ohapi.projects.get_page',
+                      side_effect=lambda url: pages[url]):
+            members = list(iter_member_data(MASTER_ACCESS_TOKEN,
+                                            max_workers=2))
+        self.assertEqual([m['project_member_id'] for m in members],
+                         ['01234567', '12345678', '23456789'])
+        self.assertEqual([f['basename'] for f in members[0]['data']],
+                         ['a.txt', 'b.txt'])
@@ -0,0 +1,150 @@
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+import json
+import os
+import shutil
+import tempfile
+
+from ohapi.projects import compact_member_data
+from ohapi.sync import (SyncPlan, add_download_sizes, execute_plan,
+                        plan_member_download, plan_upload, remote_file_size)
+
+MEMBER_DATA = {
+    'project_member_id': '01234567',
+    'sources_shared': ['direct-sharing-1'],
+    'data': [
+        {'id': 1, 'basename': 'a.txt', 'source': 'direct-sharing-1',
+         'created': '2018-01-01T00:00:00Z',
+         'download_url': 'https://example.com/a.txt',
+         'metadata': {'md5': 'beb6a43adfb950ec6f82ceed19beee21'}},
+        {'id': 2, 'basename': 'b.txt', 'source': 'direct-sharing-1',
+         'created': '2018-01-01T00:00:00Z',
+         'download_url': 'https://example.com/b.txt', 'metadata': {}},
+        {'id': 3, 'basename': 'f1.txt', 'source': 'direct-sharing-2',
+         'created': '2018-01-01T00:00:00Z',
+         'download_url': 'https://example.com/f1.txt', 'metadata': {}},
+        {'id': 4, 'basename': 'old.txt', 'source': 'direct-sharing-2',
+         'created': '2018-01-01T00:00:00Z',
+         'download_url': 'https://example.com/old.txt', 'metadata': {}},
+    ]}
+
+
+class SyncTest(TestCase):
+    """
+    Tests for :mod:`ohapi.sync`.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.member_data = compact_member_data(dict(MEMBER_DATA))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_plan_member_download(self):
+        source_dir = os.path.join(self.tempdir, 'direct-sharing-1')
+        os.mkdir(source_dir)
+        path = os.path.join(source_dir, 'a.txt')
+        with open(path, 'w') as f:
+            f.write('some stuff')
+        manifest_records = {path: {'filepath': path, 'size': 10,
+                                   'md5': 'beb6a43adfb950ec6f82ceed19beee21'}}
+        plan = plan_member_download(self.member_data, self.tempdir,
+                                    manifest_records=manifest_records)
+        self.assertEqual([(a.action, a.filename) for a in plan],
+                         [('skip', 'a.txt'), ('download', 'b.txt')])
+        self.assertEqual(plan.actions[1].path,
+                         os.path.join(source_dir, 'b.txt'))
+
+        with patch('ohapi.sync.remote_file_size', side_effect=[10 ** 9]):
+            sized = add_download_sizes(plan, max_size='128m')
+        self.assertEqual(sized.actions[1].action, 'skip')
+        self.assertEqual(sized.actions[1].reason, 'exceeds maximum size')
+
+        with patch('ohapi.sync.remote_file_size', side_effect=[None]):
+            sized = add_download_sizes(plan, max_size='128m')
+        self.assertEqual(sized.actions[1].action, 'download')
+        self.assertIsNone(sized.actions[1].size)
+        self.assertIn('unknown size', sized.format())
+
+        plan = plan_member_download(self.member_data, self.tempdir,
+                                    project_data=True)
+        self.assertEqual(sorted(a.filename for a in plan),
+                         ['f1.txt', 'old.txt'])
+
+    def test_remote_file_size(self):
+        response = MagicMock(status_code=200,
+                             headers={'Content-Length': '446'})
+        with patch('ohapi.sync.requests.get', return_value=response):
+            self.assertEqual(remote_file_size('https://example.com/a'), 446)
+        self.assertTrue(response.close.called)
+
+        response = MagicMock(status_code=200, headers={})
+        with patch('ohapi.sync.requests.get', return_value=response):
+            self.assertIsNone(remote_file_size('https://example.com/a'))
+
+        response = MagicMock(status_code=403, headers={},
+                             content=b'Forbidden')
+        with patch('ohapi.sync.requests.get', return_value=response):
+            self.assertRaises(Exception, remote_file_size,
+                              'https://example.com/a')
+        self.assertTrue(response.close.called)
+
+    def test_plan_upload(self):
+        with open(os.path.join(self.tempdir, 'f1.txt'), 'w') as f:
+            f.write('some stuff')
+        metadata = {'f1.txt': {'tags': ['txt'], 'description': 'File 1'}}
+        plan = plan_upload(self.member_data, self.tempdir, metadata,
+                           mode='sync')
+        self.assertEqual([(a.action, a.filename, a.size) for a in plan],
+                         [('upload', 'f1.txt', 10),
+                          ('delete', 'old.txt', None)])
+        self.assertEqual(plan.actions[0].details['remote_file_info'],
+                         {'download_url': 'https://example.com/f1.txt'})
+        totals = plan.totals()
+        self.assertEqual(totals['upload'], {'count': 1, 'bytes': 10,
+                                            'unknown': 0})
+        self.assertIn('upload: 1 files, 10 bytes', plan.format())
+
+        plan = plan_upload(self.member_data, self.tempdir, None,
+                           mode='safe', compress='gzip')
+        self.assertEqual([(a.action, a.filename) for a in plan],
+                         [('upload', 'f1.txt.gz')])
+        self.assertTrue(plan.actions[0].details['set_md5'])
+
+    def test_plan_serialization(self):
+        plan = SyncPlan()
+        plan.add('download', '01234567', 'a.txt', '/tmp/a.txt', 100,
+                 download_url='https://example.com/a.txt', md5=None)
+        plan.add('delete', '01234567', 'b.txt', reason='not local')
+        plan.add('download', '01234567', 'c.txt', '/tmp/c.txt', 200,
+                 download_url='https://example.com/c.txt', md5=None)
+        loaded = SyncPlan.from_json(plan.to_json())
+        self.assertEqual(loaded.actions, plan.actions)
+        self.assertEqual(json.loads(plan.to_json())[1]['action'], 'delete')
+        self.assertEqual([a.filename for a in plan.sorted_by_size()],
+                         ['c.txt', 'a.txt', 'b.txt'])
+        plan.check_disk_space(self.tempdir)
+        with patch('ohapi.sync.shutil.disk_usage') as mock_disk_usage:
+            mock_disk_usage.return_value.free = 250
+            self.assertRaises(ValueError, plan.check_disk_space,
+                              self.tempdir)
+
+    def test_execute_plan(self):
+        plan = SyncPlan()
+        path = os.path.join(self.tempdir, 'new', 'a.txt')
+        plan.add('download', '01234567', 'a.txt', path, 10,
+                 download_url='https://example.com/a.txt', md5=None)
+        plan.add('skip', '01234567', 'b.txt', reason='exists')
+        plan.add('delete', '01234567', 'old.txt')
+        self.assertRaises(ValueError, execute_plan, plan)
+        with patch('ohapi.sync.download_file', return_value='downloaded') \
+                as mock_download, \
+                patch('ohapi.sync.delete_files_bulk',
+                      return_value=['deleted']) as mock_delete:
+            results = execute_plan(plan, access_token='token')
+        self.assertEqual(results, ['downloaded', 'deleted'])
+        self.assertTrue(os.path.isdir(os.path.dirname(path)))
+        self.assertEqual(mock_download.call_args[1]['target_filepath'], path)
+        self.assertEqual(mock_delete.call_args[1]['targets'],
+                         [('01234567', 'old.txt')])
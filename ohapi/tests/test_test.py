@@ -1,14 +1,28 @@
 from unittest import TestCase
-from unittest.mock import mock_open, patch
+from unittest.mock import Mock, mock_open, patch
 import arrow
+import hashlib
+import json
 import os
+import shutil
+import tarfile
+import tempfile
+import time
 import vcr
-from posix import stat_result
-import stat
-from io import StringIO
-from ohapi.utils_fs import (guess_tags, load_metadata_csv,
+import zipfile
+from io import BytesIO, StringIO
+from ohapi.utils_fs import (HashCache, LazyMultiUserMetadata, MetadataError,
+                            guess_tags,
+                            find_metadata_errors, validate_date,
+                            _is_iso8601_date,
+                            load_metadata_csv,
                             validate_metadata, characterize_local_files,
-                            read_id_list, download_file,
+                            read_id_list, read_delete_targets,
+                            read_download_state, write_download_state,
+                            review_metadata_csv,
+                            describe_local_files, download_file,
+                            MemorySink, open_sink, iter_archive_files,
+                            mk_metadata_csv,
                             write_metadata_to_filestream)
 from humanfriendly import parse_size
 
@@ -100,6 +114,35 @@ class UtilsTest(TestCase):
                                            'metadata_proj_file_key_works.csv')
         self.assertEqual(len(metadata_files.keys()), 2)
 
+    def test_load_metadata_csv_lazy(self):
+        """
+        Tests for :class:`LazyMultiUserMetadata
+        <ohapi.utils_fs.LazyMultiUserMetadata>`
+
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            csv_path = os.path.join(tempdir, 'metadata.csv')
+            with open(csv_path, 'w') as f:
+                f.write('project_member_id,filename,tags,description\n'
+                        '12345678,a.json,"json, data",First\n'
+                        '23456789,a.json,json,"Multi\nline"\n'
+                        '12345678,b.json,json,Second\n'
+                        '34567890,None,NA,NA\n')
+            eager = load_metadata_csv(csv_path)
+            lazy = load_metadata_csv(csv_path, lazy=True)
+            self.assertIsInstance(lazy, LazyMultiUserMetadata)
+            self.assertEqual(list(lazy), ['12345678', '23456789', '34567890'])
+            self.assertEqual(dict(lazy), eager)
+            self.assertTrue(os.path.exists(csv_path + '.idx'))
+            with patch.object(LazyMultiUserMetadata,
+                              '_build_index') as mocked_build_index:
+                reloaded = LazyMultiUserMetadata(csv_path)
+                self.assertFalse(mocked_build_index.called)
+            self.assertEqual(reloaded['23456789'], eager['23456789'])
+        finally:
+            shutil.rmtree(tempdir)
+
     def test_validate_metadata(self):
         """
         Tests for :func:`validate_metadata<ohapi.utils_fs.validate_metadata>`
@@ -109,6 +152,92 @@ class UtilsTest(TestCase):
         metadata = {'file_1.json', 'file_2.json'}
         self.assertEqual(validate_metadata(directory, metadata), True)
 
+    def test_review_metadata_csv_collects_all_errors(self):
+        """
+        Tests for :func:`review_metadata_csv
+        <ohapi.utils_fs.review_metadata_csv>`
+
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            filedir = os.path.join(tempdir, 'files')
+            os.mkdir(filedir)
+            for filename in ['file_1.json', 'file_2.json', 'extra.json']:
+                open(os.path.join(filedir, filename), 'w').close()
+            csv_path = os.path.join(tempdir, 'metadata.csv')
+            with open(csv_path, 'w') as f:
+                f.write('filename,tags,description,md5\n'
+                        'file_1.json,json,First,'
+                        'd41d8cd98f00b204e9800998ecf8427e\n'
+                        'file_2.json,json,Second,notanmd5\n'
+                        'missing.json,json,Missing,'
+                        'd41d8cd98f00b204e9800998ecf8427e\n'
+                        'short.json,json\n')
+            with patch('sys.stdout', new_callable=StringIO) as stdout:
+                self.assertFalse(review_metadata_csv(filedir, csv_path))
+            output = stdout.getvalue()
+            self.assertIn('In row number 5', output)
+            self.assertIn('extra.json present at', output)
+            self.assertIn('missing.json present in metadata file', output)
+            self.assertIn('Invalid MD5 specified', output)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_validate_date(self):
+        """
+        Tests for :func:`validate_date<ohapi.utils_fs.validate_date>`
+
+        """
+        for date in ['2017-06-11T06:57:19.694165+00:00', '2017-06-11',
+                     '2017-06-11 06:57', '2017-06-11T06:57:19Z',
+                     '2017-06-11T24:00', '2017-06-11T06:57+14:00',
+                     '2017-06-11T06:57-12:00']:
+            self.assertTrue(validate_date(date, None, None))
+        for date in ['2017-13-01', '2017-02-30', 'yesterday', '',
+                     '2017-06-11T24:30', '2017-06-11T24:00:01',
+                     '2017-06-11T06:57:60', '2017-06-11T06:57+24:00']:
+            self.assertFalse(validate_date(date, None, None))
+        # Edge values are always checked by arrow, common forms aren't.
+        _is_iso8601_date.cache_clear()
+        with patch('ohapi.utils_fs.arrow.get',
+                   side_effect=ValueError) as mock_get:
+            self.assertTrue(validate_date('2017-06-11T06:57Z', None, None))
+            self.assertFalse(mock_get.called)
+            for date in ['2017-06-11T24:00', '2017-06-11T06:57+15:00',
+                         '2017-06-11T06:57+14:30']:
+                self.assertFalse(validate_date(date, None, None))
+            self.assertEqual(mock_get.call_count, 3)
+        _is_iso8601_date.cache_clear()
+
+    def test_find_metadata_errors(self):
+        """
+        Tests for :func:`find_metadata_errors
+        <ohapi.utils_fs.find_metadata_errors>`
+
+        """
+        valid = {'description': '', 'tags': [], 'md5':
+                 'd41d8cd98f00b204e9800998ecf8427e',
+                 'creation_date': '2017-06-11T06:57:19.694165+00:00'}
+        records = [
+            ('12345678', 'ok.json', valid),
+            ('1234', 'bad_id.json', valid),
+            ('12345678', 'bad_fields.json', {
+                'tags': 'json', 'md5': 'abc', 'creation_date': 'yesterday'}),
+        ]
+        errors = find_metadata_errors(records, batch_size=2)
+        self.assertEqual(
+            [(e.filename, e.field) for e in errors],
+            [('bad_id.json', 'project_member_id'),
+             ('bad_fields.json', 'description'),
+             ('bad_fields.json', 'tags'),
+             ('bad_fields.json', 'creation_date'),
+             ('bad_fields.json', 'md5')])
+        self.assertEqual(
+            str(MetadataError('12345678', 'f.json', 'md5',
+                              'Invalid MD5 specified')),
+            'Error: for project member id:  12345678  and filename:  '
+            'f.json  Invalid MD5 specified')
+
     def test_read_id_list_filepath_not_given(self):
         """
         Tests for :func:`read_id_list<ohapi.utils_fs.read_id_list>`
@@ -128,97 +257,379 @@ class UtilsTest(TestCase):
         response = read_id_list(filepath=FILEPATH)
         self.assertEqual(response, ['12345678'])
 
+    def test_read_delete_targets(self):
+        """
+        Tests for :func:`read_delete_targets
+        <ohapi.utils_fs.read_delete_targets>`
+
+        """
+        response = read_delete_targets('ohapi/tests/data/delete_targets.csv')
+        self.assertEqual(response, [('12345678', 'data.json'),
+                                    ('12345678', 1234),
+                                    ('23456789', None)])
+
+    def test_download_state(self):
+        """
+        Tests for :func:`read_download_state
+        <ohapi.utils_fs.read_download_state>` and :func:`write_download_state
+        <ohapi.utils_fs.write_download_state>`
+
+        """
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        state_file = os.path.join(tempdir, 'state.json')
+        self.assertEqual(read_download_state(state_file), {})
+        write_download_state(state_file, {'since': '2018-03-01T00:00:00'})
+        write_download_state(state_file, {'since': '2018-04-01T00:00:00'})
+        self.assertEqual(read_download_state(state_file),
+                         {'since': '2018-04-01T00:00:00'})
+        self.assertEqual(os.listdir(tempdir), ['state.json'])
+
     @my_vcr.use_cassette()
     def test_download_file_valid_url(self):
         """
         Tests for :func:`download_file<ohapi.utils_fs.download_file>`
 
         """
-        with patch('ohapi.utils_fs.open', mock_open(), create=True):
+        with patch('ohapi.utils_fs.open', mock_open(), create=True), \
+                patch('ohapi.utils_fs.os.replace'):
             FILEPATH = 'ohapi/tests/data/test_download_dir/test_download_file'
             DOWNLOAD_URL = 'http://www.loremipsum.de/downloads/version1.txt'
             response = download_file(
                 download_url=DOWNLOAD_URL, target_filepath=FILEPATH)
             self.assertEqual(response.status_code, 200)
 
+    def test_download_file_digests(self):
+        """
+        Tests for :func:`download_file<ohapi.utils_fs.download_file>`
+
+        """
+        content = b'some stuff'
+        response = Mock(status_code=200,
+                        headers={'Content-Length': str(len(content))})
+        response.iter_content.return_value = [content[:4], content[4:]]
+        tempdir = tempfile.mkdtemp()
+        try:
+            target = os.path.join(tempdir, 'f1.txt')
+            manifest = os.path.join(tempdir, 'manifest.jsonl')
+            with patch('ohapi.utils_fs.requests.get',
+                       return_value=response) as mock_get:
+                download_file('https://example.com/f1.txt', target,
+                              md5='beb6a43adfb950ec6f82ceed19beee21',
+                              sha256=True, manifest=manifest, timeout=5)
+                self.assertEqual(mock_get.call_args[1]['timeout'], 5)
+                with open(target, 'rb') as f:
+                    self.assertEqual(f.read(), content)
+                with open(manifest) as f:
+                    record = json.loads(f.readline())
+                self.assertEqual(record['filepath'], target)
+                self.assertEqual(record['size'], len(content))
+                self.assertEqual(record['md5'],
+                                 'beb6a43adfb950ec6f82ceed19beee21')
+                self.assertEqual(record['sha256'],
+                                 hashlib.sha256(content).hexdigest())
+                os.remove(target)
+                self.assertRaises(ValueError, download_file,
+                                  'https://example.com/f1.txt', target,
+                                  md5='d41d8cd98f00b204e9800998ecf8427e')
+                self.assertFalse(os.path.exists(target))
+                self.assertEqual(os.listdir(tempdir), ['manifest.jsonl'])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_download_file_sinks(self):
+        """
+        Tests for :func:`download_file<ohapi.utils_fs.download_file>` with
+        :func:`open_sink<ohapi.utils_fs.open_sink>` sinks
+
+        """
+        content = b'some stuff'
+
+        def get(url, stream=True, timeout=None):
+            response = Mock(status_code=200,
+                            headers={'Content-Length': str(len(content))})
+            response.iter_content.return_value = [content[:4], content[4:]]
+            return response
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        with patch('ohapi.utils_fs.requests.get', side_effect=get):
+            tar_path = os.path.join(tempdir, 'files.tar.gz')
+            with open_sink(tar_path) as sink:
+                download_file('https://example.com/f1.txt',
+                              os.path.join('01234567', 'f1.txt'), sink=sink)
+                f1_path = os.path.join('01234567', 'f1.txt')
+                self.assertTrue(sink.exists(f1_path, len(content)))
+                self.assertFalse(sink.exists(f1_path, len(content) + 1))
+                # The archive only appears once it's complete.
+                self.assertFalse(os.path.exists(tar_path))
+            with tarfile.open(tar_path) as archive:
+                self.assertEqual(archive.getnames(), ['01234567/f1.txt'])
+                self.assertEqual(
+                    archive.extractfile('01234567/f1.txt').read(), content)
+
+            # An invalid file fails the archive before it's all written.
+            for path in (os.path.join(tempdir, 'invalid.tar.gz'),
+                         os.path.join(tempdir, 'invalid.zip')):
+                with open_sink(path) as sink:
+                    download_file('https://example.com/f1.txt', 'f1.txt',
+                                  sink=sink)
+                    self.assertRaises(ValueError, download_file,
+                                      'https://example.com/f2.txt', 'f2.txt',
+                                      md5='d41d8cd98f00b204e9800998ecf8427e',
+                                      sink=sink)
+                    self.assertIsInstance(sink.error, ValueError)
+                    self.assertFalse(sink.exists('f2.txt', len(content)))
+                    self.assertRaises(IOError, download_file,
+                                      'https://example.com/f1.txt', 'f3.txt',
+                                      sink=sink)
+                self.assertFalse(os.path.exists(path))
+                self.assertTrue(os.path.exists(path + '.incomplete'))
+                os.remove(path + '.incomplete')
+
+            def broken_chunks(chunk_size=8192):
+                yield content[:4]
+                raise IOError('Connection reset')
+
+            broken_response = get('https://example.com/f3.txt')
+            broken_response.iter_content.side_effect = broken_chunks
+            with patch('ohapi.utils_fs.requests.get',
+                       return_value=broken_response):
+                with open_sink(os.path.join(tempdir, 'broken.tar')) as sink:
+                    self.assertIsNone(sink.error)
+                    self.assertRaises(IOError, download_file,
+                                      'https://example.com/f3.txt', 'f3.txt',
+                                      sink=sink)
+                    self.assertIsNotNone(sink.error)
+                    self.assertRaises(IOError, sink.write, 'f4.txt', 0, [])
+
+            zip_path = os.path.join(tempdir, 'files.zip')
+            with open_sink(zip_path) as sink:
+                download_file('https://example.com/f1.txt', 'f1.txt',
+                              sink=sink)
+            with zipfile.ZipFile(zip_path) as archive:
+                self.assertEqual(archive.read('f1.txt'), content)
+
+            sink = MemorySink()
+            download_file('https://example.com/f1.txt', 'f1.txt', sink=sink)
+            self.assertRaises(ValueError, download_file,
+                              'https://example.com/f2.txt', 'f2.txt',
+                              md5='d41d8cd98f00b204e9800998ecf8427e',
+                              sink=sink)
+            self.assertEqual(sink.files, {'f1.txt': content})
+
+            directory = os.path.join(tempdir, 'files')
+            with open_sink(directory) as sink:
+                download_file('https://example.com/f1.txt',
+                              os.path.join('01234567', 'f1.txt'), sink=sink)
+            self.assertEqual(os.listdir(os.path.join(directory, '01234567')),
+                             ['f1.txt'])
+
+    def test_describe_local_files(self):
+        """
+        Tests for :func:`describe_local_files
+        <ohapi.utils_fs.describe_local_files>`
+
+        """
+        described = describe_local_files('testing_extras')
+        characterized = characterize_local_files('testing_extras')
+        self.assertEqual(set(described), set(characterized))
+        for filename, file_info in characterized.items():
+            del file_info['md5']
+            self.assertEqual(described[filename], file_info)
+
+    def test_characterize_local_files_parallel(self):
+        """
+        Tests for :func:`characterize_local_files
+        <ohapi.utils_fs.characterize_local_files>`
+
+        """
+        serial = characterize_local_files('testing_extras')
+        self.assertEqual(serial['empty_file.txt']['md5'],
+                         'd41d8cd98f00b204e9800998ecf8427e')
+        parallel = characterize_local_files('testing_extras', processes=2,
+                                            buffer_size=16)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(list(parallel), list(serial))
+        mapped = characterize_local_files('testing_extras', mmap_threshold=0)
+        self.assertEqual(mapped, serial)
+
+    def test_hash_cache(self):
+        """
+        Tests for :class:`HashCache<ohapi.utils_fs.HashCache>`
+
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tempdir, 'data.txt')
+            with open(filepath, 'w') as f:
+                f.write('some stuff')
+            later_ns = int((time.time() + 10) * 10 ** 9)
+            with HashCache(os.path.join(tempdir, 'cache.db')) as cache:
+                file_stats = os.stat(filepath)
+                cache.set(filepath, file_stats, 'cachedmd5', later_ns)
+                self.assertEqual(cache.get(filepath, file_stats), 'cachedmd5')
+                with open(filepath, 'a') as f:
+                    f.write('more stuff')
+                self.assertIsNone(cache.get(filepath, os.stat(filepath)))
+                # Recently modified files are not cached.
+                file_stats = os.stat(filepath)
+                cache.set(filepath, file_stats, 'racymd5',
+                          file_stats.st_mtime_ns)
+                self.assertIsNone(cache.get(filepath, file_stats))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_characterize_local_files_hash_cache(self):
+        """
+        Tests for :func:`characterize_local_files
+        <ohapi.utils_fs.characterize_local_files>`
+        with a :class:`HashCache<ohapi.utils_fs.HashCache>`
+
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            cache = HashCache(os.path.join(tempdir, 'cache.db'))
+            later = time.time() + 10
+            with patch('ohapi.utils_fs.time.time', return_value=later):
+                first = characterize_local_files('testing_extras',
+                                                 hash_cache=cache)
+            with patch('ohapi.utils_fs._hash_file_job') as mocked_hash:
+                second = characterize_local_files('testing_extras',
+                                                  hash_cache=cache)
+                self.assertFalse(mocked_hash.called)
+            self.assertEqual(first, second)
+            cache.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def _make_member_dir(self, parent):
+        os.mkdir(parent)
+        for filename in ['f1.txt', 'f2.txt']:
+            with open(os.path.join(parent, filename), 'w') as f:
+                f.write('some stuff')
+        return {filename: arrow.get(os.stat(
+            os.path.join(parent, filename)).st_ctime).isoformat()
+            for filename in ['f1.txt', 'f2.txt']}
+
+    def test_mk_metadata_jsonl(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            data_dir = os.path.join(tempdir, 'data')
+            os.mkdir(data_dir)
+            dates = self._make_member_dir(os.path.join(data_dir, '12345678'))
+            os.mkdir(os.path.join(data_dir, '23456789'))
+            jsonl_path = os.path.join(tempdir, 'metadata.jsonl')
+            mk_metadata_csv(data_dir, jsonl_path)
+            with open(jsonl_path) as f:
+                self.assertEqual(len(f.readlines()), 3)
+            metadata = load_metadata_csv(jsonl_path)
+            self.assertEqual(metadata['23456789'], {})
+            self.assertEqual(metadata['12345678']['f1.txt'], {
+                'tags': [], 'description': '',
+                'md5': 'beb6a43adfb950ec6f82ceed19beee21',
+                'creation_date': dates['f1.txt']})
+            lazy = load_metadata_csv(jsonl_path, lazy=True)
+            self.assertIsInstance(lazy, LazyMultiUserMetadata)
+            self.assertEqual(dict(lazy), metadata)
+            self.assertTrue(review_metadata_csv(data_dir, jsonl_path))
+            with open(jsonl_path, 'a') as f:
+                f.write('{"project_member_id": "12345678", "tags": []}\n')
+                f.write('not json\n')
+            with patch('builtins.print') as mocked_print:
+                self.assertFalse(review_metadata_csv(data_dir, jsonl_path))
+            printed = [call[0][0] for call in mocked_print.call_args_list]
+            self.assertIn('Error: In row number 4: "filename" must not be '
+                          'empty.', printed)
+            self.assertIn('Error: In row number 5: invalid JSON.', printed)
+        finally:
+            shutil.rmtree(tempdir)
+
     def test_mk_metadata_empty_directory(self):
-        with patch('ohapi.utils_fs.os.path.isdir') as mocked_isdir, \
-                patch('ohapi.utils_fs.os.listdir') as mocked_listdir:
-                mocked_isdir.return_value = True
-                mocked_listdir.return_value = []
-                teststream = StringIO()
-                write_metadata_to_filestream('test_dir', teststream)
-                assert(teststream.getvalue() == 'filename,tags,description,' +
-                       'md5,creation_date\r\n')
+        tempdir = tempfile.mkdtemp()
+        try:
+            teststream = StringIO()
+            write_metadata_to_filestream(tempdir, teststream)
+            assert(teststream.getvalue() == 'filename,tags,description,' +
+                   'md5,creation_date\r\n')
+        finally:
+            shutil.rmtree(tempdir)
 
     def test_mk_metadata_single_user(self):
-            with patch('ohapi.utils_fs.os.path.isdir') as mocked_isdir, \
-                    patch('ohapi.utils_fs.os.listdir') as mocked_listdir:
-                with patch('ohapi.utils_fs.open',
-                           mock_open(read_data=b'some stuff'),
-                           create=True):
-                    mocked_isdir.return_value = True
-                    mocked_listdir.return_value = ['f1.txt', 'f2.txt']
-                    mocked_isdir.side_effect = [False, False]
-                    try:
-                        def fake_stat(arg):
-                            faked = list(orig_os_stat('/tmp'))
-                            faked[stat.ST_SIZE] = len("some stuff")
-                            faked[stat.ST_CTIME] = "1497164239.6941652"
-                            return stat_result(faked)
-                        orig_os_stat = os.stat
-                        os.stat = fake_stat
-                        teststream = StringIO()
-                        write_metadata_to_filestream('test_dir', teststream)
-                        content = teststream.getvalue()
-                        assert(len(content) == 197 and content.startswith(
-                            'filename,tags,description,md5,' +
-                            'creation_date\r\n') and "f1.txt,,,beb6a43adfb95" +
-                            "0ec6f82ceed19beee21,2017-06-11T06:57:19.694165+" +
-                            "00:00\r\n" in content and "f2.txt,,,beb6a43adfb" +
-                            "950ec6f82ceed19beee21," +
-                            "2017-06-11T06:57:19.694165+00:00\r\n" in content)
-                    finally:
-                        os.stat = orig_os_stat
+        tempdir = tempfile.mkdtemp()
+        try:
+            test_dir = os.path.join(tempdir, 'test_dir')
+            dates = self._make_member_dir(test_dir)
+            teststream = StringIO()
+            write_metadata_to_filestream(test_dir, teststream)
+            content = teststream.getvalue()
+            assert(content.startswith(
+                'filename,tags,description,md5,creation_date\r\n') and
+                "f1.txt,,,beb6a43adfb950ec6f82ceed19beee21," +
+                dates['f1.txt'] + "\r\n" in content and
+                "f2.txt,,,beb6a43adfb950ec6f82ceed19beee21," +
+                dates['f2.txt'] + "\r\n" in content)
+            self.assertEqual(len(content.splitlines()), 3)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_mk_metadata_archive(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        content = b'some stuff'
+        tar_path = os.path.join(tempdir, 'files.tar.gz')
+        with tarfile.open(tar_path, 'w:gz') as archive:
+            for name in ['./12345678/f1.txt', './12345678/f2.txt']:
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(content)
+                tarinfo.mtime = 1514764800
+                archive.addfile(tarinfo, BytesIO(content))
+            tarinfo = tarfile.TarInfo('./23456789')
+            tarinfo.type = tarfile.DIRTYPE
+            archive.addfile(tarinfo)
+        teststream = StringIO()
+        write_metadata_to_filestream(tar_path, teststream)
+        self.assertEqual(teststream.getvalue().splitlines(), [
+            'project_member_id,filename,tags,description,md5,creation_date',
+            '12345678,f1.txt,,,beb6a43adfb950ec6f82ceed19beee21,'
+            '2018-01-01T00:00:00+00:00',
+            '12345678,f2.txt,,,beb6a43adfb950ec6f82ceed19beee21,'
+            '2018-01-01T00:00:00+00:00',
+            '23456789,None,NA,NA,NA,NA'])
+
+        zip_path = os.path.join(tempdir, 'files.zip')
+        with zipfile.ZipFile(zip_path, 'w') as archive:
+            archive.writestr('f2.txt', content)
+            archive.writestr('f1.txt', b'')
+        self.assertEqual(
+            [(pmi, filename, size, fileobj.read()) for
+             pmi, filename, size, _, fileobj in iter_archive_files(zip_path)],
+            [(None, 'f1.txt', 0, b''), (None, 'f2.txt', 10, content)])
+        self.assertEqual(
+            [filename for _, filename, _, _, _ in
+             iter_archive_files(zip_path, max_bytes=5)], ['f1.txt'])
+        with zipfile.ZipFile(zip_path, 'a') as archive:
+            archive.writestr('12345678/f3.txt', content)
+        self.assertRaises(ValueError, list, iter_archive_files(zip_path))
 
     def test_mk_metadata_multi_user(self):
-        with patch('ohapi.utils_fs.open', mock_open(read_data=b'some stuff'),
-                   create=True):
-            orig_os_stat = os.stat
-            orig_os_is_dir = os.path.isdir
-            orig_os_list_dir = os.listdir
-            try:
-                def fake_stat(arg):
-                    faked = list(orig_os_stat('/tmp'))
-                    faked[stat.ST_SIZE] = len("some stuff")
-                    faked[stat.ST_CTIME] = "1497164239.6941652"
-                    return stat_result(faked)
-
-                def fake_list_dir(arg):
-                    if arg == 'test_dir':
-                        return ['12345678']
-                    elif '12345678' in arg:
-                        return ['f1.txt', 'f2.txt']
-
-                def fake_is_dir(arg):
-                    if ('test_dir') in arg or ('12345678') in arg:
-                        return True
-                    elif ('f1.txt') in arg or ('f2.txt') in arg:
-                        return False
-                os.listdir = fake_list_dir
-                os.path.isdir = fake_is_dir
-                os.stat = fake_stat
+        tempdir = tempfile.mkdtemp()
+        try:
+            dates = self._make_member_dir(os.path.join(tempdir, '12345678'))
+            os.mkdir(os.path.join(tempdir, '23456789'))
+            for processes in [1, 2]:
                 teststream = StringIO()
-                write_metadata_to_filestream('test_dir', teststream)
+                write_metadata_to_filestream(tempdir, teststream,
+                                             processes=processes)
                 content = teststream.getvalue()
-                assert(len(content) == 233 and content.startswith(
+                assert(content.startswith(
                     'project_member_id,filename,tags,description,md5,' +
-                    'creation_date\r\n') and "12345678,f1.txt,,,beb6a43adfb9" +
-                    "50ec6f82ceed19beee21,2017-06-11T06:57:19.694165+" +
-                    "00:00\r\n" in content and "12345678,f2.txt,,,beb6a43adf" +
-                    "b950ec6f82ceed19beee21," +
-                    "2017-06-11T06:57:19.694165+00:00\r\n" in content)
-            finally:
-                os.stat = orig_os_stat
-                os.listdir = orig_os_list_dir
-                os.path.isdir = orig_os_is_dir
+                    'creation_date\r\n') and
+                    "12345678,f1.txt,,,beb6a43adfb950ec6f82ceed19beee21," +
+                    dates['f1.txt'] + "\r\n" in content and
+                    "12345678,f2.txt,,,beb6a43adfb950ec6f82ceed19beee21," +
+                    dates['f2.txt'] + "\r\n" in content and
+                    "23456789,None,NA,NA,NA,NA\r\n" in content)
+                self.assertEqual(len(content.splitlines()), 4)
+        finally:
+            shutil.rmtree(tempdir)
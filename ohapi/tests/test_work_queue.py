@@ -0,0 +1,173 @@
+from unittest import TestCase
+from unittest.mock import patch
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import requests
+
+from ohapi.api import AdaptiveLimiter
+from ohapi.sync import SyncPlan
+from ohapi.work_queue import WorkQueue, enqueue_plan, run_queue
+
+
+def _claim_all(filepath, worker_id):
+    claimed = []
+    with WorkQueue(filepath, worker_id=worker_id) as queue:
+        while True:
+            item = queue.claim()
+            if item is None:
+                return claimed
+            claimed.append(item.key)
+            queue.complete(item.key)
+
+
+class WorkQueueTest(TestCase):
+    """
+    Tests for :mod:`ohapi.work_queue`.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tempdir, 'queue.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_claim_lease_and_fail(self):
+        with WorkQueue(self.filepath, max_attempts=2) as queue:
+            queue.put('a', {'n': 1})
+            queue.put('b', {'n': 2})
+            queue.put('a', {'n': 3})
+            item = queue.claim()
+            self.assertEqual(item, ('a', {'n': 3}, 1))
+            queue.complete('a')
+            queue.put('a', {'n': 4})
+            item = queue.claim()
+            self.assertEqual(item.key, 'b')
+            self.assertIsNone(queue.claim())
+            queue.fail('b', 'broken')
+            self.assertEqual(queue.claim().attempts, 2)
+            queue.fail('b', 'broken')
+            self.assertIsNone(queue.claim())
+            self.assertEqual(queue.counts(), {'pending': 0, 'leased': 0,
+                                              'done': 1, 'failed': 1})
+
+        with WorkQueue(self.filepath, lease_seconds=-1,
+                       worker_id='one') as queue:
+            queue.put('c', None)
+            self.assertEqual(queue.claim().key, 'c')
+            with WorkQueue(self.filepath, worker_id='two') as other:
+                # The first lease has already expired.
+                self.assertEqual(other.claim().key, 'c')
+            self.assertFalse(queue.renew('c'))
+
+    def test_claims_across_processes(self):
+        keys = ['{:03d}'.format(i) for i in range(200)]
+        with WorkQueue(self.filepath) as queue:
+            queue.put_many((key, None) for key in keys)
+        pool = multiprocessing.Pool(4)
+        try:
+            claimed = pool.starmap(_claim_all, [(self.filepath, str(i)) for
+                                                i in range(4)])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(sorted(sum(claimed, [])), keys)
+
+    def test_run_queue(self):
+        plan = SyncPlan()
+        for filename in ('a.txt', 'b.txt'):
+            plan.add('download', '01234567', filename,
+                     os.path.join(self.tempdir, '01234567', filename), 10,
+                     download_url='https://example.com/' + filename,
+                     md5=None)
+        plan.add('skip', '01234567', 'c.txt', reason='exists')
+
+        def download(download_url, **kwargs):
+            if download_url.endswith('b.txt'):
+                raise ValueError('MD5 mismatch')
+
+        with WorkQueue(self.filepath) as queue:
+            enqueue_plan(queue, plan)
+            enqueue_plan(queue, plan)
+            with patch('ohapi.sync.download_file',
+                       side_effect=download) as mock_download:
+                self.assertEqual(run_queue(queue, max_workers=2), 1)
+            self.assertEqual(mock_download.call_count, 4)
+            self.assertEqual(queue.counts()['done'], 1)
+            self.assertEqual(queue.counts()['failed'], 1)
+
+    def test_run_queue_reports_failures_to_limiter(self):
+        plan = SyncPlan()
+        for i in range(8):
+            filename = '{}.txt'.format(i)
+            plan.add('download', '01234567', filename,
+                     os.path.join(self.tempdir, filename), 10,
+                     download_url='https://example.com/' + filename,
+                     md5=None)
+        limiter = AdaptiveLimiter(max_limit=8, initial_limit=8)
+        with WorkQueue(self.filepath) as queue:
+            enqueue_plan(queue, plan)
+            with patch('ohapi.sync.download_file',
+                       side_effect=requests.exceptions.ConnectionError):
+                self.assertEqual(run_queue(queue, limiter=limiter), 0)
+            self.assertEqual(queue.counts()['failed'], 8)
+        metrics = limiter.metrics()
+        self.assertEqual(metrics['throttled'], 24)
+        self.assertGreater(metrics['decreases'], 0)
+        self.assertEqual(metrics['limit'], 1)
+
+        limiter = AdaptiveLimiter(max_limit=2)
+        with WorkQueue(os.path.join(self.tempdir, 'other.sqlite')) as queue:
+            enqueue_plan(queue, plan)
+            with patch('ohapi.sync.download_file',
+                       side_effect=ValueError('MD5 mismatch')):
+                run_queue(queue, limiter=limiter)
+        self.assertEqual(limiter.metrics()['failed'], 24)
+
+    def test_seed_once(self):
+        seeded = []
+
+        def seed(worker_id):
+            with WorkQueue(self.filepath, worker_id=worker_id) as queue:
+                def func():
+                    time.sleep(0.05)
+                    queue.put(worker_id, None)
+                seeded.append(queue.seed(func, poll_seconds=0.01))
+
+        workers = [threading.Thread(target=seed, args=(str(i),)) for
+                   i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(sorted(seeded), [False, False, True])
+        with WorkQueue(self.filepath) as queue:
+            # Waiting workers only return once the items are queued.
+            self.assertEqual(queue.counts()['pending'], 1)
+            queue.set_meta('latest_created', 1514764800000000)
+            self.assertEqual(queue.get_meta('latest_created'),
+                             1514764800000000)
+            self.assertIsNone(queue.get_meta('missing'))
+
+    def test_run_queue_renews_leases(self):
+        plan = SyncPlan()
+        plan.add('download', '01234567', 'a.txt',
+                 os.path.join(self.tempdir, 'a.txt'), 10,
+                 download_url='https://example.com/a.txt', md5=None)
+        claimed = []
+
+        def download(**kwargs):
+            time.sleep(0.5)
+            with WorkQueue(self.filepath, worker_id='other') as other:
+                claimed.append(other.claim())
+
+        with WorkQueue(self.filepath, lease_seconds=0.2) as queue:
+            enqueue_plan(queue, plan)
+            with patch('ohapi.sync.download_file', side_effect=download):
+                self.assertEqual(run_queue(queue, renew_seconds=0.02), 1)
+        self.assertEqual(claimed, [None])
@@ -1,19 +1,60 @@
 """
 Utility functions to sync and work with Open Humans data in a local filesystem.
 """
+from collections import OrderedDict, deque, namedtuple
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import bz2
+import concurrent.futures
 import csv
+import datetime
+from functools import lru_cache, partial
+from itertools import chain, islice
+import gzip
 import hashlib
+import io
+import json
+import locale
 import logging
+import mmap
 import os
 import re
+import shutil
+import sqlite3
+import stat
+import sys
+import tarfile
+import threading
+import time
+import zipfile
 
 import arrow
 from humanfriendly import format_size, parse_size
-from .api import _exceeds_size
+from .api import REQUEST_TIMEOUT, _exceeds_size, handle_error
 import requests
 
 
 MAX_FILE_DEFAULT = parse_size('128m')
+VALIDATION_BATCH_DEFAULT = 100000
+JSONL_SUFFIXES = ('.jsonl', '.ndjson')
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+ZIP_SUFFIXES = ('.zip',)
+MD5_RE = re.compile(r'[a-f0-9]{32}$', flags=re.IGNORECASE)
+# Common, in range ISO 8601 forms: hours 00-23 and UTC offsets up to 14:00.
+# Anything else (e.g. hour 24 or larger offsets) is left to arrow.
+ISO_8601_RE = re.compile(
+    r'([0-9]{4})-([0-9]{2})-([0-9]{2})'
+    r'(?:[T ]([01][0-9]|2[0-3]):([0-5][0-9])'
+    r'(?::([0-5][0-9])(?:[.,][0-9]+)?)?'
+    r'(?:Z|[+-](0[0-9]|1[0-4])(?::?([0-5][0-9]))?)?)?$')
+HASH_BUFFER_DEFAULT = parse_size('1 MiB')
+# Number of files hashed ahead of the file currently being written out.
+HASH_WINDOW_DEFAULT = 256
+# Files modified this recently may change again within the same timestamp
+# tick (2 s on FAT), so their hashes are not cached.
+HASH_CACHE_RACY_NS = 2 * 10 ** 9
 
 
 def strip_zip_suffix(filename):
@@ -47,64 +88,326 @@ def guess_tags(filename):
     return tags
 
 
-def characterize_local_files(filedir, max_bytes=MAX_FILE_DEFAULT):
+def hash_file(filepath, buffer_size=HASH_BUFFER_DEFAULT, use_mmap=False):
+    """
+    Return the MD5 hexdigest of a file.
+
+    :param filepath: This field is the path of the file to hash.
+    :param buffer_size: This field is the size of reads from the file. Its
+        default value is 1 MiB.
+    :param use_mmap: If True, the file is memory mapped and hashed in one
+        call instead of being read in chunks. Its default value is False.
+    """
+    file_md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        if use_mmap:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped, fall back to reading.
+                mapped = None
+            if mapped is not None:
+                try:
+                    file_md5.update(mapped)
+                finally:
+                    mapped.close()
+                return file_md5.hexdigest()
+        for chunk in iter(lambda: f.read(buffer_size), b""):
+            file_md5.update(chunk)
+    return file_md5.hexdigest()
+
+
+def _hash_file_job(job, buffer_size=HASH_BUFFER_DEFAULT, mmap_threshold=None):
+    """
+    Helper function to hash a (filepath, file_size) job in a worker process.
+    """
+    filepath, file_size = job
+    use_mmap = mmap_threshold is not None and file_size >= mmap_threshold
+    return hash_file(filepath, buffer_size=buffer_size, use_mmap=use_mmap)
+
+
+class HashCache(object):
+    """
+    Persistent SQLite cache of file MD5s, for reuse across metadata runs.
+
+    Entries are keyed by absolute path and are only used if the file's
+    device, inode, size, mtime_ns and ctime_ns all still match. Files
+    modified within HASH_CACHE_RACY_NS of being hashed are not cached, as a
+    later change might not alter their timestamps.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._conn = sqlite3.connect(filepath)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS file_hashes ('
+            'path TEXT PRIMARY KEY, device INTEGER, inode INTEGER, '
+            'size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, md5 TEXT)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _stat_key(file_stats):
+        return (file_stats.st_dev, file_stats.st_ino, file_stats.st_size,
+                file_stats.st_mtime_ns, file_stats.st_ctime_ns)
+
+    def get(self, filepath, file_stats):
+        """
+        Return the cached MD5 for a file, or None if it isn't cached or the
+        file has changed.
+
+        :param filepath: This field is the path of the file.
+        :param file_stats: This field is the os.stat result for the file.
+        """
+        row = self._conn.execute(
+            'SELECT device, inode, size, mtime_ns, ctime_ns, md5 '
+            'FROM file_hashes WHERE path = ?',
+            (os.path.abspath(filepath),)).fetchone()
+        if row and tuple(row[:5]) == self._stat_key(file_stats):
+            return row[5]
+        return None
+
+    def set(self, filepath, file_stats, md5, hashed_at_ns):
+        """
+        Cache the MD5 of a file, unless it was modified too recently.
+
+        :param filepath: This field is the path of the file.
+        :param file_stats: This field is the os.stat result for the file,
+            taken before it was hashed.
+        :param md5: This field is the MD5 hexdigest of the file.
+        :param hashed_at_ns: This field is the time hashing started, in
+            nanoseconds since the epoch.
+        """
+        path = os.path.abspath(filepath)
+        if (max(file_stats.st_mtime_ns, file_stats.st_ctime_ns) >=
+                hashed_at_ns - HASH_CACHE_RACY_NS):
+            self._conn.execute('DELETE FROM file_hashes WHERE path = ?',
+                               (path,))
+            return
+        self._conn.execute(
+            'INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (path,) + self._stat_key(file_stats) + (md5,))
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+def _scan_files(filedir, max_bytes, hash_cache=None):
+    """
+    Helper generator yielding (filename, filepath, file_stats, md5) for files
+    in a directory, skipping files larger than max_bytes. The md5 is None
+    unless it was found in hash_cache.
+    """
+    for entry in os.scandir(filedir):
+        # DirEntry caches its stat result, so each file is only stat'd once.
+        file_stats = entry.stat()
+        if file_stats.st_size > max_bytes:
+            continue
+        md5 = None
+        if hash_cache is not None:
+            md5 = hash_cache.get(entry.path, file_stats)
+        yield entry.name, entry.path, file_stats, md5
+
+
+def _iter_hashed(jobs, processes=1, buffer_size=HASH_BUFFER_DEFAULT,
+                 mmap_threshold=None, executor=None, hash_cache=None,
+                 window=HASH_WINDOW_DEFAULT):
+    """
+    Helper generator hashing (key, filepath, file_stats, md5) jobs, yielding
+    (key, file_stats, md5) in the same order. Jobs that already have an md5,
+    or have no filepath, are passed through without hashing. Up to window
+    files are hashed ahead of the one being yielded.
+    """
+    job_func = partial(_hash_file_job, buffer_size=buffer_size,
+                       mmap_threshold=mmap_threshold)
+    own_executor = None
+    if executor is None and processes != 1:
+        executor = own_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes or None)
+    pending = deque()
+
+    def finish(key, filepath, file_stats, result, hashed_at_ns):
+        if hashed_at_ns is None:
+            return key, file_stats, result
+        md5 = result.result() if executor is not None else result
+        if hash_cache is not None:
+            hash_cache.set(filepath, file_stats, md5, hashed_at_ns)
+        return key, file_stats, md5
+
+    try:
+        for key, filepath, file_stats, md5 in jobs:
+            hashed_at_ns = None
+            result = md5
+            if md5 is None and filepath is not None:
+                hashed_at_ns = int(time.time() * 10 ** 9)
+                job = (filepath, file_stats.st_size)
+                if executor is not None:
+                    result = executor.submit(job_func, job)
+                else:
+                    result = job_func(job)
+            pending.append((key, filepath, file_stats, result, hashed_at_ns))
+            if executor is None or len(pending) >= window:
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        if own_executor is not None:
+            own_executor.shutdown()
+        if hash_cache is not None:
+            hash_cache.commit()
+
+
+def draft_file_metadata(filename, created):
+    """
+    Draft upload metadata for a file, without an md5: tags are guessed from
+    its filename and its creation_date is the given time.
+
+    :param filename: This field is the name of the file.
+    :param created: This field is the file's creation time, in seconds since
+        the epoch.
+    """
+    return {
+        'tags': guess_tags(filename),
+        'description': '',
+        'creation_date': arrow.get(created).isoformat(),
+    }
+
+
+def _file_info(filename, file_stats, md5):
+    """
+    Helper function to build the file_data entry for a characterized file.
+    """
+    file_info = draft_file_metadata(filename, file_stats.st_ctime)
+    file_info['md5'] = md5
+    return file_info
+
+
+def iter_local_file_data(filedir, max_bytes=MAX_FILE_DEFAULT, processes=1,
+                         buffer_size=HASH_BUFFER_DEFAULT, mmap_threshold=None,
+                         executor=None, hash_cache=None):
+    """
+    Yield (filename, file_info) for files in a directory as they are
+    characterized, in directory order. See
+    :func:`characterize_local_files<ohapi.utils_fs.characterize_local_files>`
+    for the parameters and the format of file_info.
+    """
+    logging.info('Characterizing files in {}'.format(filedir))
+    jobs = ((filename, filepath, file_stats, md5) for
+            filename, filepath, file_stats, md5 in
+            _scan_files(filedir, max_bytes, hash_cache=hash_cache))
+    for filename, file_stats, md5 in _iter_hashed(
+            jobs, processes=processes, buffer_size=buffer_size,
+            mmap_threshold=mmap_threshold, executor=executor,
+            hash_cache=hash_cache):
+        yield filename, _file_info(filename, file_stats, md5)
+
+
+def characterize_local_files(filedir, max_bytes=MAX_FILE_DEFAULT,
+                             processes=1, buffer_size=HASH_BUFFER_DEFAULT,
+                             mmap_threshold=None, executor=None,
+                             hash_cache=None):
     """
     Collate local file info as preperation for Open Humans upload.
 
     Note: Files with filesize > max_bytes are not included in returned info.
 
+    :param filedir: This field is target directory to get files from.
+    :param max_bytes: This field is the maximum file size to consider. Its
+        default value is 128m.
+    :param processes: This field is the number of worker processes used to
+        hash files. If None or 0, one process per CPU core is used. Its
+        default value is 1.
+    :param buffer_size: This field is the size of reads from each file. Its
+        default value is 1 MiB.
+    :param mmap_threshold: If provided, files at least this size are memory
+        mapped instead of read in chunks. Its default value is None.
+    :param executor: If provided, this concurrent.futures executor is used
+        to hash files. Its default value is None.
+    :param hash_cache: If provided, this HashCache is used to skip hashing
+        files that haven't changed since they were last hashed. Its default
+        value is None.
+    """
+    return dict(iter_local_file_data(
+        filedir, max_bytes=max_bytes, processes=processes,
+        buffer_size=buffer_size, mmap_threshold=mmap_threshold,
+        executor=executor, hash_cache=hash_cache))
+
+
+def describe_local_files(filedir, max_bytes=MAX_FILE_DEFAULT):
+    """
+    Draft metadata for the files in a directory without reading them, as
+    for uploads that compute each file's MD5 while it is uploaded.
+
+    Files get the same tags, description and creation_date as
+    :func:`characterize_local_files<ohapi.utils_fs.characterize_local_files>`
+    gives them, but no md5. Files with filesize > max_bytes are not
+    included.
+
     :param filedir: This field is target directory to get files from.
     :param max_bytes: This field is the maximum file size to consider. Its
         default value is 128m.
     """
     file_data = {}
-    logging.info('Characterizing files in {}'.format(filedir))
-    for filename in os.listdir(filedir):
-        filepath = os.path.join(filedir, filename)
-        file_stats = os.stat(filepath)
-        creation_date = arrow.get(file_stats.st_ctime).isoformat()
-        file_size = file_stats.st_size
-        if file_size <= max_bytes:
-            file_md5 = hashlib.md5()
-            with open(filepath, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    file_md5.update(chunk)
-            md5 = file_md5.hexdigest()
-            file_data[filename] = {
-                'tags': guess_tags(filename),
-                'description': '',
-                'md5': md5,
-                'creation_date': creation_date,
-            }
+    for filename, _, file_stats, _ in _scan_files(filedir, max_bytes):
+        if stat.S_ISREG(file_stats.st_mode):
+            file_data[filename] = draft_file_metadata(filename,
+                                                      file_stats.st_ctime)
     return file_data
 
 
+def _metadata_dir_errors(target_dir, metadata):
+    """
+    Helper function to list mismatches between files in target_dir and the
+    filenames in metadata, compared as sets.
+    """
+    if not os.path.isdir(target_dir):
+        return ["Error: " + target_dir + " is not a directory"]
+    file_list = set(os.listdir(target_dir))
+    metadata_files = set(metadata)
+    errors = []
+    for filename in sorted(file_list - metadata_files):
+        errors.append("Error: " + filename + " present at" + target_dir +
+                      " not found in metadata file")
+    for filename in sorted(metadata_files - file_list):
+        errors.append("Error: " + filename + " present in metadata file " +
+                      " not found on disk at: " + target_dir)
+    return errors
+
+
 def validate_metadata(target_dir, metadata):
     """
     Check that the files listed in metadata exactly match files in target dir.
 
+    All mismatches are printed.
+
     :param target_dir: This field is the target directory from which to
         match metadata
     :param metadata: This field contains the metadata to be matched.
     """
-    if not os.path.isdir(target_dir):
-        print("Error: " + target_dir + " is not a directory")
-        return False
-    file_list = os.listdir(target_dir)
-    for filename in file_list:
-        if filename not in metadata:
-            print("Error: " + filename + " present at" + target_dir +
-                  " not found in metadata file")
-            return False
-    for filename in metadata:
-        if filename not in file_list:
-            print("Error: " + filename + " present in metadata file " +
-                  " not found on disk at: " + target_dir)
-            return False
-    return True
+    errors = _metadata_dir_errors(target_dir, metadata)
+    for error in errors:
+        print(error)
+    return not errors
 
 
-def load_metadata_csv_single_user(csv_in, header, tags_idx):
+def _row_error(errors, message):
+    """
+    Helper function to record a metadata row error, or raise it as a
+    ValueError if errors aren't being collected.
+    """
+    if errors is None:
+        raise ValueError(message)
+    errors.append(message)
+
+
+def load_metadata_csv_single_user(csv_in, header, tags_idx, errors=None):
     """
     Return the metadata as requested for a single user.
 
@@ -112,31 +415,35 @@ def load_metadata_csv_single_user(csv_in, header, tags_idx):
     :param header: This field contains the headers in the csv file
     :param tags_idx: This field contains the index of the tags in the csv
         file.
+    :param errors: If provided, row errors are appended to this list and the
+        row is skipped, instead of raising a ValueError. Its default value is
+        None.
     """
     metadata = {}
     n_headers = len(header)
+    fields = [(i, header[i]) for i in range(1, n_headers) if i != tags_idx]
     for index, row in enumerate(csv_in, 2):
         if row[0] == "":
-            raise ValueError('Error: In row number ' + str(index) + ':' +
-                             ' "filename" must not be empty.')
+            _row_error(errors, 'Error: In row number ' + str(index) + ':' +
+                       ' "filename" must not be empty.')
+            continue
         if row[0] == 'None' and [x == 'NA' for x in row[1:]]:
             break
         if len(row) != n_headers:
-            raise ValueError('Error: In row number ' + str(index) + ':' +
-                             ' Number of columns (' + str(len(row)) +
-                             ') doesnt match Number of headings (' +
-                             str(n_headers) + ')')
-        metadata[row[0]] = {
-            header[i]: row[i] for i in range(1, len(header)) if
-            i != tags_idx
-        }
-        metadata[row[0]]['tags'] = [t.strip() for t in
-                                    row[tags_idx].split(',') if
-                                    t.strip()]
+            _row_error(errors, 'Error: In row number ' + str(index) + ':' +
+                       ' Number of columns (' + str(len(row)) +
+                       ') doesnt match Number of headings (' +
+                       str(n_headers) + ')')
+            continue
+        file_metadata = {name: row[i] for i, name in fields}
+        file_metadata['tags'] = [t.strip() for t in
+                                 row[tags_idx].split(',') if t.strip()]
+        metadata[row[0]] = file_metadata
     return metadata
 
 
-def load_metadata_csv_multi_user(csv_in, header, tags_idx):
+def load_metadata_csv_multi_user(csv_in, header, tags_idx, errors=None,
+                                 first_row=2):
     """
     Return the metadata as requested for multiple users.
 
@@ -144,65 +451,352 @@ def load_metadata_csv_multi_user(csv_in, header, tags_idx):
     :param header: This field contains the headers in the csv file
     :param tags_idx: This field contains the index of the tags in the csv
         file.
+    :param errors: If provided, row errors are appended to this list and the
+        row is skipped, instead of raising a ValueError. Its default value is
+        None.
+    :param first_row: This field is the row number of the first row, used in
+        error messages. Its default value is 2.
     """
     metadata = {}
     n_headers = len(header)
-    for index, row in enumerate(csv_in, 2):
+    fields = [(i, header[i]) for i in range(2, n_headers) if i != tags_idx]
+    for index, row in enumerate(csv_in, first_row):
         if row[0] == "":
-            raise ValueError('Error: In row number ' + str(index) + ':' +
-                             ' "project_member_id" must not be empty.')
+            _row_error(errors, 'Error: In row number ' + str(index) + ':' +
+                       ' "project_member_id" must not be empty.')
+            continue
         if row[1] == "":
-            raise ValueError('Error: In row number ' + str(index) + ':' +
-                             ' "filename" must not be empty.')
+            _row_error(errors, 'Error: In row number ' + str(index) + ':' +
+                       ' "filename" must not be empty.')
+            continue
         if row[0] not in metadata:
             metadata[row[0]] = {}
         if row[1] == 'None' and all([x == 'NA' for x in row[2:]]):
             continue
         if len(row) != n_headers:
-            raise ValueError('Error: In row number ' + str(index) + ':' +
-                             ' Number of columns (' + str(len(row)) +
-                             ') doesnt match Number of headings (' +
-                             str(n_headers) + ')')
-        metadata[row[0]][row[1]] = {
-            header[i]: row[i] for i in range(2, len(header)) if
-            i != tags_idx
-        }
-        metadata[row[0]][row[1]]['tags'] = [t.strip() for t in
-                                            row[tags_idx].split(',') if
-                                            t.strip()]
+            _row_error(errors, 'Error: In row number ' + str(index) + ':' +
+                       ' Number of columns (' + str(len(row)) +
+                       ') doesnt match Number of headings (' +
+                       str(n_headers) + ')')
+            continue
+        file_metadata = {name: row[i] for i, name in fields}
+        file_metadata['tags'] = [t.strip() for t in
+                                 row[tags_idx].split(',') if t.strip()]
+        metadata[row[0]][row[1]] = file_metadata
+    return metadata
+
+
+def _read_metadata_csv(f, errors=None):
+    """
+    Helper function to read the header and metadata from an open CSV file in
+    a single pass. Returns (header, metadata).
+    """
+    csv_in = csv.reader(f)
+    header = next(csv_in)
+    if 'tags' in header:
+        tags_idx = header.index('tags')
+    else:
+        raise ValueError('"tags" is a compulsory column in metadata file.')
+    if header[0] == 'project_member_id':
+        if header[1] == 'filename':
+            metadata = load_metadata_csv_multi_user(csv_in, header,
+                                                    tags_idx, errors=errors)
+        else:
+            raise ValueError('The second column must be "filename"')
+    elif header[0] == 'filename':
+        metadata = load_metadata_csv_single_user(csv_in, header, tags_idx,
+                                                 errors=errors)
+    else:
+        raise ValueError('Incorrect Formatting of metadata. The first' +
+                         ' column for single user upload should be' +
+                         ' "filename". For multiuser uploads the first ' +
+                         'column should be "project member id" and the' +
+                         ' second column should be "filename"')
+    return header, metadata
+
+
+def is_jsonl_path(filepath):
+    """
+    Return True if a metadata filepath is in JSON Lines format, judging by
+    its extension (".jsonl" or ".ndjson", before any ".gz" or ".bz2").
+
+    :param filepath: This field is the metadata filepath.
+    """
+    return strip_zip_suffix(filepath.lower()).endswith(JSONL_SUFFIXES)
+
+
+def open_output_file(filepath):
+    """
+    Open a text file for writing, compressed with gzip or bz2 if filepath
+    ends in ".gz" or ".bz2".
+
+    :param filepath: This field is the path of the file to write.
+    """
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, 'wt', newline='')
+    elif filepath.endswith('.bz2'):
+        return bz2.open(filepath, 'wt', newline='')
+    return open(filepath, 'w', newline='')
+
+
+def _iter_jsonl_records(lines, errors=None, first_row=1, multi_user=None):
+    """
+    Helper generator parsing JSON Lines metadata, yielding (index,
+    project_member_id, filename, file_metadata). project_member_id is None
+    for single user metadata, and filename is None for members without
+    files. Errors are raised as ValueError, or appended to errors.
+    """
+    for index, line in enumerate(lines, first_row):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            _row_error(errors, 'Error: In row number ' + str(index) + ':' +
+                       ' invalid JSON.')
+            continue
+        if not isinstance(record, dict):
+            _row_error(errors, 'Error: In row number ' + str(index) + ':' +
+                       ' each line must be a JSON object.')
+            continue
+        record_multi_user = 'project_member_id' in record
+        if multi_user is None:
+            multi_user = record_multi_user
+        elif multi_user != record_multi_user:
+            _row_error(errors, 'Error: In row number ' + str(index) + ':' +
+                       ' "project_member_id" must be given for every file,'
+                       ' or for none.')
+            continue
+        project_member_id = record.pop('project_member_id', None)
+        filename = record.pop('filename', None)
+        if multi_user and not project_member_id:
+            _row_error(errors, 'Error: In row number ' + str(index) + ':' +
+                       ' "project_member_id" must not be empty.')
+            continue
+        if not filename and not (multi_user and len(record) == 0):
+            _row_error(errors, 'Error: In row number ' + str(index) + ':' +
+                       ' "filename" must not be empty.')
+            continue
+        yield index, project_member_id, filename or None, record
+
+
+def _read_metadata_jsonl(f, errors=None):
+    """
+    Helper function to read JSON Lines metadata from an open file in a
+    single pass. Returns (multi_user, metadata).
+    """
+    metadata = {}
+    multi_user = False
+    for _, project_member_id, filename, file_metadata in _iter_jsonl_records(
+            f, errors=errors):
+        if project_member_id is None:
+            metadata[filename] = file_metadata
+            continue
+        multi_user = True
+        member_metadata = metadata.setdefault(project_member_id, {})
+        if filename is not None:
+            member_metadata[filename] = file_metadata
+    return multi_user, metadata
+
+
+def load_metadata_jsonl(input_filepath):
+    """
+    Return dict of metadata from a JSON Lines file, with one JSON object
+    per file. Objects have a "filename" and the file's metadata fields, and
+    for multi-user metadata a "project_member_id". Values keep their JSON
+    types, e.g. "tags" is a list and metadata may be nested.
+
+    The format of the returned metadata matches
+    :func:`load_metadata_csv<ohapi.utils_fs.load_metadata_csv>`.
+
+    :param input_filepath: This field is the filepath of the JSON Lines file.
+    """
+    with open(input_filepath) as f:
+        _, metadata = _read_metadata_jsonl(f)
     return metadata
 
 
-def load_metadata_csv(input_filepath):
+def _read_csv_records(f, encoding):
+    """
+    Helper generator reading CSV records from a binary file, yielding
+    (row, start, end) with the byte offsets of each record.
+    """
+    position = [f.tell()]
+
+    def lines():
+        for line in f:
+            position[0] += len(line)
+            yield line.decode(encoding).replace('\r\n', '\n')
+
+    start = position[0]
+    # The csv reader only pulls the lines of one record at a time, so the
+    # position after each record is its end offset.
+    for row in csv.reader(lines()):
+        yield row, start, position[0]
+        start = position[0]
+
+
+class LazyMultiUserMetadata(Mapping):
+    """
+    Multi-user metadata from a CSV file, loaded one project member at a time.
+
+    One pass over the CSV builds an index of the byte offsets of each
+    member's rows, which is saved next to the CSV (as "<csv>.idx") and
+    reused while the CSV is unchanged. Looking up a project member ID
+    reads and parses only that member's rows, returning the same dict
+    :func:`load_metadata_csv<ohapi.utils_fs.load_metadata_csv>` would.
+
+    JSON Lines metadata files (see
+    :func:`is_jsonl_path<ohapi.utils_fs.is_jsonl_path>`) are indexed the
+    same way.
+    """
+    INDEX_VERSION = 1
+
+    def __init__(self, input_filepath, index_filepath=None):
+        self.input_filepath = input_filepath
+        self.index_filepath = index_filepath or input_filepath + '.idx'
+        self.encoding = locale.getpreferredencoding(False)
+        self.jsonl = is_jsonl_path(input_filepath)
+        index = self._read_index()
+        if index is None:
+            index = self._build_index()
+            self._write_index(index)
+        self.header = index['header']
+        self.tags_idx = None if self.jsonl else self.header.index('tags')
+        self._spans = OrderedDict(
+            (member_id, spans) for member_id, spans in index['spans'])
+
+    def _csv_stat_key(self):
+        stats = os.stat(self.input_filepath)
+        return [stats.st_size, stats.st_mtime_ns]
+
+    def _read_index(self):
+        try:
+            with open(self.index_filepath) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if (index.get('version') != self.INDEX_VERSION or
+                index.get('csv') != self._csv_stat_key() or
+                index.get('encoding') != self.encoding):
+            return None
+        return index
+
+    def _build_index(self):
+        logging.info('Indexing metadata in {}'.format(self.input_filepath))
+        csv_key = self._csv_stat_key()
+        spans = OrderedDict()
+        if self.jsonl:
+            with open(self.input_filepath, 'rb') as f:
+                start = 0
+                for index, line in enumerate(f, 1):
+                    end = start + len(line)
+                    for _, member_id, _, _ in _iter_jsonl_records(
+                            [line.decode(self.encoding)], first_row=index,
+                            multi_user=True):
+                        self._add_span(spans, member_id, start, end, index)
+                    start = end
+            return {'version': self.INDEX_VERSION, 'csv': csv_key,
+                    'encoding': self.encoding, 'header': None,
+                    'spans': list(spans.items())}
+        with open(self.input_filepath, 'rb') as f:
+            records = _read_csv_records(f, self.encoding)
+            header = next(records)[0]
+            if 'tags' not in header:
+                raise ValueError(
+                    '"tags" is a compulsory column in metadata file.')
+            if header[:2] != ['project_member_id', 'filename']:
+                raise ValueError('Lazy loading needs multi-user metadata, '
+                                 'with "project_member_id" and "filename" '
+                                 'as the first columns.')
+            for index, (row, start, end) in enumerate(records, 2):
+                if not row or row[0] == "":
+                    raise ValueError('Error: In row number ' + str(index) +
+                                     ':' + ' "project_member_id" must not '
+                                     'be empty.')
+                self._add_span(spans, row[0], start, end, index)
+        return {'version': self.INDEX_VERSION, 'csv': csv_key,
+                'encoding': self.encoding, 'header': header,
+                'spans': list(spans.items())}
+
+    @staticmethod
+    def _add_span(spans, project_member_id, start, end, index):
+        member_spans = spans.setdefault(project_member_id, [])
+        if member_spans and sum(member_spans[-1][:2]) == start:
+            member_spans[-1][1] += end - start
+        else:
+            member_spans.append([start, end - start, index])
+
+    def _write_index(self, index):
+        tmp_filepath = '{}.{}.tmp'.format(self.index_filepath, os.getpid())
+        try:
+            with open(tmp_filepath, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_filepath, self.index_filepath)
+        except (IOError, OSError) as e:
+            logging.warning('Unable to save metadata index {}: {}'.format(
+                self.index_filepath, e))
+
+    def __getitem__(self, project_member_id):
+        spans = self._spans[project_member_id]
+        member_metadata = {}
+        with open(self.input_filepath, 'rb') as f:
+            for offset, length, first_row in spans:
+                f.seek(offset)
+                text = f.read(length).decode(self.encoding)
+                if self.jsonl:
+                    for _, _, filename, file_metadata in _iter_jsonl_records(
+                            io.StringIO(text), first_row=first_row,
+                            multi_user=True):
+                        if filename is not None:
+                            member_metadata[filename] = file_metadata
+                    continue
+                rows = csv.reader(io.StringIO(text.replace('\r\n', '\n')))
+                metadata = load_metadata_csv_multi_user(
+                    rows, self.header, self.tags_idx, first_row=first_row)
+                member_metadata.update(metadata.get(project_member_id, {}))
+        return member_metadata
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __contains__(self, project_member_id):
+        return project_member_id in self._spans
+
+
+def load_metadata_csv(input_filepath, lazy=False):
     """
     Return dict of metadata.
 
     Format is either dict (filenames are keys) or dict-of-dicts (project member
     IDs as top level keys, then filenames as keys).
 
+    JSON Lines metadata files are detected by their extension (see
+    :func:`is_jsonl_path<ohapi.utils_fs.is_jsonl_path>`) and loaded with
+    :func:`load_metadata_jsonl<ohapi.utils_fs.load_metadata_jsonl>`.
+
     :param input_filepath: This field is the filepath of the csv file.
+    :param lazy: If True, multi-user metadata is returned as a
+        :class:`LazyMultiUserMetadata<ohapi.utils_fs.LazyMultiUserMetadata>`
+        which loads each member's rows on demand. Its default value is False.
     """
+    if is_jsonl_path(input_filepath):
+        if lazy:
+            with open(input_filepath) as f:
+                first_line = next((line for line in f if line.strip()), '')
+            if '"project_member_id"' in first_line:
+                return LazyMultiUserMetadata(input_filepath)
+        return load_metadata_jsonl(input_filepath)
     with open(input_filepath) as f:
-        csv_in = csv.reader(f)
-        header = next(csv_in)
-        if 'tags' in header:
-            tags_idx = header.index('tags')
-        else:
-            raise ValueError('"tags" is a compulsory column in metadata file.')
-        if header[0] == 'project_member_id':
-            if header[1] == 'filename':
-                metadata = load_metadata_csv_multi_user(csv_in, header,
-                                                        tags_idx)
-            else:
-                raise ValueError('The second column must be "filename"')
-        elif header[0] == 'filename':
-            metadata = load_metadata_csv_single_user(csv_in, header, tags_idx)
-        else:
-            raise ValueError('Incorrect Formatting of metadata. The first' +
-                             ' column for single user upload should be' +
-                             ' "filename". For multiuser uploads the first ' +
-                             'column should be "project member id" and the' +
-                             ' second column should be "filename"')
+        if lazy:
+            header = next(csv.reader(f))
+            if header[:2] == ['project_member_id', 'filename']:
+                return LazyMultiUserMetadata(input_filepath)
+            f.seek(0)
+        _, metadata = _read_metadata_csv(f)
     return metadata
 
 
@@ -215,6 +809,31 @@ def print_error(e):
     print(" ".join([str(arg) for arg in e.args]))
 
 
+@lru_cache(maxsize=65536)
+def _is_iso8601_date(date):
+    """
+    Helper function to check an ISO 8601 date string, with results cached
+    as creation dates are often repeated. Common forms are checked with a
+    regular expression, and anything else, including edge values, falls
+    back to arrow, so the result is always the same as arrow's.
+    """
+    match = ISO_8601_RE.match(date)
+    if match:
+        year, month, day, hour, minute, second, tz_hour, tz_minute = [
+            int(x) if x else 0 for x in match.groups()]
+        try:
+            datetime.datetime(year, month, day, hour, minute, second)
+            if tz_hour * 60 + tz_minute <= 14 * 60:
+                return True
+        except ValueError:
+            pass
+    try:
+        arrow.get(date)
+    except Exception:
+        return False
+    return True
+
+
 def validate_date(date, project_member_id, filename):
     """
     Check if date is in ISO 8601 format.
@@ -225,6 +844,8 @@ def validate_date(date, project_member_id, filename):
     :param filename: This field is the filename corresponding to the date
         provided.
     """
+    if isinstance(date, str):
+        return _is_iso8601_date(date)
     try:
         arrow.get(date)
     except Exception:
@@ -232,70 +853,163 @@ def validate_date(date, project_member_id, filename):
     return True
 
 
+def _is_project_member_id(project_member_id):
+    return (isinstance(project_member_id, str) and
+            project_member_id.isdigit() and len(project_member_id) == 8)
+
+
 def is_single_file_metadata_valid(file_metadata, project_member_id, filename):
     """
     Check if metadata fields like project member id, description, tags, md5 and
     creation date are valid for a single file.
 
+    To check many files at once, use
+    :func:`find_metadata_errors<ohapi.utils_fs.find_metadata_errors>`.
+
     :param file_metadata: This field is metadata of file.
     :param project_member_id: This field is the project member id corresponding
         to the file metadata provided.
     :param filename: This field is the filename corresponding to the file
         metadata provided.
     """
-    if project_member_id is not None:
-        if not project_member_id.isdigit() or len(project_member_id) != 8:
-            raise ValueError(
-                'Error: for project member id: ', project_member_id,
-                ' and filename: ', filename,
-                ' project member id must be of 8 digits from 0 to 9')
-    if 'description' not in file_metadata:
-        raise ValueError(
-            'Error: for project member id: ', project_member_id,
-            ' and filename: ', filename,
-            ' "description" is a required field of the metadata')
-
-    if not isinstance(file_metadata['description'], str):
-        raise ValueError(
-            'Error: for project member id: ', project_member_id,
-            ' and filename: ', filename,
-            ' "description" must be a string')
-
-    if 'tags' not in file_metadata:
-        raise ValueError(
-            'Error: for project member id: ', project_member_id,
-            ' and filename: ', filename,
-            ' "tags" is a required field of the metadata')
-
-    if not isinstance(file_metadata['tags'], list):
-        raise ValueError(
-            'Error: for project member id: ', project_member_id,
-            ' and filename: ', filename,
-            ' "tags" must be an array of strings')
-
-    if 'creation_date' in file_metadata:
-        if not validate_date(file_metadata['creation_date'], project_member_id,
-                             filename):
-            raise ValueError(
-                'Error: for project member id: ', project_member_id,
-                ' and filename: ', filename,
-                ' Dates must be in ISO 8601 format')
+    errors = find_metadata_errors(
+        [(project_member_id, filename, file_metadata)])
+    if errors:
+        raise ValueError(*errors[0].args)
+    return True
 
-    if 'md5' in file_metadata:
-        if not re.match(r'[a-f0-9]{32}$', file_metadata['md5'],
-                        flags=re.IGNORECASE):
-            raise ValueError(
-                'Error: for project member id: ', project_member_id,
-                ' and filename: ', filename,
-                ' Invalid MD5 specified')
 
-    return True
+class MetadataError(namedtuple('MetadataError', ['project_member_id',
+                                                 'filename', 'field',
+                                                 'message'])):
+    """
+    A metadata field error found by
+    :func:`find_metadata_errors<ohapi.utils_fs.find_metadata_errors>`.
+    """
+    __slots__ = ()
+
+    @property
+    def args(self):
+        return ('Error: for project member id: ', self.project_member_id,
+                ' and filename: ', self.filename, ' ' + self.message)
+
+    def __str__(self):
+        return " ".join([str(arg) for arg in self.args])
+
+
+def _metadata_batch_errors(batch):
+    """
+    Helper function to check a batch of (project_member_id, filename,
+    file_metadata) records one field at a time. Values repeated across the
+    batch, like project member IDs and dates, are only checked once.
+    """
+    errors = []
+    member_ids = set(r[0] for r in batch if r[0] is not None)
+    bad_member_ids = set(m for m in member_ids if
+                         not _is_project_member_id(m))
+    if bad_member_ids:
+        errors += [
+            (index, 0, MetadataError(
+                r[0], r[1], 'project_member_id',
+                'project member id must be of 8 digits from 0 to 9'))
+            for index, r in enumerate(batch) if r[0] in bad_member_ids]
+    for index, (member_id, filename, file_metadata) in enumerate(batch):
+        if 'description' not in file_metadata:
+            errors.append((index, 1, MetadataError(
+                member_id, filename, 'description',
+                '"description" is a required field of the metadata')))
+        elif not isinstance(file_metadata['description'], str):
+            errors.append((index, 1, MetadataError(
+                member_id, filename, 'description',
+                '"description" must be a string')))
+    for index, (member_id, filename, file_metadata) in enumerate(batch):
+        if 'tags' not in file_metadata:
+            errors.append((index, 2, MetadataError(
+                member_id, filename, 'tags',
+                '"tags" is a required field of the metadata')))
+        elif not isinstance(file_metadata['tags'], list):
+            errors.append((index, 2, MetadataError(
+                member_id, filename, 'tags',
+                '"tags" must be an array of strings')))
+    dates = [(index, r[2]['creation_date']) for index, r in
+             enumerate(batch) if 'creation_date' in r[2]]
+    errors += [(index, 3, MetadataError(
+        batch[index][0], batch[index][1], 'creation_date',
+        'Dates must be in ISO 8601 format')) for index, date in dates if
+        not validate_date(date, None, None)]
+    md5s = [(index, r[2]['md5']) for index, r in enumerate(batch) if
+            'md5' in r[2]]
+    errors += [(index, 4, MetadataError(
+        batch[index][0], batch[index][1], 'md5', 'Invalid MD5 specified'))
+        for index, md5 in md5s if
+        not (isinstance(md5, str) and MD5_RE.match(md5))]
+    return [error for _, _, error in sorted(errors, key=lambda e: e[:2])]
+
+
+def iter_metadata_errors(records, batch_size=VALIDATION_BATCH_DEFAULT):
+    """
+    Yield a MetadataError for each invalid field in a stream of records,
+    checking batch_size records at a time.
+
+    :param records: This field is an iterable of (project_member_id,
+        filename, file_metadata) tuples. project_member_id is None for
+        single user metadata.
+    :param batch_size: This field is the number of records checked together.
+        Its default value is 100000.
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        for error in _metadata_batch_errors(batch):
+            yield error
+
+
+def metadata_records(metadata, multi_user=False):
+    """
+    Yield (project_member_id, filename, file_metadata) records from metadata
+    returned by :func:`load_metadata_csv<ohapi.utils_fs.load_metadata_csv>`.
+
+    :param metadata: This field is the metadata dict.
+    :param multi_user: This field is True if metadata is keyed by project
+        member ID. Its default value is False.
+    """
+    if multi_user:
+        for project_member_id, member_metadata in metadata.items():
+            for filename, file_metadata in member_metadata.items():
+                yield project_member_id, filename, file_metadata
+    else:
+        for filename, file_metadata in metadata.items():
+            yield None, filename, file_metadata
+
+
+def find_metadata_errors(records, batch_size=VALIDATION_BATCH_DEFAULT):
+    """
+    Check metadata fields like project member id, description, tags, md5 and
+    creation date for many files at once. Returns a list of MetadataError,
+    with every invalid field reported rather than only the first.
+
+    :param records: This field is an iterable of (project_member_id,
+        filename, file_metadata) tuples, e.g. from
+        :func:`metadata_records<ohapi.utils_fs.metadata_records>`.
+    :param batch_size: This field is the number of records checked together.
+        Its default value is 100000.
+    """
+    return list(iter_metadata_errors(records, batch_size=batch_size))
+
+
+def _review_single_user_errors(filedir, metadata):
+    return (_metadata_dir_errors(filedir, metadata) +
+            [str(e) for e in find_metadata_errors(metadata_records(metadata))])
 
 
 def review_metadata_csv_single_user(filedir, metadata, csv_in, n_headers):
     """
     Check validity of metadata for single user.
 
+    All errors found are printed.
+
     :param filedir: This field is the filepath of the directory whose csv
         has to be made.
     :param metadata: This field is the metadata generated from the
@@ -304,15 +1018,29 @@ def review_metadata_csv_single_user(filedir, metadata, csv_in, n_headers):
         csv.
     :param n_headers: This field is the number of headers in the csv.
     """
-    try:
-        if not validate_metadata(filedir, metadata):
-            return False
-        for filename, file_metadata in metadata.items():
-            is_single_file_metadata_valid(file_metadata, None, filename)
-    except ValueError as e:
-        print_error(e)
-        return False
-    return True
+    errors = _review_single_user_errors(filedir, metadata)
+    for error in errors:
+        print(error)
+    return not errors
+
+
+def _subfolder_errors(filedir, metadata):
+    """
+    Helper function to list mismatches between subfolders of filedir and
+    the project member IDs in metadata, compared as sets.
+    """
+    if not os.path.isdir(filedir):
+        return ["Error: " + filedir + " is not a directory"]
+    subfolders = set(os.listdir(filedir))
+    metadata_subfolders = set(metadata)
+    errors = []
+    for subfolder in sorted(subfolders - metadata_subfolders):
+        errors.append("Error: folder " + subfolder +
+                      " present on disk but not in metadata")
+    for subfolder in sorted(metadata_subfolders - subfolders):
+        errors.append("Error: folder " + subfolder +
+                      " present in metadata but not on disk")
+    return errors
 
 
 def validate_subfolders(filedir, metadata):
@@ -320,31 +1048,35 @@ def validate_subfolders(filedir, metadata):
     Check that all folders in the given directory have a corresponding
     entry in the metadata file, and vice versa.
 
+    All mismatches are printed.
+
     :param filedir: This field is the target directory from which to
         match metadata
     :param metadata: This field contains the metadata to be matched.
     """
-    if not os.path.isdir(filedir):
-        print("Error: " + filedir + " is not a directory")
-        return False
-    subfolders = os.listdir(filedir)
-    for subfolder in subfolders:
-        if subfolder not in metadata:
-            print("Error: folder " + subfolder +
-                  " present on disk but not in metadata")
-            return False
-    for subfolder in metadata:
-        if subfolder not in subfolders:
-            print("Error: folder " + subfolder +
-                  " present in metadata but not on disk")
-            return False
-    return True
+    errors = _subfolder_errors(filedir, metadata)
+    for error in errors:
+        print(error)
+    return not errors
+
+
+def _review_multi_user_errors(filedir, metadata):
+    errors = _subfolder_errors(filedir, metadata)
+    for project_member_id, member_metadata in metadata.items():
+        member_dir = os.path.join(filedir, project_member_id)
+        if os.path.isdir(member_dir):
+            errors += _metadata_dir_errors(member_dir, member_metadata)
+    errors += [str(e) for e in find_metadata_errors(
+        metadata_records(metadata, multi_user=True))]
+    return errors
 
 
 def review_metadata_csv_multi_user(filedir, metadata, csv_in, n_headers):
     """
     Check validity of metadata for multi user.
 
+    All errors found are printed.
+
     :param filedir: This field is the filepath of the directory whose csv
         has to be made.
     :param metadata: This field is the metadata generated from the
@@ -353,131 +1085,765 @@ def review_metadata_csv_multi_user(filedir, metadata, csv_in, n_headers):
         csv.
     :param n_headers: This field is the number of headers in the csv.
     """
-    try:
-        if not validate_subfolders(filedir, metadata):
-            return False
-        for project_member_id, member_metadata in metadata.items():
-            if not validate_metadata(os.path.join
-                                     (filedir, project_member_id),
-                                     member_metadata):
-                return False
-            for filename, file_metadata in member_metadata.items():
-                is_single_file_metadata_valid(file_metadata, project_member_id,
-                                              filename)
-
-    except ValueError as e:
-        print_error(e)
-        return False
-    return True
+    errors = _review_multi_user_errors(filedir, metadata)
+    for error in errors:
+        print(error)
+    return not errors
 
 
 def review_metadata_csv(filedir, input_filepath):
     """
     Check validity of metadata fields.
 
+    The metadata file is read once, and all errors found are printed.
+    JSON Lines metadata files are detected by their extension (see
+    :func:`is_jsonl_path<ohapi.utils_fs.is_jsonl_path>`).
+
     :param filedir: This field is the filepath of the directory whose csv
         has to be made.
-    :param outputfilepath: This field is the file path of the output csv.
-    :param max_bytes: This field is the maximum file size to consider. Its
-        default value is 128m.
+    :param input_filepath: This field is the file path of the metadata csv.
     """
+    errors = []
     try:
-        metadata = load_metadata_csv(input_filepath)
+        with open(input_filepath) as f:
+            if is_jsonl_path(input_filepath):
+                multi_user, metadata = _read_metadata_jsonl(f, errors=errors)
+            else:
+                header, metadata = _read_metadata_csv(f, errors=errors)
+                multi_user = header[0] == 'project_member_id'
     except ValueError as e:
         print_error(e)
         return False
 
-    with open(input_filepath) as f:
-        csv_in = csv.reader(f)
-        header = next(csv_in)
-        n_headers = len(header)
-        if header[0] == 'filename':
-            res = review_metadata_csv_single_user(filedir, metadata,
-                                                  csv_in, n_headers)
-            return res
-        if header[0] == 'project_member_id':
-            res = review_metadata_csv_multi_user(filedir, metadata,
-                                                 csv_in, n_headers)
-            return res
+    if multi_user:
+        errors += _review_multi_user_errors(filedir, metadata)
+    else:
+        errors += _review_single_user_errors(filedir, metadata)
+    for error in errors:
+        print(error)
+    return not errors
+
+
+def _list_member_subdirs(filedir):
+    """
+    Helper function to list the project member ID subdirectories of filedir,
+    raising a ValueError if any subdirectory isn't a project member ID.
+    """
+    subdirs = [entry.name for entry in os.scandir(filedir) if
+               entry.is_dir()]
+    if subdirs:
+        logging.info('Making metadata for subdirs of {}'.format(filedir))
+        if not all([re.match('^[0-9]{8}$', d) for d in subdirs]):
+            raise ValueError("Subdirs not all project member ID format!")
+    return subdirs
+
+
+def iter_metadata_records(filedir, max_bytes=MAX_FILE_DEFAULT, processes=1,
+                          buffer_size=HASH_BUFFER_DEFAULT,
+                          mmap_threshold=None, hash_cache=None,
+                          subdirs=None):
+    """
+    Yield (project_member_id, filename, file_info) for all files in a
+    directory, as files are characterized. Files are hashed ahead of the
+    records being yielded, in parallel if processes isn't 1, across all
+    member subdirectories.
+
+    project_member_id is None if the directory has no member subdirectories.
+    For member subdirectories without files, filename and file_info are None.
+
+    filedir may instead be a tar or zip archive laid out in the same way (see
+    :func:`iter_archive_files<ohapi.utils_fs.iter_archive_files>`). Its
+    files are hashed as they are read from the archive, in a single pass
+    without extracting them, and creation dates are their modification
+    times. processes, mmap_threshold and hash_cache aren't used for
+    archives.
+
+    :param filedir: This field is the filepath of the directory whose csv
+        has to be made.
+    :param max_bytes: This field is the maximum file size to consider. Its
+        default value is 128m.
+    :param processes: This field is the number of worker processes used to
+        hash files. If None or 0, one process per CPU core is used. Its
+        default value is 1.
+    :param buffer_size: This field is the size of reads from each file. Its
+        default value is 1 MiB.
+    :param mmap_threshold: If provided, files at least this size are memory
+        mapped instead of read in chunks. Its default value is None.
+    :param hash_cache: If provided, this HashCache is used to skip hashing
+        unchanged files. Its default value is None.
+    :param subdirs: If provided, this list of member subdirectories is used
+        instead of listing filedir again. Its default value is None.
+    """
+    if is_archive(filedir):
+        for record in _iter_archive_metadata_records(
+                filedir, max_bytes=max_bytes, buffer_size=buffer_size):
+            yield record
+        return
+    if subdirs is None:
+        subdirs = _list_member_subdirs(filedir)
+    if not subdirs:
+        for filename, file_info in iter_local_file_data(
+                filedir, max_bytes=max_bytes, processes=processes,
+                buffer_size=buffer_size, mmap_threshold=mmap_threshold,
+                hash_cache=hash_cache):
+            yield None, filename, file_info
+        return
+
+    def jobs():
+        for proj_member_id in subdirs:
+            subdir = os.path.join(filedir, proj_member_id)
+            logging.info('Characterizing files in {}'.format(subdir))
+            empty = True
+            for filename, filepath, file_stats, md5 in _scan_files(
+                    subdir, max_bytes, hash_cache=hash_cache):
+                empty = False
+                yield (proj_member_id, filename), filepath, file_stats, md5
+            if empty:
+                yield (proj_member_id, None), None, None, None
+
+    for (proj_member_id, filename), file_stats, md5 in _iter_hashed(
+            jobs(), processes=processes, buffer_size=buffer_size,
+            mmap_threshold=mmap_threshold, hash_cache=hash_cache):
+        if filename is None:
+            yield proj_member_id, None, None
+        else:
+            yield (proj_member_id, filename,
+                   _file_info(filename, file_stats, md5))
+
+
+def iter_metadata_rows(filedir, max_bytes=MAX_FILE_DEFAULT, processes=1,
+                       buffer_size=HASH_BUFFER_DEFAULT, mmap_threshold=None,
+                       hash_cache=None):
+    """
+    Yield metadata CSV rows (header first) for all files in a directory, as
+    files are characterized. See
+    :func:`iter_metadata_records<ohapi.utils_fs.iter_metadata_records>` for
+    the parameters.
+    """
+    records = iter_metadata_records(
+        filedir, max_bytes=max_bytes, processes=processes,
+        buffer_size=buffer_size, mmap_threshold=mmap_threshold,
+        hash_cache=hash_cache)
+    # The first record shows whether there are member subdirectories.
+    first = next(records, None)
+    if first is not None and first[0] is not None:
+        yield ['project_member_id', 'filename', 'tags', 'description', 'md5',
+               'creation_date']
+    else:
+        yield ['filename', 'tags', 'description', 'md5', 'creation_date']
+    if first is None:
+        return
+    for proj_member_id, filename, file_info in chain([first], records):
+        if filename is None:
+            yield [proj_member_id, 'None', 'NA', 'NA', 'NA', 'NA']
+            continue
+        row = [filename,
+               ', '.join(file_info['tags']),
+               file_info['description'],
+               file_info['md5'],
+               file_info['creation_date']]
+        yield row if proj_member_id is None else [proj_member_id] + row
+
+
+def write_metadata_jsonl_to_filestream(filedir, filestream,
+                                       max_bytes=MAX_FILE_DEFAULT,
+                                       processes=1,
+                                       buffer_size=HASH_BUFFER_DEFAULT,
+                                       mmap_threshold=None, hash_cache=None):
+    """
+    Make a JSON Lines metadata file for all files in a directory, with one
+    JSON object per file. Member subdirectories without files are written
+    as {"project_member_id": ..., "filename": null}. See
+    :func:`iter_metadata_records<ohapi.utils_fs.iter_metadata_records>` for
+    the parameters.
+    """
+    for proj_member_id, filename, file_info in iter_metadata_records(
+            filedir, max_bytes=max_bytes, processes=processes,
+            buffer_size=buffer_size, mmap_threshold=mmap_threshold,
+            hash_cache=hash_cache):
+        record = OrderedDict()
+        if proj_member_id is not None:
+            record['project_member_id'] = proj_member_id
+        record['filename'] = filename
+        for key in ['tags', 'description', 'md5', 'creation_date']:
+            if file_info is not None:
+                record[key] = file_info[key]
+        filestream.write(json.dumps(record) + '\n')
 
 
 def write_metadata_to_filestream(filedir, filestream,
-                                 max_bytes=MAX_FILE_DEFAULT):
+                                 max_bytes=MAX_FILE_DEFAULT, processes=1,
+                                 buffer_size=HASH_BUFFER_DEFAULT,
+                                 mmap_threshold=None, hash_cache=None):
     """
     Make metadata file for all files in a directory(helper function)
 
+    Rows are written as files are characterized, see
+    :func:`iter_metadata_rows<ohapi.utils_fs.iter_metadata_rows>`.
+
     :param filedir: This field is the filepath of the directory whose csv
         has to be made.
     :param filestream: This field is a stream for writing to the csv.
     :param max_bytes: This field is the maximum file size to consider. Its
         default value is 128m.
+    :param processes: This field is the number of worker processes used to
+        hash files. If None or 0, one process per CPU core is used. Its
+        default value is 1.
+    :param buffer_size: This field is the size of reads from each file. Its
+        default value is 1 MiB.
+    :param mmap_threshold: If provided, files at least this size are memory
+        mapped instead of read in chunks. Its default value is None.
+    :param hash_cache: If provided, this HashCache is used to skip hashing
+        unchanged files. Its default value is None.
     """
     csv_out = csv.writer(filestream)
-    subdirs = [os.path.join(filedir, i) for i in os.listdir(filedir) if
-               os.path.isdir(os.path.join(filedir, i))]
-    if subdirs:
-        logging.info('Making metadata for subdirs of {}'.format(filedir))
-        if not all([re.match('^[0-9]{8}$', os.path.basename(d))
-                    for d in subdirs]):
-            raise ValueError("Subdirs not all project member ID format!")
-        csv_out.writerow(['project_member_id', 'filename', 'tags',
-                          'description', 'md5', 'creation_date'])
-        for subdir in subdirs:
-            file_info = characterize_local_files(
-                filedir=subdir, max_bytes=max_bytes)
-            proj_member_id = os.path.basename(subdir)
-            if not file_info:
-                csv_out.writerow([proj_member_id, 'None',
-                                  'NA', 'NA', 'NA', 'NA'])
-                continue
-            for filename in file_info:
-                csv_out.writerow([proj_member_id,
-                                  filename,
-                                  ', '.join(file_info[filename]['tags']),
-                                  file_info[filename]['description'],
-                                  file_info[filename]['md5'],
-                                  file_info[filename]['creation_date'],
-                                  ])
-    else:
-        csv_out.writerow(['filename', 'tags',
-                          'description', 'md5', 'creation_date'])
-        file_info = characterize_local_files(
-            filedir=filedir, max_bytes=max_bytes)
-        for filename in file_info:
-            csv_out.writerow([filename,
-                              ', '.join(file_info[filename]['tags']),
-                              file_info[filename]['description'],
-                              file_info[filename]['md5'],
-                              file_info[filename]['creation_date'],
-                              ])
+    for row in iter_metadata_rows(filedir, max_bytes=max_bytes,
+                                  processes=processes,
+                                  buffer_size=buffer_size,
+                                  mmap_threshold=mmap_threshold,
+                                  hash_cache=hash_cache):
+        csv_out.writerow(row)
 
 
-def mk_metadata_csv(filedir, outputfilepath, max_bytes=MAX_FILE_DEFAULT):
+def mk_metadata_csv(filedir, outputfilepath, max_bytes=MAX_FILE_DEFAULT,
+                    processes=1, buffer_size=HASH_BUFFER_DEFAULT,
+                    mmap_threshold=None, hash_cache=None):
     """
     Make metadata file for all files in a directory.
 
+    If outputfilepath ends with ".jsonl" or ".ndjson", a JSON Lines file
+    is written instead of a CSV. filedir may be a tar or zip archive, see
+    :func:`iter_metadata_records<ohapi.utils_fs.iter_metadata_records>`.
+
     :param filedir: This field is the filepath of the directory whose csv
         has to be made.
     :param outputfilepath: This field is the file path of the output csv.
+    :param max_bytes: This field is the maximum file size to consider. Its
+        default value is 128m.
+    :param processes: This field is the number of worker processes used to
+        hash files. If None or 0, one process per CPU core is used. Its
+        default value is 1.
+    :param buffer_size: This field is the size of reads from each file. Its
+        default value is 1 MiB.
+    :param mmap_threshold: If provided, files at least this size are memory
+        mapped instead of read in chunks. Its default value is None.
+    :param hash_cache: If provided, this is the filepath of a HashCache
+        database, so that only new or modified files are hashed. Its default
+        value is None.
+    """
+    if is_jsonl_path(outputfilepath):
+        write_func = write_metadata_jsonl_to_filestream
+    else:
+        write_func = write_metadata_to_filestream
+    cache = HashCache(hash_cache) if hash_cache else None
+    try:
+        with open(outputfilepath, 'w') as filestream:
+            write_func(filedir, filestream, max_bytes,
+                       processes=processes, buffer_size=buffer_size,
+                       mmap_threshold=mmap_threshold, hash_cache=cache)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def append_manifest(manifest, target_filepath, size, digests):
+    """
+    Record a downloaded file's digests in a JSON Lines manifest, with one
+    object per file holding its "filepath", "size" and digests.
+
+    :param manifest: This field is the filepath of the manifest. It's
+        appended to, and created if it doesn't exist.
+    :param target_filepath: This field is the path of the downloaded file.
+    :param size: This field is the size of the downloaded file.
+    :param digests: This field is a dict of hash names (e.g. "md5") to
+        hexdigests.
+    """
+    record = OrderedDict([('filepath', target_filepath), ('size', size)])
+    record.update(digests)
+    with open(manifest, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def read_manifest(manifest):
+    """
+    Return a dict of the records in a JSON Lines manifest of downloaded
+    files, keyed by filepath. If a file was recorded more than once, its
+    latest record is returned. A missing manifest has no records.
+
+    :param manifest: This field is the filepath of the manifest.
+    """
+    records = {}
+    if not os.path.exists(manifest):
+        return records
+    with open(manifest) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records[record['filepath']] = record
+    return records
+
+
+def read_download_state(filepath):
+    """
+    Return the state recorded by an earlier incremental download (e.g. its
+    "since" high-water mark) as a dict, or an empty dict if there's no state
+    file.
+
+    :param filepath: This field is the path of the JSON state file.
+    """
+    if not os.path.exists(filepath):
+        return {}
+    with open(filepath) as f:
+        return json.load(f)
+
+
+def write_download_state(filepath, state):
+    """
+    Record the state of an incremental download as JSON. The file is
+    replaced atomically, so an interrupted write leaves the earlier state.
+
+    :param filepath: This field is the path of the JSON state file.
+    :param state: This field is a dict of the state to record.
+    """
+    temp_filepath = '{}.tmp'.format(filepath)
+    with open(temp_filepath, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temp_filepath, filepath)
+
+
+def archive_format(filepath):
+    """
+    Return "tar" or "zip" if a filepath is an archive, judging by its
+    extension (e.g. ".tar.gz" or ".zip"), or None otherwise.
+
+    :param filepath: This field is the filepath.
+    """
+    filepath = filepath.lower()
+    if filepath.endswith(TAR_SUFFIXES):
+        return 'tar'
+    elif filepath.endswith(ZIP_SUFFIXES):
+        return 'zip'
+    return None
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    Read-only file object over an iterable of byte chunks.
+
+    If verify is given, it's called once the chunks run out, before the last
+    bytes are read, so a reader copying exactly the expected size never gets
+    all of an invalid file.
+    """
+    def __init__(self, chunks, verify=None):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self._verify = verify
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self):
+        for chunk in self._chunks:
+            if chunk:
+                return chunk
+        if self._verify is not None:
+            verify, self._verify = self._verify, None
+            verify()
+        return b''
+
+    def readinto(self, b):
+        if not self._buffer:
+            self._buffer = self._next_chunk()
+        n = min(len(b), len(self._buffer))
+        if n == len(self._buffer) and n:
+            # Look ahead, so the file is verified before its end is read.
+            following = self._next_chunk()
+        else:
+            following = None
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        if following:
+            self._buffer = following
+        return n
+
+
+class DownloadSink(object):
+    """
+    Base class for the destinations files are downloaded to, by
+    :func:`download_file<ohapi.utils_fs.download_file>`. Sinks can be used
+    as context managers, which close them.
+
+    If a failed write leaves a sink unusable (e.g. an archive with a partly
+    written file), error is set to the exception.
+    """
+    error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def exists(self, path, size):
+        """
+        Return True if the file exists with this size, so it can be skipped.
+        """
+        raise NotImplementedError
+
+    def write(self, path, size, chunks, verify=None):
+        """
+        Write a file from an iterable of byte chunks. If verify is given, it's
+        called once every chunk is written, and raises an exception if the
+        file is invalid. Sinks discard invalid files where they can.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class DirectorySink(DownloadSink):
+    """
+    Download sink writing files under a local directory.
+
+    Each file is written to a temporary file alongside its target, which
+    then replaces the target in a single rename, so concurrent downloads of
+    the same file never leave a partial or mixed file at the target path.
+    Subdirectories of directory are created as needed. With no directory,
+    paths are used as given and their directories must already exist.
+    """
+    def __init__(self, directory=''):
+        self.directory = directory
+
+    def exists(self, path, size):
+        filepath = os.path.join(self.directory, path)
+        if not os.path.exists(filepath):
+            return False
+        if os.stat(filepath).st_size == size:
+            return True
+        logging.info('Replacing, file exists and is the wrong '
+                     'size: {}'.format(filepath))
+        return False
+
+    def write(self, path, size, chunks, verify=None):
+        filepath = os.path.join(self.directory, path)
+        if self.directory:
+            os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        temp_filepath = '{}.{}-{}.part'.format(filepath, os.getpid(),
+                                               threading.get_ident())
+        try:
+            with open(temp_filepath, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            if verify is not None:
+                verify()
+            os.replace(temp_filepath, filepath)
+        except BaseException:
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+            raise
+
+
+class MemorySink(DownloadSink):
+    """
+    Download sink keeping files in memory, as a dict of path to bytes in
+    its files attribute.
+    """
+    def __init__(self):
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def exists(self, path, size):
+        return path in self.files and len(self.files[path]) == size
+
+    def write(self, path, size, chunks, verify=None):
+        content = b''.join(chunks)
+        if verify is not None:
+            verify()
+        with self._lock:
+            self.files[path] = content
+
+
+class TarSink(DownloadSink):
+    """
+    Download sink streaming files into a new tar archive, compressed with
+    gzip or bz2 if filepath ends in e.g. ".tar.gz" or ".tar.bz2".
+
+    Files are streamed from their download into the archive with no
+    intermediate files, one at a time. A file already written with the same
+    size exists, so it's skipped. A file is verified before its last bytes
+    are written, but as the archive can't be rewound, a file failing
+    verification (or any failed write) leaves the archive incomplete: error
+    is set, the error is raised, and no more files can be written.
+
+    The archive is written to a temporary file, which replaces filepath when
+    the sink is closed. An incomplete archive is left at filepath with
+    ".incomplete" added instead.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.sizes = {}
+        self._lock = threading.Lock()
+        lower = filepath.lower()
+        if lower.endswith(('.gz', '.tgz')):
+            mode = 'w|gz'
+        elif lower.endswith(('.bz2', '.tbz2')):
+            mode = 'w|bz2'
+        else:
+            mode = 'w|'
+        self._temp_filepath = '{}.{}.part'.format(filepath, os.getpid())
+        self._archive = tarfile.open(self._temp_filepath, mode)
+
+    def exists(self, path, size):
+        return self.sizes.get(path) == size
+
+    def write(self, path, size, chunks, verify=None):
+        tarinfo = tarfile.TarInfo(path.replace(os.sep, '/'))
+        tarinfo.size = size
+        tarinfo.mtime = time.time()
+        tarinfo.mode = 0o644
+        with self._lock:
+            self._check_error()
+            try:
+                self._archive.addfile(tarinfo, io.BufferedReader(
+                    _ChunkReader(chunks, verify=verify)))
+            except BaseException as e:
+                self.error = e
+                raise
+            self.sizes[path] = size
+
+    def _check_error(self):
+        if self.error is not None:
+            raise IOError('Archive {} is incomplete after an error: '
+                          '{}'.format(self.filepath, self.error))
+
+    def close(self):
+        self._archive.close()
+        if self.error is None:
+            os.replace(self._temp_filepath, self.filepath)
+            return
+        incomplete_filepath = self.filepath + '.incomplete'
+        os.replace(self._temp_filepath, incomplete_filepath)
+        logging.error('Archive {} is incomplete after an error ({}), and was '
+                      'left at {}'.format(self.filepath, self.error,
+                                          incomplete_filepath))
+
+
+class ZipSink(TarSink):
+    """
+    Download sink streaming files into a new zip archive. See
+    :class:`TarSink<ohapi.utils_fs.TarSink>`.
+
+    On Python 3.5, where zip entries can't be written as a stream, each
+    file is held in memory while it's added, so it's verified before it's
+    added, and a file failing verification is left out.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.sizes = {}
+        self._lock = threading.Lock()
+        self._temp_filepath = '{}.{}.part'.format(filepath, os.getpid())
+        self._archive = zipfile.ZipFile(self._temp_filepath, 'w',
+                                        zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def write(self, path, size, chunks, verify=None):
+        name = path.replace(os.sep, '/')
+        zipinfo = zipfile.ZipInfo(name, time.localtime()[:6])
+        zipinfo.compress_type = zipfile.ZIP_DEFLATED
+        if sys.version_info < (3, 6):
+            # The file is in memory, so it's verified before it's added.
+            content = b''.join(chunks)
+            if verify is not None:
+                verify()
+            chunks, verify = [content], None
+        with self._lock:
+            self._check_error()
+            try:
+                if sys.version_info < (3, 6):
+                    self._archive.writestr(zipinfo, chunks[0])
+                else:
+                    zipinfo.file_size = size
+                    with self._archive.open(zipinfo, 'w',
+                                            force_zip64=True) as f:
+                        shutil.copyfileobj(_ChunkReader(chunks, verify), f)
+            except BaseException as e:
+                self.error = e
+                raise
+            self.sizes[path] = size
+
+
+def open_sink(target):
+    """
+    Return a download sink for a target: a :class:`TarSink
+    <ohapi.utils_fs.TarSink>` or :class:`ZipSink<ohapi.utils_fs.ZipSink>`
+    if target is an archive filepath (see :func:`archive_format
+    <ohapi.utils_fs.archive_format>`), otherwise a :class:`DirectorySink
+    <ohapi.utils_fs.DirectorySink>`. An archive is created anew, replacing
+    any existing file when it's closed (unless it's incomplete).
+
+    :param target: This field is the target directory or archive filepath.
+    """
+    archive = archive_format(target)
+    if archive == 'tar':
+        return TarSink(target)
+    elif archive == 'zip':
+        return ZipSink(target)
+    return DirectorySink(target)
+
+
+def is_archive(filepath):
+    """
+    Return True if filepath is an existing tar or zip archive file (see
+    :func:`archive_format<ohapi.utils_fs.archive_format>`).
+
+    :param filepath: This field is the filepath.
+    """
+    return os.path.isfile(filepath) and archive_format(filepath) is not None
+
+
+def _iter_archive_entries(archive, fmt):
+    """
+    Helper generator yielding (name, is_dir, size, mtime, open_entry) for
+    the entries of an open tar or zip archive. Zip entries are sorted by
+    name, tar entries are in archive order.
+    """
+    if fmt == 'zip':
+        for info in sorted(archive.infolist(), key=lambda i: i.filename):
+            yield (info.filename, info.filename.endswith('/'),
+                   info.file_size, time.mktime(info.date_time + (0, 0, -1)),
+                   partial(archive.open, info))
+        return
+    for entry in archive:
+        if entry.isdir():
+            yield entry.name, True, None, entry.mtime, None
+        elif entry.isfile():
+            yield (entry.name, False, entry.size, entry.mtime,
+                   partial(archive.extractfile, entry))
+
+
+def iter_archive_files(filepath, max_bytes=MAX_FILE_DEFAULT):
+    """
+    Yield (project_member_id, filename, size, mtime, fileobj) for the files
+    in a tar or zip archive, laid out as a directory of files for upload:
+    either files at the top level, or files in project member ID
+    subdirectories (when project_member_id is None for every file).
+
+    Tar archives (compressed or not) are read as a stream in a single pass,
+    so each fileobj can only be read until the next file is yielded. Zip
+    entries are yielded sorted by name. Member subdirectories without files
+    are yielded last, as (project_member_id, None, None, None, None).
+
+    :param filepath: This field is the filepath of the archive.
     :param max_bytes: This field is the maximum file size to consider. Its
         default value is 128m.
     """
-    with open(outputfilepath, 'w') as filestream:
-        write_metadata_to_filestream(filedir, filestream, max_bytes)
+    fmt = archive_format(filepath)
+    if fmt == 'zip':
+        archive = zipfile.ZipFile(filepath)
+    else:
+        archive = tarfile.open(filepath, 'r|*')
+    multi_user = None
+    member_dirs = set()
+    members_with_files = set()
+    try:
+        for name, is_dir, size, mtime, open_entry in _iter_archive_entries(
+                archive, fmt):
+            parts = [part for part in name.split('/') if part not in
+                     ('', '.')]
+            if is_dir:
+                if len(parts) == 1 and re.match('^[0-9]{8}$', parts[0]):
+                    member_dirs.add(parts[0])
+                continue
+            if len(parts) == 2 and re.match('^[0-9]{8}$', parts[0]):
+                project_member_id, filename = parts
+            elif len(parts) == 1:
+                project_member_id, filename = None, parts[0]
+            else:
+                raise ValueError('Archive files should be at the top level, '
+                                 'or in project member ID subdirectories: '
+                                 '{}'.format(name))
+            if multi_user is None:
+                multi_user = project_member_id is not None
+            elif multi_user != (project_member_id is not None):
+                raise ValueError('Archive has files both at the top level '
+                                 'and in project member ID subdirectories!')
+            if size > max_bytes:
+                logging.info('Skipping {}, {} > {}'.format(
+                    name, format_size(size), format_size(max_bytes)))
+                continue
+            members_with_files.add(project_member_id)
+            with open_entry() as fileobj:
+                yield project_member_id, filename, size, mtime, fileobj
+        if multi_user is not False:
+            for project_member_id in sorted(member_dirs - members_with_files):
+                yield project_member_id, None, None, None, None
+    finally:
+        archive.close()
+
+
+def _iter_archive_metadata_records(filepath, max_bytes=MAX_FILE_DEFAULT,
+                                   buffer_size=HASH_BUFFER_DEFAULT):
+    """
+    Helper generator yielding (project_member_id, filename, file_info) for
+    the files in an archive, hashing each file as it's read from the
+    archive. See :func:`iter_archive_files
+    <ohapi.utils_fs.iter_archive_files>`.
+    """
+    logging.info('Characterizing files in {}'.format(filepath))
+    for project_member_id, filename, _, mtime, fileobj in iter_archive_files(
+            filepath, max_bytes=max_bytes):
+        if filename is None:
+            yield project_member_id, None, None
+            continue
+        md5 = hashlib.md5()
+        for chunk in iter(partial(fileobj.read, buffer_size), b''):
+            md5.update(chunk)
+        file_info = draft_file_metadata(filename, mtime)
+        file_info['md5'] = md5.hexdigest()
+        yield project_member_id, filename, file_info
 
 
-def download_file(download_url, target_filepath, max_bytes=MAX_FILE_DEFAULT):
+def download_file(download_url, target_filepath, max_bytes=MAX_FILE_DEFAULT,
+                  md5=None, sha256=False, manifest=None, sink=None,
+                  timeout=REQUEST_TIMEOUT):
     """
     Download a file.
 
+    The MD5 (and optionally SHA-256) of the file is computed from the chunks
+    as they are written, so verifying a download doesn't read it again.
+
+    The file is streamed into a sink, by default a :class:`DirectorySink
+    <ohapi.utils_fs.DirectorySink>`, which writes to a temporary file
+    alongside the target and then renames it to the target. Concurrent
+    downloads of the same file (e.g. by several processes) therefore never
+    leave a partial or mixed file at the target path.
+
     :param download_url: This field is the url from which data will be
         downloaded.
     :param target_filepath: This field is the path of the file where
         data will be downloaded.
     :param max_bytes: This field is the maximum file size to download. Its
         default value is 128m.
+    :param md5: If provided, this field is the expected MD5 hexdigest. If the
+        downloaded file doesn't match, it's removed and a ValueError is
+        raised. Its default value is None.
+    :param sha256: If True, the SHA-256 of the file is also computed. Its
+        default value is False.
+    :param manifest: If provided, this field is the filepath of a JSON Lines
+        manifest in which the digests of downloaded files are recorded. See
+        :func:`append_manifest<ohapi.utils_fs.append_manifest>`. Its default
+        value is None.
+    :param sink: If provided, this field is the sink (see :func:`open_sink
+        <ohapi.utils_fs.open_sink>`) the file is written to, and
+        target_filepath is its path within the sink. Its default value is
+        None, for a local file.
+    :param timeout: This field is the number of seconds to wait to connect,
+        or for data, before the download fails with
+        requests.exceptions.Timeout. Its default value is REQUEST_TIMEOUT
+        (the OHAPI_REQUEST_TIMEOUT environment variable, or 60).
     """
-    response = requests.get(download_url, stream=True)
+    response = requests.get(download_url, stream=True, timeout=timeout)
+    handle_error(response, 200)
     size = int(response.headers['Content-Length'])
 
     if _exceeds_size(size, max_bytes, target_filepath) is True:
@@ -486,21 +1852,37 @@ def download_file(download_url, target_filepath, max_bytes=MAX_FILE_DEFAULT):
     logging.info('Downloading {} ({})'.format(
         target_filepath, format_size(size)))
 
-    if os.path.exists(target_filepath):
-        stat = os.stat(target_filepath)
-        if stat.st_size == size:
-            logging.info('Skipping, file exists and is the right '
-                         'size: {}'.format(target_filepath))
-            return response
-        else:
-            logging.info('Replacing, file exists and is the wrong '
-                         'size: {}'.format(target_filepath))
-            os.remove(target_filepath)
+    if sink is None:
+        sink = DirectorySink()
+    if sink.exists(target_filepath, size):
+        logging.info('Skipping, file exists and is the right '
+                     'size: {}'.format(target_filepath))
+        return response
+
+    hashes = OrderedDict([('md5', hashlib.md5())])
+    if sha256:
+        hashes['sha256'] = hashlib.sha256()
+    digests = OrderedDict()
 
-    with open(target_filepath, 'wb') as f:
+    def chunks():
         for chunk in response.iter_content(chunk_size=8192):
             if chunk:
-                f.write(chunk)
+                for file_hash in hashes.values():
+                    file_hash.update(chunk)
+                yield chunk
+
+    def verify():
+        digests.update(
+            (name, file_hash.hexdigest()) for name, file_hash in
+            hashes.items())
+        if md5 and digests['md5'] != md5.lower():
+            raise ValueError(
+                'MD5 mismatch for {}: expected {}, got {}'.format(
+                    target_filepath, md5, digests['md5']))
+
+    sink.write(target_filepath, size, chunks(), verify=verify)
+    if manifest:
+        append_manifest(manifest, target_filepath, size, digests)
 
     logging.info('Download complete: {}'.format(target_filepath))
     return response
@@ -524,3 +1906,37 @@ def read_id_list(filepath):
             else:
                 id_list.append(line)
     return id_list
+
+
+def read_delete_targets(filepath):
+    """
+    Get (project_member_id, file) pairs to delete from a CSV file.
+
+    The CSV must have a "project_member_id" column, and "file_basename"
+    and/or "file_id" columns. Rows giving neither a basename nor an ID
+    target all files of that member.
+
+    :param filepath: This field is the path of the CSV file to read.
+    """
+    targets = []
+    with open(filepath) as f:
+        csv_in = csv.DictReader(f)
+        if 'project_member_id' not in (csv_in.fieldnames or []):
+            raise ValueError('"project_member_id" is a compulsory column in '
+                             'the delete targets file.')
+        for index, row in enumerate(csv_in, 2):
+            project_member_id = row['project_member_id'].strip()
+            file_basename = (row.get('file_basename') or '').strip()
+            file_id = (row.get('file_id') or '').strip()
+            if not re.match('^[0-9]{8}$', project_member_id):
+                raise ValueError('Error: In row number ' + str(index) + ':' +
+                                 ' "project_member_id" must be 8 digits.')
+            if file_basename and file_id:
+                raise ValueError('Error: In row number ' + str(index) + ':' +
+                                 ' specify "file_basename" or "file_id",'
+                                 ' not both.')
+            if file_id:
+                targets.append((project_member_id, int(file_id)))
+            else:
+                targets.append((project_member_id, file_basename or None))
+    return targets
@@ -0,0 +1,401 @@
+"""
+A file-backed work queue shared by cooperating processes on one host.
+
+Several processes (e.g. ``ohproj-download --queue``) can attach to the same
+SQLite queue file. The first to arrive seeds the queue with the work it
+planned while the others wait, then each claims items one at a time with a
+lease. Leases are renewed while items run, so each item is claimed by
+exactly one worker, and an item whose lease expires (e.g. because its
+worker was killed) is queued again for another worker.
+"""
+from collections import namedtuple
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from .api import _run_concurrently
+from .projects import MAX_SIZE_DEFAULT
+from .sync import SyncAction, _run_download, _run_upload
+
+LEASE_SECONDS_DEFAULT = 15 * 60
+MAX_ATTEMPTS_DEFAULT = 3
+SEED_POLL_SECONDS = 1
+SEED_META = '_seed'
+STATES = ('pending', 'leased', 'done', 'failed')
+
+
+class WorkItem(namedtuple('WorkItem', ['key', 'payload', 'attempts'])):
+    """
+    A claimed :class:`WorkQueue<ohapi.work_queue.WorkQueue>` item. payload
+    is the JSON-serializable value it was queued with, and attempts counts
+    its claims, including this one.
+    """
+    __slots__ = ()
+
+
+class WorkQueue(object):
+    """
+    Persistent SQLite queue of work items, keyed by a unique string.
+
+    Claims are made in an immediate transaction, so concurrent workers never
+    lease the same item. Leased items are claimable again once their lease
+    expires, so a worker should :func:`renew<ohapi.work_queue.WorkQueue.renew>`
+    the leases of items that run longer than lease_seconds (as
+    :func:`run_queue<ohapi.work_queue.run_queue>` does). Items failing
+    max_attempts times are marked as failed rather than queued again.
+
+    A queue can be shared by the threads of one worker.
+    """
+    def __init__(self, filepath, lease_seconds=LEASE_SECONDS_DEFAULT,
+                 max_attempts=MAX_ATTEMPTS_DEFAULT, worker_id=None):
+        self.filepath = filepath
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or '{}:{}'.format(socket.gethostname(),
+                                                     os.getpid())
+        # Transactions are managed explicitly, see _transaction. The
+        # connection is shared by threads (e.g. run_queue's lease renewal),
+        # one statement or transaction at a time.
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(filepath, timeout=60,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS work_items ('
+            'key TEXT PRIMARY KEY, payload TEXT, state TEXT, worker TEXT, '
+            'lease_expires REAL, attempts INTEGER, error TEXT)')
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS work_items_state '
+            'ON work_items (state, lease_expires)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS queue_meta ('
+            'name TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _transaction(self, func, *args):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(*args)
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            return result
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._conn.execute(sql, parameters)
+
+    def seed(self, func, poll_seconds=SEED_POLL_SECONDS):
+        """
+        Call func to queue the work (e.g. with :func:`enqueue_plan
+        <ohapi.work_queue.enqueue_plan>`), unless another worker has already
+        seeded the queue. If another worker is seeding it, wait until it's
+        done, so workers don't all plan the same work. A worker that doesn't
+        finish seeding within lease_seconds is replaced. Returns True if
+        this worker seeded the queue.
+
+        :param func: This field is a function, called without arguments,
+            that queues the work.
+        :param poll_seconds: This field is the number of seconds between
+            checks while waiting. It's default value is 1.
+        """
+        def start():
+            now = time.time()
+            row = self._conn.execute(
+                'SELECT value, expires FROM queue_meta WHERE name = ?',
+                (SEED_META,)).fetchone()
+            if row is not None and (row[0] == 'done' or row[1] >= now):
+                return row[0]
+            self._conn.execute(
+                'INSERT OR REPLACE INTO queue_meta (name, value, expires) '
+                'VALUES (?, ?, ?)',
+                (SEED_META, self.worker_id, now + self.lease_seconds))
+            return self.worker_id
+
+        while True:
+            seeder = self._transaction(start)
+            if seeder == 'done':
+                return False
+            if seeder == self.worker_id:
+                break
+            logging.debug('Waiting for {} to seed the queue'.format(seeder))
+            time.sleep(poll_seconds)
+        try:
+            func()
+        except BaseException:
+            self._execute('DELETE FROM queue_meta WHERE name = ?',
+                          (SEED_META,))
+            raise
+        self._execute('UPDATE queue_meta SET value = ?, expires = NULL '
+                      'WHERE name = ?', ('done', SEED_META))
+        return True
+
+    def get_meta(self, name, default=None):
+        """
+        Return a JSON-serializable value shared by the queue's workers.
+
+        :param name: This field is the value's name.
+        :param default: This field is returned if the value isn't set. It's
+            default value is None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM queue_meta WHERE name = ?',
+                (name,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_meta(self, name, value):
+        """
+        Set a JSON-serializable value shared by the queue's workers, e.g.
+        a result of planning the work.
+
+        :param name: This field is the value's name.
+        :param value: This field is the value.
+        """
+        self._execute(
+            'INSERT OR REPLACE INTO queue_meta (name, value, expires) '
+            'VALUES (?, ?, NULL)', (name, json.dumps(value)))
+
+    def put(self, key, payload):
+        """
+        Queue an item, unless it's already queued. The payload of an item
+        that isn't done is updated (e.g. with a fresh download URL).
+
+        :param key: This field is the item's unique key.
+        :param payload: This field is a JSON-serializable value.
+        """
+        self.put_many([(key, payload)])
+
+    def put_many(self, items):
+        """
+        Queue (key, payload) pairs in a single transaction. See
+        :func:`put<ohapi.work_queue.WorkQueue.put>`.
+
+        :param items: This field is an iterable of (key, payload) pairs.
+        """
+        def insert(items):
+            for key, payload in items:
+                payload = json.dumps(payload)
+                self._conn.execute(
+                    'UPDATE work_items SET payload = ? '
+                    'WHERE key = ? AND state != ?', (payload, key, 'done'))
+                self._conn.execute(
+                    'INSERT OR IGNORE INTO work_items '
+                    '(key, payload, state, attempts) VALUES (?, ?, ?, 0)',
+                    (key, payload, 'pending'))
+        self._transaction(insert, items)
+
+    def claim(self):
+        """
+        Lease the next pending (or expired) item to this worker and return
+        it as a :class:`WorkItem<ohapi.work_queue.WorkItem>`, or None if
+        there's nothing left to claim.
+        """
+        def lease():
+            now = time.time()
+            row = self._conn.execute(
+                'SELECT key, payload, attempts FROM work_items '
+                'WHERE state = ? OR (state = ? AND lease_expires < ?) '
+                'ORDER BY rowid LIMIT 1', ('pending', 'leased', now)
+            ).fetchone()
+            if row is None:
+                return None
+            key, payload, attempts = row
+            self._conn.execute(
+                'UPDATE work_items SET state = ?, worker = ?, '
+                'lease_expires = ?, attempts = ? WHERE key = ?',
+                ('leased', self.worker_id, now + self.lease_seconds,
+                 attempts + 1, key))
+            return WorkItem(key, json.loads(payload), attempts + 1)
+        return self._transaction(lease)
+
+    def renew(self, key):
+        """
+        Extend this worker's lease on an item, e.g. during a long transfer.
+        Returns False if the lease was lost to another worker.
+
+        :param key: This field is the item's key.
+        """
+        cursor = self._execute(
+            'UPDATE work_items SET lease_expires = ? '
+            'WHERE key = ? AND state = ? AND worker = ?',
+            (time.time() + self.lease_seconds, key, 'leased',
+             self.worker_id))
+        return cursor.rowcount == 1
+
+    def complete(self, key):
+        """
+        Mark an item as done, so it isn't claimed or queued again.
+
+        :param key: This field is the item's key.
+        """
+        self._execute(
+            'UPDATE work_items SET state = ?, lease_expires = NULL, '
+            'error = NULL WHERE key = ?', ('done', key))
+
+    def fail(self, key, error):
+        """
+        Release an item after an error. It's queued again unless it has been
+        claimed max_attempts times, when it's marked as failed.
+
+        :param key: This field is the item's key.
+        :param error: This field is a description of the error.
+        """
+        self._execute(
+            'UPDATE work_items SET state = CASE WHEN attempts >= ? '
+            'THEN ? ELSE ? END, lease_expires = NULL, error = ? '
+            'WHERE key = ?',
+            (self.max_attempts, 'failed', 'pending', str(error), key))
+
+    def counts(self):
+        """
+        Return a dict of the number of items in each state.
+        """
+        counts = dict.fromkeys(STATES, 0)
+        with self._lock:
+            counts.update(self._conn.execute(
+                'SELECT state, COUNT(*) FROM work_items GROUP BY state'))
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def enqueue_plan(queue, plan):
+    """
+    Queue the downloads and uploads of a
+    :class:`SyncPlan<ohapi.sync.SyncPlan>`, keyed by their local paths.
+
+    :param queue: This field is the :class:`WorkQueue
+        <ohapi.work_queue.WorkQueue>`.
+    :param plan: This field is the plan.
+    """
+    queue.put_many(
+        ('{}:{}'.format(action.action, action.path), action.to_dict())
+        for action in plan if action.action in ('download', 'upload'))
+
+
+def _renew_leases(queue, keys, stop, interval):
+    """
+    Helper function renewing this worker's leases on keys every interval
+    seconds until stop is set, so long transfers aren't claimed again by
+    another worker.
+    """
+    while not stop.wait(interval):
+        for key in keys:
+            if not queue.renew(key):
+                logging.warning('Lost the lease on {}'.format(key))
+
+
+def run_queue(queue, access_token=None, max_workers=1,
+              max_size=MAX_SIZE_DEFAULT, sha256=False, manifest=None,
+              limiter=None, renew_seconds=None):
+    """
+    Claim and run queued downloads and uploads (see
+    :func:`enqueue_plan<ohapi.work_queue.enqueue_plan>`) until there are
+    none left to claim. Returns the number of items completed by this
+    worker. Errors are logged, and the item is released to be retried.
+    While items run, their leases are renewed in a background thread.
+
+    Run this in several processes attached to the same queue file to use
+    more than one CPU.
+
+    :param queue: This field is the :class:`WorkQueue
+        <ohapi.work_queue.WorkQueue>`.
+    :param access_token: This field is the master access token, needed for
+        uploads. It's default value is None.
+    :param max_workers: This field is the number of items run at once by
+        this worker, in threads. It's default value is 1.
+    :param max_size: This field is the maximum file size to download. It's
+        default value is 128m.
+    :param sha256: If True, SHA-256 digests of downloads are also computed.
+        It's default value is False.
+    :param manifest: If provided, this field is the filepath of a manifest
+        recording the digests of downloaded files. It's default value is
+        None.
+    :param limiter: If provided, this field is an :class:`AdaptiveLimiter
+        <ohapi.api.AdaptiveLimiter>`, and its current limit is used instead
+        of max_workers for each batch of claims. It's default value is None.
+    :param renew_seconds: This field is the number of seconds between lease
+        renewals. It's default value is None, for a third of the queue's
+        lease_seconds.
+    """
+    if renew_seconds is None:
+        renew_seconds = queue.lease_seconds / 3.0
+
+    def transfer(action):
+        if action.action == 'download':
+            _run_download(action, max_size, sha256, manifest)
+        else:
+            _run_upload(action, access_token)
+
+    def run(item):
+        action = SyncAction(**item.payload)
+        logging.debug('Running {} of {} (attempt {})'.format(
+            action.action, action.path, item.attempts))
+        try:
+            if limiter is None:
+                transfer(action)
+            else:
+                # The slot sees the error before it's caught here.
+                with limiter.slot():
+                    transfer(action)
+        except Exception as e:
+            logging.error('Failed {} of {}: {}'.format(
+                action.action, action.path, e))
+            return e
+        return None
+
+    completed = 0
+    while True:
+        items = []
+        batch_size = max_workers if limiter is None else limiter.limit
+        for _ in range(batch_size):
+            item = queue.claim()
+            if item is None:
+                break
+            items.append(item)
+        if not items:
+            break
+        stop = threading.Event()
+        renewer = threading.Thread(
+            target=_renew_leases,
+            args=(queue, [item.key for item in items], stop, renew_seconds))
+        renewer.daemon = True
+        if renew_seconds > 0:
+            renewer.start()
+        try:
+            if limiter is not None:
+                results = _run_concurrently(
+                    run, [{'item': i} for i in items],
+                    max_workers=limiter.max_limit)
+            elif max_workers > 1:
+                results = _run_concurrently(
+                    run, [{'item': i} for i in items],
+                    max_workers=max_workers)
+            else:
+                results = [run(item) for item in items]
+        finally:
+            stop.set()
+            if renewer.is_alive():
+                renewer.join()
+        for item, error in zip(items, results):
+            if error is None:
+                queue.complete(item.key)
+                completed += 1
+            else:
+                queue.fail(item.key, error)
+    return completed